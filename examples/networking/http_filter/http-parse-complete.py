@@ -59,6 +59,7 @@ def cleanup():
     #looking for leaf having:
     #timestap  == 0        --> update with current timestamp
     #AGE > MAX_AGE_SECONDS --> delete item
+    expired = []
     for key,leaf in bpf_sessions.items():
       try:
         current_leaf = bpf_sessions[key]
@@ -68,9 +69,12 @@ def cleanup():
         else:
           #delete older entries
           if (current_time - current_leaf.timestamp > MAX_AGE_SECONDS):
-            del bpf_sessions[key]
+            expired.append(key)
       except:
         print("cleanup exception.")
+    #delete all older entries at once
+    #entries already deleted by the packet loop are reported as failures
+    bpf_sessions.delete_many(expired)
     return 
 
 #args
@@ -44,6 +44,27 @@ void * bpf_module_create_c_from_string(const char *text, unsigned flags, const c
   return mod;
 }
 
+void * bpf_module_create_from_object(const char *path, unsigned flags) {
+  auto mod = new ebpf::BPFModule(flags);
+  if (mod->load_object(path) != 0) {
+    delete mod;
+    return nullptr;
+  }
+  return mod;
+}
+
+int bpf_module_save_object(void *program, const char *path) {
+  auto mod = static_cast<ebpf::BPFModule *>(program);
+  if (!mod) return -1;
+  return mod->save_object(path);
+}
+
+int bpf_module_build_pch(const char *text, const char *path, unsigned flags,
+                         const char *cflags[], int ncflags) {
+  ebpf::BPFModule mod(flags);
+  return mod.build_pch(text, path, cflags, ncflags);
+}
+
 void bpf_module_destroy(void *program) {
   auto mod = static_cast<ebpf::BPFModule *>(program);
   if (!mod) return;
@@ -27,6 +27,10 @@ extern "C" {
 void * bpf_module_create_b(const char *filename, const char *proto_filename, unsigned flags);
 void * bpf_module_create_c(const char *filename, unsigned flags, const char *cflags[], int ncflags);
 void * bpf_module_create_c_from_string(const char *text, unsigned flags, const char *cflags[], int ncflags);
+void * bpf_module_create_from_object(const char *path, unsigned flags);
+int bpf_module_save_object(void *program, const char *path);
+int bpf_module_build_pch(const char *text, const char *path, unsigned flags,
+                         const char *cflags[], int ncflags);
 void bpf_module_destroy(void *program);
 char * bpf_module_license(void *program);
 unsigned bpf_module_kern_version(void *program);
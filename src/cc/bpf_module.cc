@@ -14,6 +14,7 @@
  * limitations under the License.
  */
 #include <algorithm>
+#include <errno.h>
 #include <fcntl.h>
 #include <ftw.h>
 #include <map>
@@ -328,6 +329,13 @@ int BPFModule::load_cfile(const string &file, bool in_memory, const char *cflags
   return 0;
 }
 
+// precompile the headers included by text into path, for use with -include-pch
+int BPFModule::build_pch(const string &text, const string &path, const char *cflags[],
+                         int ncflags) {
+  ClangLoader loader(&*ctx_, flags_);
+  return loader.build_pch(text, path, cflags, ncflags);
+}
+
 // NOTE: this is a duplicate of the above, but planning to deprecate if we
 // settle on clang as the frontend
 
@@ -745,4 +753,247 @@ int BPFModule::load_string(const string &text, const char *cflags[], int ncflags
   return 0;
 }
 
+// Serialized module layout, all integers in host byte order:
+//   char magic[8]
+//   u32 num_tables, followed by that many tables:
+//     str name, u32 flags, i32 type, u64 key_size, u64 leaf_size,
+//     u64 max_entries, str key_desc, str leaf_desc
+//   u32 num_sections, followed by that many sections:
+//     str name, u64 size, u8 data[size]
+// where str is a u32 length followed by the (unterminated) characters.
+// Map references in function sections are stored as table indices instead of
+// fds, so that the maps can be recreated when the object is loaded.
+static const char OBJECT_MAGIC[8] = {'B', 'C', 'C', 'O', 'B', 'J', '0', '1'};
+static const uint32_t OBJECT_TABLE_EXPORTED = 0x1;
+static const uint32_t OBJECT_TABLE_EXTERN = 0x2;
+static const uint32_t OBJECT_MAX_STR = 1 << 20;
+
+static bool object_write(FILE *f, const void *data, size_t size) {
+  return size == 0 || fwrite(data, size, 1, f) == 1;
+}
+
+static bool object_write_u32(FILE *f, uint32_t val) {
+  return object_write(f, &val, sizeof(val));
+}
+
+static bool object_write_u64(FILE *f, uint64_t val) {
+  return object_write(f, &val, sizeof(val));
+}
+
+static bool object_write_str(FILE *f, const string &val) {
+  return object_write_u32(f, val.size()) && object_write(f, val.data(), val.size());
+}
+
+static bool object_read(FILE *f, void *data, size_t size) {
+  return size == 0 || fread(data, size, 1, f) == 1;
+}
+
+static bool object_read_u32(FILE *f, uint32_t *val) {
+  return object_read(f, val, sizeof(*val));
+}
+
+static bool object_read_u64(FILE *f, uint64_t *val) {
+  return object_read(f, val, sizeof(*val));
+}
+
+static bool object_read_str(FILE *f, string *val) {
+  uint32_t len;
+  if (!object_read_u32(f, &len) || len > OBJECT_MAX_STR)
+    return false;
+  val->resize(len);
+  return object_read(f, &(*val)[0], len);
+}
+
+// Rewrite the immediate of every map fd load (ld_imm64 with the pseudo map fd
+// source register) in a function with the value returned by translate.
+template <typename F>
+static bool relocate_map_fds(uint8_t *start, size_t size, F translate) {
+  struct bpf_insn *insns = (struct bpf_insn *)start;
+  size_t insn_cnt = size / sizeof(struct bpf_insn);
+  for (size_t i = 0; i + 1 < insn_cnt; ++i) {
+    if (insns[i].code != (BPF_LD | BPF_DW | BPF_IMM))
+      continue;
+    if (insns[i].src_reg == BPF_PSEUDO_MAP_FD) {
+      int imm = translate(insns[i].imm);
+      if (imm < 0)
+        return false;
+      insns[i].imm = imm;
+    }
+    // ld_imm64 occupies two instruction slots
+    ++i;
+  }
+  return true;
+}
+
+// Save the compiled functions and table definitions of this module, so that
+// it can later be recreated with load_object without invoking clang.
+int BPFModule::save_object(const string &path) const {
+  if (sections_.empty() || !tables_) {
+    fprintf(stderr, "Program not initialized\n");
+    return -1;
+  }
+  if (b_loader_) {
+    fprintf(stderr, "Saving B modules is not supported\n");
+    return -1;
+  }
+
+  map<int, int> fd_ids;
+  for (size_t i = 0; i < tables_->size(); ++i)
+    fd_ids[(*tables_)[i].fd] = i;
+
+  // write to a temporary file first, so that concurrent readers never see a
+  // partially written object
+  string tmp_path = path + ".tmp." + std::to_string(getpid());
+  FILE *f = fopen(tmp_path.c_str(), "wb");
+  if (!f) {
+    fprintf(stderr, "open(%s): %s\n", tmp_path.c_str(), strerror(errno));
+    return -1;
+  }
+
+  bool ok = object_write(f, OBJECT_MAGIC, sizeof(OBJECT_MAGIC));
+  ok = ok && object_write_u32(f, tables_->size());
+  for (auto &table : *tables_) {
+    if (!ok) break;
+    uint32_t flags = 0;
+    if (table.is_shared)
+      flags |= OBJECT_TABLE_EXPORTED;
+    else if (SharedTables::instance()->lookup_fd(table.name) == table.fd)
+      flags |= OBJECT_TABLE_EXTERN;
+    ok = object_write_str(f, table.name) && object_write_u32(f, flags) &&
+         object_write_u32(f, table.type) && object_write_u64(f, table.key_size) &&
+         object_write_u64(f, table.leaf_size) && object_write_u64(f, table.max_entries) &&
+         object_write_str(f, table.key_desc) && object_write_str(f, table.leaf_desc);
+  }
+
+  ok = ok && object_write_u32(f, sections_.size());
+  for (auto &section : sections_) {
+    if (!ok) break;
+    uint8_t *start = get<0>(section.second);
+    size_t size = get<1>(section.second);
+    vector<uint8_t> data(start, start + size);
+    if (!strncmp(FN_PREFIX.c_str(), section.first.c_str(), FN_PREFIX.size())) {
+      ok = relocate_map_fds(data.data(), size, [&](int fd) {
+        auto it = fd_ids.find(fd);
+        return it == fd_ids.end() ? -1 : it->second;
+      });
+      if (!ok) {
+        fprintf(stderr, "Unknown map reference in %s\n", section.first.c_str());
+        break;
+      }
+    }
+    ok = object_write_str(f, section.first) && object_write_u64(f, size) &&
+         object_write(f, data.data(), size);
+  }
+
+  if (fclose(f) != 0)
+    ok = false;
+  if (ok && rename(tmp_path.c_str(), path.c_str()) < 0) {
+    fprintf(stderr, "rename(%s): %s\n", path.c_str(), strerror(errno));
+    ok = false;
+  }
+  if (!ok) {
+    unlink(tmp_path.c_str());
+    return -1;
+  }
+  return 0;
+}
+
+// load a module previously written by save_object, creating fresh maps
+int BPFModule::load_object(const string &path) {
+  if (!sections_.empty()) {
+    fprintf(stderr, "Program already initialized\n");
+    return -1;
+  }
+  FILE *f = fopen(path.c_str(), "rb");
+  if (!f) {
+    fprintf(stderr, "open(%s): %s\n", path.c_str(), strerror(errno));
+    return -1;
+  }
+
+  int rc = -1;
+  char magic[sizeof(OBJECT_MAGIC)];
+  uint32_t num_tables, num_sections;
+  // maps created here and not handed over to SharedTables, which are closed
+  // again if loading fails
+  vector<int> created_fds;
+  if (!object_read(f, magic, sizeof(magic)) || memcmp(magic, OBJECT_MAGIC, sizeof(magic))) {
+    fprintf(stderr, "%s: not a bcc object file\n", path.c_str());
+    goto out;
+  }
+
+  tables_ = make_unique<vector<TableDesc>>();
+  if (!object_read_u32(f, &num_tables))
+    goto corrupt;
+  for (uint32_t i = 0; i < num_tables; ++i) {
+    TableDesc table = TableDesc();
+    uint32_t flags, type;
+    uint64_t key_size, leaf_size, max_entries;
+    if (!object_read_str(f, &table.name) || !object_read_u32(f, &flags) ||
+        !object_read_u32(f, &type) || !object_read_u64(f, &key_size) ||
+        !object_read_u64(f, &leaf_size) || !object_read_u64(f, &max_entries) ||
+        !object_read_str(f, &table.key_desc) || !object_read_str(f, &table.leaf_desc))
+      goto corrupt;
+    table.type = type;
+    table.key_size = key_size;
+    table.leaf_size = leaf_size;
+    table.max_entries = max_entries;
+    if (flags & OBJECT_TABLE_EXTERN)
+      table.fd = SharedTables::instance()->lookup_fd(table.name);
+    else
+      table.fd = bpf_create_map((enum bpf_map_type)table.type, table.key_size,
+                                table.leaf_size, table.max_entries);
+    if (table.fd < 0) {
+      fprintf(stderr, "could not open bpf map %s: %s\n", table.name.c_str(), strerror(errno));
+      goto out;
+    }
+    if (!(flags & OBJECT_TABLE_EXTERN))
+      created_fds.push_back(table.fd);
+    if (flags & OBJECT_TABLE_EXPORTED) {
+      if (!SharedTables::instance()->insert_fd(table.name, table.fd)) {
+        fprintf(stderr, "could not export bpf map %s: already in use\n", table.name.c_str());
+        goto out;
+      }
+      // closed by the destructor through SharedTables::remove_fd
+      created_fds.pop_back();
+      table.is_shared = true;
+    }
+    table_names_[table.name] = i;
+    tables_->push_back(move(table));
+  }
+
+  if (!object_read_u32(f, &num_sections))
+    goto corrupt;
+  for (uint32_t i = 0; i < num_sections; ++i) {
+    string name;
+    uint64_t size;
+    if (!object_read_str(f, &name) || !object_read_u64(f, &size) || size > UINT32_MAX)
+      goto corrupt;
+    unique_ptr<uint8_t[]> data(new uint8_t[size]);
+    if (!object_read(f, data.get(), size))
+      goto corrupt;
+    if (!strncmp(FN_PREFIX.c_str(), name.c_str(), FN_PREFIX.size())) {
+      bool ok = relocate_map_fds(data.get(), size, [&](int id) {
+        return id < 0 || (size_t)id >= tables_->size() ? -1 : (*tables_)[id].fd;
+      });
+      if (!ok)
+        goto corrupt;
+      function_names_.push_back(name);
+    }
+    sections_[name] = make_tuple(data.get(), size);
+    object_sections_.push_back(move(data));
+  }
+  rc = 0;
+  goto out;
+
+corrupt:
+  fprintf(stderr, "%s: corrupt bcc object file\n", path.c_str());
+out:
+  fclose(f);
+  if (rc != 0) {
+    for (int fd : created_fds)
+      close(fd);
+  }
+  return rc;
+}
+
 } // namespace ebpf
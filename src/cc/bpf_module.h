@@ -57,6 +57,10 @@ class BPFModule {
   int load_b(const std::string &filename, const std::string &proto_filename);
   int load_c(const std::string &filename, const char *cflags[], int ncflags);
   int load_string(const std::string &text, const char *cflags[], int ncflags);
+  int load_object(const std::string &path);
+  int save_object(const std::string &path) const;
+  int build_pch(const std::string &text, const std::string &path, const char *cflags[],
+                int ncflags);
   size_t num_functions() const;
   uint8_t * function_start(size_t id) const;
   uint8_t * function_start(const std::string &name) const;
@@ -102,6 +106,8 @@ class BPFModule {
   std::vector<std::string> function_names_;
   std::map<llvm::Type *, llvm::Function *> readers_;
   std::map<llvm::Type *, llvm::Function *> writers_;
+  // backing storage for sections restored by load_object
+  std::vector<std::unique_ptr<uint8_t[]>> object_sections_;
 };
 
 }  // namespace ebpf
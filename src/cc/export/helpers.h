@@ -60,6 +60,19 @@ BPF_TABLE(_table_type, _key_type, _leaf_type, _name, _max_entries); \
 __attribute__((section("maps/export"))) \
 struct _name##_table_t __##_name
 
+// Define two tables _name_0 and _name_1 for interval reporting, and a one
+// entry array _name_sel telling which of them the program should write to.
+// Map functions cannot be used inside macros, so programs select the table
+// themselves:
+//   int zero = 0;
+//   u32 *sel = _name_sel.lookup(&zero);
+//   if (sel && *sel) _name_1.increment(key); else _name_0.increment(key);
+// From python, get_double_table() swaps the two and drains the idle one.
+#define BPF_DOUBLE_TABLE(_table_type, _key_type, _leaf_type, _name, _max_entries) \
+BPF_TABLE(_table_type, _key_type, _leaf_type, _name##_0, _max_entries); \
+BPF_TABLE(_table_type, _key_type, _leaf_type, _name##_1, _max_entries); \
+BPF_TABLE("array", int, u32, _name##_sel, 1)
+
 // Table for pushing custom events to userspace via ring buffer
 #define BPF_PERF_OUTPUT(_name) \
 struct _name##_table_t { \
@@ -74,35 +74,17 @@ ClangLoader::ClangLoader(llvm::LLVMContext *ctx, unsigned flags)
 
 ClangLoader::~ClangLoader() {}
 
-int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDesc>> *tables,
-                       const string &file, bool in_memory, const char *cflags[], int ncflags) {
+// Build the clang -cc1 arguments for compiling abs_file against the headers
+// of the running kernel. Must be called from the kernel build directory.
+int ClangLoader::build_ccargs(clang::DiagnosticsEngine &diags, const string &abs_file,
+                              const char *cwd, const char *machine, const string &kdir,
+                              bool bcc_includes, const char *cflags[], int ncflags,
+                              vector<string> *ccargs) {
   using namespace clang;
 
-  string main_path = "/virtual/main.c";
-  unique_ptr<llvm::MemoryBuffer> main_buf;
-  struct utsname un;
-  uname(&un);
-  string kdir = string(KERNEL_MODULES_DIR) + "/" + un.release;
-
-  // clang needs to run inside the kernel dir
-  DirStack dstack(kdir + "/" + KERNEL_MODULES_SUFFIX);
-  if (!dstack.ok())
-    return -1;
-
-  string abs_file;
-  if (in_memory) {
-    abs_file = main_path;
-    main_buf = llvm::MemoryBuffer::getMemBuffer(file);
-  } else {
-    if (file.substr(0, 1) == "/")
-      abs_file = file;
-    else
-      abs_file = string(dstack.cwd()) + "/" + file;
-  }
-
   // -fno-color-diagnostics: this is a workaround for a bug in llvm terminalHasColors() as of
   // 22 Jul 2016. Also see bcc #615.
-  vector<const char *> flags_cstr({"-O0", "-emit-llvm", "-I", dstack.cwd(),
+  vector<const char *> flags_cstr({"-O0", "-emit-llvm", "-I", cwd,
                                    "-Wno-deprecated-declarations",
                                    "-Wno-gnu-variable-sized-type-not-at-end",
                                    "-fno-color-diagnostics",
@@ -110,12 +92,14 @@ int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDes
 
   KBuildHelper kbuild_helper(kdir);
   vector<string> kflags;
-  if (kbuild_helper.get_flags(un.machine, &kflags))
+  if (kbuild_helper.get_flags(machine, &kflags))
     return -1;
-  kflags.push_back("-include");
-  kflags.push_back("/virtual/include/bcc/bpf.h");
-  kflags.push_back("-include");
-  kflags.push_back("/virtual/include/bcc/helpers.h");
+  if (bcc_includes) {
+    kflags.push_back("-include");
+    kflags.push_back("/virtual/include/bcc/bpf.h");
+    kflags.push_back("-include");
+    kflags.push_back("/virtual/include/bcc/helpers.h");
+  }
   kflags.push_back("-isystem");
   kflags.push_back("/virtual/include");
   for (auto it = kflags.begin(); it != kflags.end(); ++it)
@@ -125,13 +109,6 @@ int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDes
       flags_cstr.push_back(cflags[i]);
   }
 
-  // set up the error reporting class
-  IntrusiveRefCntPtr<DiagnosticOptions> diag_opts(new DiagnosticOptions());
-  auto diag_client = new TextDiagnosticPrinter(llvm::errs(), &*diag_opts);
-
-  IntrusiveRefCntPtr<DiagnosticIDs> DiagID(new DiagnosticIDs());
-  DiagnosticsEngine diags(DiagID, &*diag_opts, diag_client);
-
   // set up the command line argument wrapper
 #if defined(__powerpc64__)
   driver::Driver drv("", "ppc64le-unknown-linux-gnu", diags);
@@ -161,15 +138,61 @@ int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDes
     return -1;
   }
 
-  // Initialize a compiler invocation object from the clang (-cc1) arguments.
-  const driver::ArgStringList &ccargs = cmd.getArguments();
+  // the arguments are owned by the compilation, so copy them out
+  for (auto arg : cmd.getArguments())
+    ccargs->push_back(arg);
 
   if (flags_ & DEBUG_PREPROCESSOR) {
     llvm::errs() << "clang";
-    for (auto arg : ccargs)
+    for (auto &arg : *ccargs)
       llvm::errs() << " " << arg;
     llvm::errs() << "\n";
   }
+  return 0;
+}
+
+int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDesc>> *tables,
+                       const string &file, bool in_memory, const char *cflags[], int ncflags) {
+  using namespace clang;
+
+  string main_path = "/virtual/main.c";
+  unique_ptr<llvm::MemoryBuffer> main_buf;
+  struct utsname un;
+  uname(&un);
+  string kdir = string(KERNEL_MODULES_DIR) + "/" + un.release;
+
+  // clang needs to run inside the kernel dir
+  DirStack dstack(kdir + "/" + KERNEL_MODULES_SUFFIX);
+  if (!dstack.ok())
+    return -1;
+
+  string abs_file;
+  if (in_memory) {
+    abs_file = main_path;
+    main_buf = llvm::MemoryBuffer::getMemBuffer(file);
+  } else {
+    if (file.substr(0, 1) == "/")
+      abs_file = file;
+    else
+      abs_file = string(dstack.cwd()) + "/" + file;
+  }
+
+  // set up the error reporting class
+  IntrusiveRefCntPtr<DiagnosticOptions> diag_opts(new DiagnosticOptions());
+  auto diag_client = new TextDiagnosticPrinter(llvm::errs(), &*diag_opts);
+
+  IntrusiveRefCntPtr<DiagnosticIDs> DiagID(new DiagnosticIDs());
+  DiagnosticsEngine diags(DiagID, &*diag_opts, diag_client);
+
+  vector<string> ccargs_str;
+  if (build_ccargs(diags, abs_file, dstack.cwd(), un.machine, kdir, true, cflags, ncflags,
+                   &ccargs_str))
+    return -1;
+
+  // Initialize a compiler invocation object from the clang (-cc1) arguments.
+  vector<const char *> ccargs;
+  for (auto &arg : ccargs_str)
+    ccargs.push_back(arg.c_str());
 
   // pre-compilation pass for generating tracepoint structures
   auto invocation0 = make_unique<CompilerInvocation>();
@@ -256,5 +279,60 @@ int ClangLoader::parse(unique_ptr<llvm::Module> *mod, unique_ptr<vector<TableDes
   return 0;
 }
 
+int ClangLoader::build_pch(const string &text, const string &path, const char *cflags[],
+                           int ncflags) {
+  using namespace clang;
+
+  string main_path = "/virtual/pch.c";
+  struct utsname un;
+  uname(&un);
+  string kdir = string(KERNEL_MODULES_DIR) + "/" + un.release;
+
+  // clang needs to run inside the kernel dir
+  DirStack dstack(kdir + "/" + KERNEL_MODULES_SUFFIX);
+  if (!dstack.ok())
+    return -1;
+
+  IntrusiveRefCntPtr<DiagnosticOptions> diag_opts(new DiagnosticOptions());
+  auto diag_client = new TextDiagnosticPrinter(llvm::errs(), &*diag_opts);
+
+  IntrusiveRefCntPtr<DiagnosticIDs> DiagID(new DiagnosticIDs());
+  DiagnosticsEngine diags(DiagID, &*diag_opts, diag_client);
+
+  // The header is compiled with exactly the arguments of a program, so that
+  // the language options match when it is used with -include-pch. The bcc
+  // helpers are left out; they are included after the precompiled header.
+  vector<string> ccargs_str;
+  if (build_ccargs(diags, main_path, dstack.cwd(), un.machine, kdir, false, cflags, ncflags,
+                   &ccargs_str))
+    return -1;
+  vector<const char *> ccargs;
+  for (auto &arg : ccargs_str)
+    ccargs.push_back(arg.c_str());
+
+  auto invocation = make_unique<CompilerInvocation>();
+  if (!CompilerInvocation::CreateFromArgs(*invocation, const_cast<const char **>(ccargs.data()),
+                                          const_cast<const char **>(ccargs.data()) + ccargs.size(), diags))
+    return -1;
+
+  unique_ptr<llvm::MemoryBuffer> main_buf = llvm::MemoryBuffer::getMemBuffer(text);
+  invocation->getPreprocessorOpts().RetainRemappedFileBuffers = true;
+  for (const auto &f : remapped_files_)
+    invocation->getPreprocessorOpts().addRemappedFile(f.first, &*f.second);
+  invocation->getPreprocessorOpts().addRemappedFile(main_path, &*main_buf);
+  invocation->getFrontendOpts().Inputs.clear();
+  invocation->getFrontendOpts().Inputs.push_back(FrontendInputFile(main_path, IK_C));
+  invocation->getFrontendOpts().OutputFile = path;
+  invocation->getFrontendOpts().DisableFree = false;
+
+  CompilerInstance compiler;
+  compiler.setInvocation(invocation.release());
+  compiler.createDiagnostics();
+
+  GeneratePCHAction pch_act;
+  if (!compiler.ExecuteAction(pch_act))
+    return -1;
+  return 0;
+}
 
 }  // namespace ebpf
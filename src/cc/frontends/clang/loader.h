@@ -19,6 +19,11 @@
 #include <map>
 #include <memory>
 #include <string>
+#include <vector>
+
+namespace clang {
+class DiagnosticsEngine;
+}
 
 namespace llvm {
 class Module;
@@ -41,7 +46,12 @@ class ClangLoader {
   ~ClangLoader();
   int parse(std::unique_ptr<llvm::Module> *mod, std::unique_ptr<std::vector<TableDesc>> *tables,
             const std::string &file, bool in_memory, const char *cflags[], int ncflags);
+  int build_pch(const std::string &text, const std::string &path, const char *cflags[],
+                int ncflags);
  private:
+  int build_ccargs(clang::DiagnosticsEngine &diags, const std::string &abs_file, const char *cwd,
+                   const char *machine, const std::string &kdir, bool bcc_includes,
+                   const char *cflags[], int ncflags, std::vector<std::string> *ccargs);
   static std::map<std::string, std::unique_ptr<llvm::MemoryBuffer>> remapped_files_;
   llvm::LLVMContext *ctx_;
   unsigned flags_;
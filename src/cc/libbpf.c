@@ -61,6 +61,22 @@
 #define PERF_FLAG_FD_CLOEXEC (1UL << 3)
 #endif
 
+// BPF_MAP_LOOKUP_BATCH and its attributes, available since Linux 5.6
+#define BCC_MAP_LOOKUP_BATCH 24
+#define BCC_MAP_UPDATE_BATCH 26
+#define BCC_MAP_DELETE_BATCH 27
+
+struct bcc_batch_attr {
+  __u64 in_batch;
+  __u64 out_batch;
+  __u64 keys;
+  __u64 values;
+  __u32 count;
+  __u32 map_fd;
+  __u64 elem_flags;
+  __u64 flags;
+};
+
 static __u64 ptr_to_u64(void *ptr)
 {
   return (__u64) (unsigned long) ptr;
@@ -134,6 +150,258 @@ int bpf_get_next_key(int fd, void *key, void *next_key)
   return syscall(__NR_bpf, BPF_MAP_GET_NEXT_KEY, &attr, sizeof(attr));
 }
 
+// Find the first key of a map. Kernels since 4.12 accept a NULL key for this;
+// older ones fault on it, but return the first key when given one that is not
+// in the map, so look for such a key instead. value_size is only used for
+// that lookup. Fails with ENOENT if the map is empty.
+int bpf_get_first_key(int fd, void *key, size_t key_size, size_t value_size)
+{
+  int i, res;
+  void *value;
+
+  res = bpf_get_next_key(fd, NULL, key);
+  if (res == 0 || (errno != EFAULT && errno != EINVAL))
+    return res;
+
+  value = malloc(value_size);
+  if (!value)
+    return -1;
+  res = -1;
+  for (i = 0; i < 0x100; i++) {
+    memset(key, i, key_size);
+    if (bpf_lookup_elem(fd, key, value) < 0 && errno == ENOENT) {
+      res = bpf_get_next_key(fd, key, key);
+      break;
+    }
+  }
+  if (i == 0x100)
+    errno = EEXIST;
+  free(value);
+  return res;
+}
+
+static int dump_map_batch(int fd, void *keys, size_t key_size, void *values,
+                          size_t value_size, int max_entries)
+{
+  struct bcc_batch_attr attr;
+  void *token;
+  int n = 0, res = 0;
+
+  // the position token is a bucket index for hash maps and a key otherwise
+  token = calloc(1, key_size > 8 ? key_size : 8);
+  if (!token)
+    return -1;
+  while (n < max_entries) {
+    memset(&attr, 0, sizeof(attr));
+    attr.in_batch = n ? ptr_to_u64(token) : 0;
+    attr.out_batch = ptr_to_u64(token);
+    attr.keys = ptr_to_u64((char *)keys + n * key_size);
+    attr.values = ptr_to_u64((char *)values + n * value_size);
+    attr.count = max_entries - n;
+    attr.map_fd = fd;
+    res = syscall(__NR_bpf, BCC_MAP_LOOKUP_BATCH, &attr, sizeof(attr));
+    // the kernel reports how many elements it copied even on failure
+    n += attr.count;
+    if (res < 0) {
+      if (errno == ENOENT)
+        res = 0;
+      break;
+    }
+    if (attr.count == 0)
+      break;
+  }
+  free(token);
+  return res < 0 ? -1 : n;
+}
+
+// Read up to max_entries keys and values of a map into the keys and values
+// arrays, and return how many were read. This uses the kernel's batch lookup
+// where supported, and otherwise walks the map with one get_next_key and one
+// lookup per element; entries deleted during the walk are skipped.
+int bpf_dump_map(int fd, void *keys, size_t key_size, void *values,
+                 size_t value_size, int max_entries)
+{
+  int n = 0, res;
+  char *cur, *next;
+
+  if (max_entries <= 0)
+    return 0;
+  res = dump_map_batch(fd, keys, key_size, values, value_size, max_entries);
+  if (res >= 0)
+    return res;
+
+  if (bpf_get_first_key(fd, keys, key_size, value_size) < 0)
+    return errno == ENOENT ? 0 : -1;
+  cur = keys;
+  for (;;) {
+    if (bpf_lookup_elem(fd, cur, (char *)values + n * value_size) == 0)
+      n++;
+    if (n == max_entries)
+      break;
+    // a key that vanished is overwritten by its successor
+    next = (char *)keys + n * key_size;
+    if (bpf_get_next_key(fd, cur, next) < 0) {
+      if (errno != ENOENT)
+        return -1;
+      break;
+    }
+    cur = next;
+  }
+  return n;
+}
+
+// Update (if values is set) or delete count elements with the kernel's batch
+// operations, which stop at the first element that fails; record its errno
+// and carry on after it. Returns the number of failed elements, or -1 if the
+// kernel does not support batch operations on this map. Kernels and map types
+// without batch support fail before looking at count, leaving it as it was
+// sent, so it can't be trusted to tell whether anything was processed.
+static int batch_update_delete(int cmd, int fd, void *keys, size_t key_size,
+                               void *values, size_t value_size, int count,
+                               unsigned long long flags, int *errors)
+{
+  struct bcc_batch_attr attr;
+  int i, n = 0, failed = 0, res, err, done;
+
+  while (n < count) {
+    memset(&attr, 0, sizeof(attr));
+    attr.keys = ptr_to_u64((char *)keys + n * key_size);
+    if (values)
+      attr.values = ptr_to_u64((char *)values + n * value_size);
+    attr.count = count - n;
+    attr.map_fd = fd;
+    attr.elem_flags = flags;
+    res = syscall(__NR_bpf, cmd, &attr, sizeof(attr));
+    err = errno;
+    // a failing call writes back fewer than it was sent, so an unchanged
+    // count means nothing was processed; redoing that one key at a time
+    // also reports the right errno if the first element genuinely failed
+    if (res < 0 && n == 0 &&
+        (attr.count == 0 || attr.count == (__u32)count) &&
+        (err == EINVAL || err == ENOTSUP || err == EOPNOTSUPP ||
+         err == 524 /* ENOTSUPP */))
+      return -1;
+    done = attr.count > (__u32)(count - n) ? count - n : (int)attr.count;
+    for (i = 0; i < done; i++)
+      errors[n + i] = 0;
+    n += done;
+    if (res == 0)
+      break;
+    if (n >= count)
+      break;
+    errors[n++] = err;
+    failed++;
+  }
+  return failed;
+}
+
+// Update count elements of a map from the keys and values arrays, with the
+// same flags as bpf_update_elem, using the kernel's batch update where it is
+// supported. errors[i] is set to the errno of the update of the i-th element,
+// or 0 if it succeeded. Returns the number of elements that failed.
+int bpf_update_batch(int fd, void *keys, size_t key_size, void *values,
+                     size_t value_size, int count, unsigned long long flags,
+                     int *errors)
+{
+  int i, failed;
+
+  failed = batch_update_delete(BCC_MAP_UPDATE_BATCH, fd, keys, key_size,
+                               values, value_size, count, flags, errors);
+  if (failed >= 0)
+    return failed;
+  failed = 0;
+  for (i = 0; i < count; i++) {
+    errors[i] = 0;
+    if (bpf_update_elem(fd, (char *)keys + i * key_size,
+                        (char *)values + i * value_size, flags) < 0) {
+      errors[i] = errno;
+      failed++;
+    }
+  }
+  return failed;
+}
+
+// Delete count elements of a map, like bpf_update_batch.
+int bpf_delete_batch(int fd, void *keys, size_t key_size, int count,
+                     int *errors)
+{
+  int i, failed;
+
+  failed = batch_update_delete(BCC_MAP_DELETE_BATCH, fd, keys, key_size,
+                               NULL, 0, count, 0, errors);
+  if (failed >= 0)
+    return failed;
+  failed = 0;
+  for (i = 0; i < count; i++) {
+    errors[i] = 0;
+    if (bpf_delete_elem(fd, (char *)keys + i * key_size) < 0) {
+      errors[i] = errno;
+      failed++;
+    }
+  }
+  return failed;
+}
+
+// Set all max_entries elements of an array map to the same value, e.g. to
+// reset a histogram.
+int bpf_fill_array(int fd, void *value, int max_entries)
+{
+  uint32_t i;
+
+  for (i = 0; i < (uint32_t)max_entries; i++) {
+    if (bpf_update_elem(fd, &i, value, BPF_ANY) < 0)
+      return -1;
+  }
+  return 0;
+}
+
+// Count the elements of a map by walking its keys natively, without reading
+// the values, for maps whose size the kernel does not report.
+int bpf_count_map(int fd, size_t key_size, size_t value_size)
+{
+  int n = 0;
+  char *keys, *cur, *next, *tmp;
+
+  keys = malloc(2 * key_size);
+  if (!keys)
+    return -1;
+  cur = keys;
+  next = keys + key_size;
+  if (bpf_get_first_key(fd, cur, key_size, value_size) < 0) {
+    free(keys);
+    return errno == ENOENT ? 0 : -1;
+  }
+  do {
+    n++;
+    tmp = cur;
+    cur = next;
+    next = tmp;
+  } while (bpf_get_next_key(fd, next, cur) == 0);
+  free(keys);
+  return errno == ENOENT ? n : -1;
+}
+
+// Copy up to max_entries keys of a map into the keys array by walking them
+// natively, without reading the values. Returns the number of keys copied.
+// Keys deleted concurrently can make the walk start over, so the same key
+// may be returned more than once.
+int bpf_dump_keys(int fd, void *keys, size_t key_size, size_t value_size,
+                  int max_entries)
+{
+  int n = 0;
+  char *cur = keys;
+
+  if (max_entries <= 0)
+    return 0;
+  if (bpf_get_first_key(fd, cur, key_size, value_size) < 0)
+    return errno == ENOENT ? 0 : -1;
+  for (n = 1; n < max_entries; n++, cur += key_size) {
+    if (bpf_get_next_key(fd, cur, cur + key_size) < 0)
+      return errno == ENOENT ? n : -1;
+  }
+  return n;
+}
+
 #define ROUND_UP(x, n) (((x) + (n) - 1u) & ~((n) - 1u))
 
 int bpf_prog_load(enum bpf_prog_type prog_type,
@@ -308,7 +576,7 @@ static void * bpf_attach_probe(int progfd, const char *event,
   char buf[256];
   struct perf_reader *reader = NULL;
 
-  reader = perf_reader_new(cb, NULL, cb_cookie);
+  reader = perf_reader_new(cb, NULL, NULL, cb_cookie, 0);
   if (!reader)
     goto error;
 
@@ -382,13 +650,102 @@ int bpf_detach_uprobe(const char *event_desc) {
   return bpf_detach_probe(event_desc, "uprobe");
 }
 
+// The kernel parses {k,u}probe_events writes line by line in chunks of up to
+// one page, so many probes can be removed with a single write. If a chunk
+// fails, its lines are retried one by one to find the offending ones; probes
+// that are already gone (ENOENT) are not counted as failures in that case.
+// The kernel may also consume only part of a chunk, so writes are repeated
+// until everything has been written.
+#define DETACH_BATCH_SIZE 4096
+
+// Returns how much of buf was written; if that is less than len, errno says
+// why the rest was not.
+static size_t write_all(int fd, const char *buf, size_t len) {
+  size_t done = 0;
+  ssize_t res;
+  while (done < len) {
+    res = write(fd, buf + done, len - done);
+    if (res < 0 && errno == EINTR)
+      continue;
+    if (res <= 0) {
+      if (res == 0)
+        errno = EIO;
+      break;
+    }
+    done += res;
+  }
+  return done;
+}
+
+static int bpf_detach_probe_lines(int kfd, const char *buf, size_t len) {
+  int failed = 0;
+  const char *line = buf, *end = buf + len;
+  while (line < end) {
+    const char *nl = memchr(line, '\n', end - line);
+    size_t line_len = (nl ? nl : end) - line;
+    if (line_len > 0 && write_all(kfd, line, line_len) < line_len &&
+        errno != ENOENT)
+      ++failed;
+    line += line_len + 1;
+  }
+  return failed;
+}
+
+static int bpf_detach_probes(const char *event_descs[], int num,
+                             const char *event_type) {
+  int kfd, i, failed = 0;
+  size_t len = 0, done;
+  char buf[256];
+  char batch[DETACH_BATCH_SIZE];
+
+  snprintf(buf, sizeof(buf), "/sys/kernel/debug/tracing/%s_events", event_type);
+  kfd = open(buf, O_WRONLY | O_APPEND, 0);
+  if (kfd < 0) {
+    fprintf(stderr, "open(%s): %s\n", buf, strerror(errno));
+    return -1;
+  }
+
+  for (i = 0; i <= num; ++i) {
+    size_t desc_len = i < num ? strlen(event_descs[i]) + 1 : 0;
+    // flush when the next line would not fit, or at the end
+    if (len > 0 && (i == num || len + desc_len > sizeof(batch))) {
+      done = write_all(kfd, batch, len);
+      if (done < len)
+        failed += bpf_detach_probe_lines(kfd, batch + done, len - done);
+      len = 0;
+    }
+    if (i == num)
+      break;
+    if (desc_len > sizeof(batch)) {
+      ++failed;
+      continue;
+    }
+    memcpy(batch + len, event_descs[i], desc_len - 1);
+    batch[len + desc_len - 1] = '\n';
+    len += desc_len;
+  }
+  close(kfd);
+
+  if (failed)
+    fprintf(stderr, "failed to remove %d of %d %s events\n", failed, num, event_type);
+  return failed;
+}
+
+int bpf_detach_kprobes(const char *event_descs[], int num) {
+  return bpf_detach_probes(event_descs, num, "kprobe");
+}
+
+int bpf_detach_uprobes(const char *event_descs[], int num) {
+  return bpf_detach_probes(event_descs, num, "uprobe");
+}
+
 void * bpf_attach_tracepoint(int progfd, const char *tp_category,
                              const char *tp_name, int pid, int cpu,
                              int group_fd, perf_reader_cb cb, void *cb_cookie) {
   char buf[256];
   struct perf_reader *reader = NULL;
 
-  reader = perf_reader_new(cb, NULL, cb_cookie);
+  reader = perf_reader_new(cb, NULL, NULL, cb_cookie, 0);
   if (!reader)
     goto error;
 
@@ -410,12 +767,14 @@ int bpf_detach_tracepoint(const char *tp_category, const char *tp_name) {
   return 0;
 }
 
-void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, void *cb_cookie, int pid, int cpu) {
+void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, perf_reader_lost_cb lost_cb,
+                            void *cb_cookie, int pid, int cpu, int page_cnt,
+                            int wakeup_events, int wakeup_watermark) {
   int pfd;
   struct perf_event_attr attr = {};
   struct perf_reader *reader = NULL;
 
-  reader = perf_reader_new(NULL, raw_cb, cb_cookie);
+  reader = perf_reader_new(NULL, raw_cb, lost_cb, cb_cookie, page_cnt);
   if (!reader)
     goto error;
 
@@ -423,7 +782,12 @@ void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, void *cb_cookie, int pid,
   attr.type = PERF_TYPE_SOFTWARE;
   attr.sample_type = PERF_SAMPLE_RAW;
   attr.sample_period = 1;
-  attr.wakeup_events = 1;
+  if (wakeup_watermark > 0) {
+    attr.watermark = 1;
+    attr.wakeup_watermark = wakeup_watermark;
+  } else {
+    attr.wakeup_events = wakeup_events > 0 ? wakeup_events : 1;
+  }
   pfd = syscall(__NR_perf_event_open, &attr, pid, cpu, -1, PERF_FLAG_FD_CLOEXEC);
   if (pfd < 0) {
     fprintf(stderr, "perf_event_open: %s\n", strerror(errno));
@@ -431,6 +795,10 @@ void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, void *cb_cookie, int pid,
     goto error;
   }
   perf_reader_set_fd(reader, pfd);
+  // with deferred wakeups, the last few samples of a quiet stream would sit
+  // in the buffer, so read it when it has not been read for a while
+  if (wakeup_watermark > 0 || wakeup_events > 1)
+    perf_reader_set_flush_timeout(reader, 100);
 
   if (perf_reader_mmap(reader, attr.type, attr.sample_type) < 0)
     goto error;
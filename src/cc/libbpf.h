@@ -30,6 +30,18 @@ int bpf_update_elem(int fd, void *key, void *value, unsigned long long flags);
 int bpf_lookup_elem(int fd, void *key, void *value);
 int bpf_delete_elem(int fd, void *key);
 int bpf_get_next_key(int fd, void *key, void *next_key);
+int bpf_get_first_key(int fd, void *key, size_t key_size, size_t value_size);
+int bpf_dump_map(int fd, void *keys, size_t key_size, void *values,
+		 size_t value_size, int max_entries);
+int bpf_count_map(int fd, size_t key_size, size_t value_size);
+int bpf_dump_keys(int fd, void *keys, size_t key_size, size_t value_size,
+                  int max_entries);
+int bpf_fill_array(int fd, void *value, int max_entries);
+int bpf_update_batch(int fd, void *keys, size_t key_size, void *values,
+		     size_t value_size, int count, unsigned long long flags,
+		     int *errors);
+int bpf_delete_batch(int fd, void *keys, size_t key_size, int count,
+		     int *errors);
 
 int bpf_prog_load(enum bpf_prog_type prog_type,
 		  const struct bpf_insn *insns, int insn_len,
@@ -43,23 +55,37 @@ int bpf_open_raw_sock(const char *name);
 typedef void (*perf_reader_cb)(void *cb_cookie, int pid, uint64_t callchain_num,
                                void *callchain);
 typedef void (*perf_reader_raw_cb)(void *cb_cookie, void *raw, int raw_size);
+typedef void (*perf_reader_lost_cb)(void *cb_cookie, uint64_t lost);
+/* called with all the raw samples read from a ring at once, copied back to
+ * back into data; sample i spans offsets[i] to offsets[i + 1] */
+typedef void (*perf_reader_batch_cb)(void *cb_cookie, void *data, uint32_t *offsets,
+                                     int count);
 
 void * bpf_attach_kprobe(int progfd, const char *event, const char *event_desc,
                          int pid, int cpu, int group_fd, perf_reader_cb cb,
                          void *cb_cookie);
 int bpf_detach_kprobe(const char *event_desc);
+int bpf_detach_kprobes(const char *event_descs[], int num);
 
 void * bpf_attach_uprobe(int progfd, const char *event, const char *event_desc,
                          int pid, int cpu, int group_fd, perf_reader_cb cb,
                          void *cb_cookie);
 int bpf_detach_uprobe(const char *event_desc);
+int bpf_detach_uprobes(const char *event_descs[], int num);
 
 void * bpf_attach_tracepoint(int progfd, const char *tp_category,
                              const char *tp_name, int pid, int cpu,
                              int group_fd, perf_reader_cb cb, void *cb_cookie);
 int bpf_detach_tracepoint(const char *tp_category, const char *tp_name);
 
-void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, void *cb_cookie, int pid, int cpu);
+/* page_cnt is the power of two number of pages per ring buffer, 0 for the
+ * default of 8. lost_cb is called with the number of samples the kernel
+ * dropped because the buffer was full; if it is NULL, they are reported on
+ * stderr. The poller is woken up after every wakeup_events samples, or once
+ * wakeup_watermark bytes are in the buffer if that is not 0. */
+void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, perf_reader_lost_cb lost_cb,
+                            void *cb_cookie, int pid, int cpu, int page_cnt,
+                            int wakeup_events, int wakeup_watermark);
 
 /* attached a prog expressed by progfd to the device specified in dev_name */
 int bpf_attach_xdp(const char *dev_name, int progfd);
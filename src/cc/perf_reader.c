@@ -14,23 +14,35 @@
  * limitations under the License.
  */
 
+#include <errno.h>
 #include <poll.h>
 #include <stdio.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/epoll.h>
 #include <sys/mman.h>
+#include <time.h>
 #include <unistd.h>
 #include <linux/perf_event.h>
 
 #include "libbpf.h"
 #include "perf_reader.h"
 
+// default number of data pages in a ring buffer, 32KB with 4KB pages
 int perf_reader_page_cnt = 8;
 
+static uint64_t now_ms(void) {
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
 struct perf_reader {
   perf_reader_cb cb;
   perf_reader_raw_cb raw_cb;
+  perf_reader_lost_cb lost_cb;
   void *cb_cookie; // to be returned in the cb
   void *buf; // for keeping segmented data
   size_t buf_size;
@@ -40,34 +52,63 @@ struct perf_reader {
   int fd;
   uint32_t type;
   uint64_t sample_type;
+  uint64_t lost; // samples dropped by the kernel since the reader was opened
+  // read the ring when it has not been read for flush_timeout ms, 0 for never
+  int flush_timeout;
+  uint64_t last_read; // CLOCK_MONOTONIC ms
+  // batch mode: raw samples are copied back to back into batch, and
+  // batch_offsets[i] is where sample i starts, with one extra entry for the end
+  perf_reader_batch_cb batch_cb;
+  char *batch;
+  size_t batch_cap;
+  uint32_t *batch_offsets;
+  int batch_cnt;
+  int batch_offsets_cap;
 };
 
-struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb, void *cb_cookie) {
-  struct perf_reader *reader = calloc(1, sizeof(struct perf_reader));
+// page_cnt is the number of data pages of the ring buffer, which the kernel
+// requires to be a power of two, or 0 for the default
+struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb,
+                                     perf_reader_lost_cb lost_cb, void *cb_cookie,
+                                     int page_cnt) {
+  struct perf_reader *reader;
+
+  if (page_cnt == 0)
+    page_cnt = perf_reader_page_cnt;
+  if (page_cnt < 0 || (page_cnt & (page_cnt - 1)) != 0) {
+    fprintf(stderr, "%s: page_cnt %d is not a power of two\n", __FUNCTION__, page_cnt);
+    errno = EINVAL;
+    return NULL;
+  }
+  reader = calloc(1, sizeof(struct perf_reader));
   if (!reader)
     return NULL;
   reader->cb = cb;
   reader->raw_cb = raw_cb;
+  reader->lost_cb = lost_cb;
   reader->cb_cookie = cb_cookie;
   reader->fd = -1;
   reader->page_size = getpagesize();
-  reader->page_cnt = perf_reader_page_cnt;
+  reader->page_cnt = page_cnt;
   return reader;
 }
 
 void perf_reader_free(void *ptr) {
   if (ptr) {
     struct perf_reader *reader = ptr;
-    munmap(reader->base, reader->page_size * (reader->page_cnt + 1));
+    if (reader->base)
+      munmap(reader->base, (size_t)reader->page_size * (reader->page_cnt + 1));
     if (reader->fd >= 0)
       close(reader->fd);
     free(reader->buf);
+    free(reader->batch);
+    free(reader->batch_offsets);
     free(ptr);
   }
 }
 
 int perf_reader_mmap(struct perf_reader *reader, unsigned type, unsigned long sample_type) {
-  int mmap_size = reader->page_size * (reader->page_cnt + 1);
+  size_t mmap_size = (size_t)reader->page_size * (reader->page_cnt + 1);
 
   if (reader->fd < 0) {
     fprintf(stderr, "%s: reader fd is not set\n", __FUNCTION__);
@@ -160,6 +201,68 @@ static void parse_tracepoint(struct perf_reader *reader, void *data, int size) {
     reader->cb(reader->cb_cookie, tk ? tk->common.pid : -1, num_callchain, callchain);
 }
 
+static void batch_flush(struct perf_reader *reader) {
+  if (reader->batch_cnt == 0)
+    return;
+  reader->batch_cb(reader->cb_cookie, reader->batch, reader->batch_offsets,
+                   reader->batch_cnt);
+  reader->batch_cnt = 0;
+  reader->batch_offsets[0] = 0;
+}
+
+// Used when the batch cannot grow: hand over whatever is pending, then the
+// sample on its own straight from the ring, so that nothing is dropped.
+static void batch_deliver_alone(struct perf_reader *reader, void *data, uint32_t size) {
+  uint32_t offsets[2] = {0, size};
+
+  if (reader->batch_offsets)
+    batch_flush(reader);
+  reader->batch_cb(reader->cb_cookie, data, offsets, 1);
+}
+
+static void batch_append(struct perf_reader *reader, void *data, uint32_t size) {
+  uint32_t start;
+
+  if (!reader->batch_offsets) {
+    reader->batch_offsets_cap = 64;
+    reader->batch_offsets = calloc(reader->batch_offsets_cap, sizeof(uint32_t));
+    if (!reader->batch_offsets) {
+      batch_deliver_alone(reader, data, size);
+      return;
+    }
+  }
+  // keep batches no bigger than the ring buffer itself
+  if (reader->batch_offsets[reader->batch_cnt] + size >
+      (uint64_t)reader->page_size * reader->page_cnt)
+    batch_flush(reader);
+  start = reader->batch_offsets[reader->batch_cnt];
+  if (start + size > reader->batch_cap) {
+    size_t cap = reader->batch_cap ? reader->batch_cap : reader->page_size;
+    char *batch;
+    while (cap < start + size)
+      cap *= 2;
+    batch = realloc(reader->batch, cap);
+    if (!batch) {
+      batch_deliver_alone(reader, data, size);
+      return;
+    }
+    reader->batch = batch;
+    reader->batch_cap = cap;
+  }
+  if (reader->batch_cnt + 2 > reader->batch_offsets_cap) {
+    uint32_t *offsets = realloc(reader->batch_offsets,
+                                2 * reader->batch_offsets_cap * sizeof(uint32_t));
+    if (!offsets) {
+      batch_deliver_alone(reader, data, size);
+      return;
+    }
+    reader->batch_offsets = offsets;
+    reader->batch_offsets_cap *= 2;
+  }
+  memcpy(reader->batch + start, data, size);
+  reader->batch_offsets[++reader->batch_cnt] = start + size;
+}
+
 static void parse_sw(struct perf_reader *reader, void *data, int size) {
   uint8_t *ptr = data;
   struct perf_event_header *header = (void *)data;
@@ -190,7 +293,9 @@ static void parse_sw(struct perf_reader *reader, void *data, int size) {
     return;
   }
 
-  if (reader->raw_cb)
+  if (reader->batch_cb)
+    batch_append(reader, raw->data, raw->size);
+  else if (reader->raw_cb)
     reader->raw_cb(reader->cb_cookie, raw->data, raw->size);
 }
 
@@ -236,7 +341,13 @@ static void event_read(struct perf_reader *reader) {
     }
 
     if (e->type == PERF_RECORD_LOST) {
-      fprintf(stderr, "Lost %lu samples\n", *(uint64_t *)(ptr + sizeof(*e)));
+      // the record holds the event id, then the number of lost samples
+      uint64_t lost = *(uint64_t *)(ptr + sizeof(*e) + sizeof(uint64_t));
+      reader->lost += lost;
+      if (reader->lost_cb)
+        reader->lost_cb(reader->cb_cookie, lost);
+      else
+        fprintf(stderr, "Lost %lu samples\n", lost);
     } else if (e->type == PERF_RECORD_SAMPLE) {
       if (reader->type == PERF_TYPE_TRACEPOINT)
         parse_tracepoint(reader, ptr, e->size);
@@ -248,11 +359,23 @@ static void event_read(struct perf_reader *reader) {
 
     write_data_tail(perf_header, perf_header->data_tail + e->size);
   }
+  if (reader->batch_cb)
+    batch_flush(reader);
+  reader->last_read = now_ms();
+}
+
+// Readers with deferred wakeups may hold samples without their fd ever
+// becoming ready, and a busy reader keeps polls from timing out, so after
+// each wait, read those that have not been read for their flush timeout.
+static void flush_stale(struct perf_reader *reader, uint64_t now) {
+  if (reader->flush_timeout > 0 && now - reader->last_read >= (uint64_t)reader->flush_timeout)
+    event_read(reader);
 }
 
 int perf_reader_poll(int num_readers, struct perf_reader **readers, int timeout) {
   struct pollfd pfds[num_readers];
   int i;
+  uint64_t now;
 
   for (i = 0; i <num_readers; ++i) {
     pfds[i].fd = readers[i]->fd;
@@ -265,9 +388,135 @@ int perf_reader_poll(int num_readers, struct perf_reader **readers, int timeout)
         event_read(readers[i]);
     }
   }
+  now = now_ms();
+  for (i = 0; i < num_readers; ++i)
+    flush_stale(readers[i], now);
+  return 0;
+}
+
+// A set of readers registered once with an epoll instance, so that each poll
+// only visits the readers that have data, instead of building a pollfd array
+// of all of them. The readers are not owned by the poller; they must be
+// removed before they are freed, which a callback may do in the middle of a
+// poll. Removal never dereferences the reader, and a poll checks that a ready
+// reader is still registered before reading it whenever readers were removed
+// since the wait.
+struct perf_reader_poller_entry {
+  struct perf_reader *reader;
+  int fd;
+};
+
+struct perf_reader_poller {
+  int epfd;
+  struct perf_reader_poller_entry *entries;
+  struct epoll_event *events;
+  int num_entries;
+  int cap;
+  unsigned removals; // readers removed so far
+};
+
+struct perf_reader_poller * perf_reader_poller_new(void) {
+  struct perf_reader_poller *poller = calloc(1, sizeof(struct perf_reader_poller));
+  if (!poller)
+    return NULL;
+  poller->epfd = epoll_create1(EPOLL_CLOEXEC);
+  if (poller->epfd < 0) {
+    free(poller);
+    return NULL;
+  }
+  return poller;
+}
+
+void perf_reader_poller_free(struct perf_reader_poller *poller) {
+  if (poller) {
+    close(poller->epfd);
+    free(poller->entries);
+    free(poller->events);
+    free(poller);
+  }
+}
+
+int perf_reader_poller_add(struct perf_reader_poller *poller, struct perf_reader *reader) {
+  struct epoll_event ev = {};
+
+  if (poller->num_entries == poller->cap) {
+    int cap = poller->cap ? 2 * poller->cap : 16;
+    struct perf_reader_poller_entry *entries;
+    struct epoll_event *events;
+
+    entries = realloc(poller->entries, cap * sizeof(*entries));
+    if (!entries)
+      return -1;
+    poller->entries = entries;
+    events = realloc(poller->events, cap * sizeof(*events));
+    if (!events)
+      return -1;
+    poller->events = events;
+    poller->cap = cap;
+  }
+  ev.events = EPOLLIN;
+  ev.data.ptr = reader;
+  if (epoll_ctl(poller->epfd, EPOLL_CTL_ADD, reader->fd, &ev) < 0)
+    return -1;
+  poller->entries[poller->num_entries].reader = reader;
+  poller->entries[poller->num_entries].fd = reader->fd;
+  poller->num_entries++;
+  return 0;
+}
+
+// readers must be removed before they are freed
+int perf_reader_poller_remove(struct perf_reader_poller *poller, struct perf_reader *reader) {
+  int i;
+
+  for (i = 0; i < poller->num_entries; ++i) {
+    if (poller->entries[i].reader == reader) {
+      epoll_ctl(poller->epfd, EPOLL_CTL_DEL, poller->entries[i].fd, NULL);
+      poller->entries[i] = poller->entries[--poller->num_entries];
+      poller->removals++;
+      return 0;
+    }
+  }
+  errno = ENOENT;
+  return -1;
+}
+
+static int poller_has(struct perf_reader_poller *poller, struct perf_reader *reader) {
+  int i;
+
+  for (i = 0; i < poller->num_entries; ++i) {
+    if (poller->entries[i].reader == reader)
+      return 1;
+  }
   return 0;
 }
 
+int perf_reader_poller_poll(struct perf_reader_poller *poller, int timeout) {
+  int i, n;
+  unsigned removals;
+  uint64_t now;
+
+  // like perf_reader_poll, just sleep when there is nothing to poll
+  if (poller->num_entries == 0)
+    return poll(NULL, 0, timeout);
+  n = epoll_wait(poller->epfd, poller->events, poller->num_entries, timeout);
+  if (n < 0)
+    return errno == EINTR ? 0 : -1;
+  removals = poller->removals;
+  for (i = 0; i < n; ++i) {
+    struct perf_reader *reader = poller->events[i].data.ptr;
+    // a callback may have removed, and freed, a reader that is still queued
+    if (poller->removals != removals && !poller_has(poller, reader))
+      continue;
+    event_read(reader);
+  }
+  // entries removed by a callback are swapped with the last one, which may
+  // then be skipped until the next poll
+  now = now_ms();
+  for (i = 0; i < poller->num_entries; ++i)
+    flush_stale(poller->entries[i].reader, now);
+  return n;
+}
+
 void perf_reader_set_fd(struct perf_reader *reader, int fd) {
   reader->fd = fd;
 }
@@ -275,3 +524,16 @@ void perf_reader_set_fd(struct perf_reader *reader, int fd) {
 int perf_reader_fd(struct perf_reader *reader) {
   return reader->fd;
 }
+
+void perf_reader_set_batch_cb(struct perf_reader *reader, perf_reader_batch_cb batch_cb) {
+  reader->batch_cb = batch_cb;
+}
+
+void perf_reader_set_flush_timeout(struct perf_reader *reader, int timeout) {
+  reader->flush_timeout = timeout;
+  reader->last_read = now_ms();
+}
+
+uint64_t perf_reader_lost_count(struct perf_reader *reader) {
+  return reader->lost;
+}
@@ -15,10 +15,21 @@
  */
 
 struct perf_reader;
+struct perf_reader_poller;
 
-struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb, void *cb_cookie);
+struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb,
+                                     perf_reader_lost_cb lost_cb, void *cb_cookie,
+                                     int page_cnt);
 void perf_reader_free(void *ptr);
 int perf_reader_mmap(struct perf_reader *reader, unsigned type, unsigned long sample_type);
 int perf_reader_poll(int num_readers, struct perf_reader **readers, int timeout);
+struct perf_reader_poller * perf_reader_poller_new(void);
+void perf_reader_poller_free(struct perf_reader_poller *poller);
+int perf_reader_poller_add(struct perf_reader_poller *poller, struct perf_reader *reader);
+int perf_reader_poller_remove(struct perf_reader_poller *poller, struct perf_reader *reader);
+int perf_reader_poller_poll(struct perf_reader_poller *poller, int timeout);
 int perf_reader_fd(struct perf_reader *reader);
+uint64_t perf_reader_lost_count(struct perf_reader *reader);
+void perf_reader_set_batch_cb(struct perf_reader *reader, perf_reader_batch_cb batch_cb);
+void perf_reader_set_flush_timeout(struct perf_reader *reader, int timeout);
 void perf_reader_set_fd(struct perf_reader *reader, int fd);
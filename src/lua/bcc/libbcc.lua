@@ -39,6 +39,8 @@ int bpf_open_raw_sock(const char *name);
 
 typedef void (*perf_reader_cb)(void *cb_cookie, int pid, uint64_t callchain_num, void *callchain);
 typedef void (*perf_reader_raw_cb)(void *cb_cookie, void *raw, int raw_size);
+typedef void (*perf_reader_lost_cb)(void *cb_cookie, uint64_t lost);
+typedef void (*perf_reader_batch_cb)(void *cb_cookie, void *data, uint32_t *offsets, int count);
 
 void * bpf_attach_kprobe(int progfd, const char *event, const char *event_desc,
   int pid, int cpu, int group_fd, perf_reader_cb cb, void *cb_cookie);
@@ -48,7 +50,7 @@ void * bpf_attach_uprobe(int progfd, const char *event, const char *event_desc,
   int pid, int cpu, int group_fd, perf_reader_cb cb, void *cb_cookie);
 int bpf_detach_uprobe(const char *event_desc);
 
-void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, void *cb_cookie, int pid, int cpu);
+void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb, perf_reader_lost_cb lost_cb, void *cb_cookie, int pid, int cpu, int page_cnt, int wakeup_events, int wakeup_watermark);
 ]]
 
 ffi.cdef[[
@@ -90,11 +92,14 @@ int bpf_table_leaf_sscanf(void *program, size_t id, const char *buf, void *leaf)
 ffi.cdef[[
 struct perf_reader;
 
-struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb, void *cb_cookie);
+struct perf_reader * perf_reader_new(perf_reader_cb cb, perf_reader_raw_cb raw_cb, perf_reader_lost_cb lost_cb, void *cb_cookie, int page_cnt);
 void perf_reader_free(void *ptr);
 int perf_reader_mmap(struct perf_reader *reader, unsigned type, unsigned long sample_type);
 int perf_reader_poll(int num_readers, struct perf_reader **readers, int timeout);
 int perf_reader_fd(struct perf_reader *reader);
+uint64_t perf_reader_lost_count(struct perf_reader *reader);
+void perf_reader_set_batch_cb(struct perf_reader *reader, perf_reader_batch_cb batch_cb);
+void perf_reader_set_flush_timeout(struct perf_reader *reader, int timeout);
 void perf_reader_set_fd(struct perf_reader *reader, int fd);
 ]]
 
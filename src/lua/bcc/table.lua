@@ -245,7 +245,8 @@ function PerfEventArray:_open_perf_buffer(cpu, callback, ctype)
       callback(cpu, ctype(data)[0])
     end)
 
-  local reader = libbcc.bpf_open_perf_buffer(_cb, nil, -1, cpu)
+  -- 0 pages selects the default ring buffer size, and wake up on every event
+  local reader = libbcc.bpf_open_perf_buffer(_cb, nil, nil, -1, cpu, 0, 1, 0)
   assert(reader, "failed to open perf buffer")
 
   local fd = libbcc.perf_reader_fd(reader)
@@ -16,28 +16,29 @@ from __future__ import print_function
 import atexit
 import ctypes as ct
 import fcntl
+import hashlib
 import json
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import struct
 import errno
 import sys
+import threading
+import time
 basestring = (unicode if sys.version_info[0] < 3 else str)
 
+from .budget import ProbeBudget
 from .libbcc import lib, _CB_TYPE, bcc_symbol
-from .table import Table
+from .table import Table, DoubleTable
 from .tracepoint import Tracepoint
 from .perf import Perf
 from .usyms import ProcessSymbols
 
-_kprobe_limit = 1000
-_num_open_probes = 0
-
 # for tests
 def _get_num_open_probes():
-    global _num_open_probes
-    return _num_open_probes
+    return ProbeBudget.process().total()
 
 TRACEFS = "/sys/kernel/debug/tracing"
 
@@ -46,6 +47,9 @@ DEBUG_BPF = 0x2
 DEBUG_PREPROCESSOR = 0x4
 LOG_BUFFER_SIZE = 65536
 
+# bump whenever the layout of cached objects or the way they are keyed changes
+OBJECT_CACHE_VERSION = 1
+
 class SymbolCache(object):
     def __init__(self, pid):
         self.cache = lib.bcc_symcache_new(pid)
@@ -73,30 +77,94 @@ class BPF(object):
 
     _probe_repl = re.compile("[^a-zA-Z0-9_]")
     _sym_caches = {}
+    # "kprobes/<name>" and "uprobes/<name>" events still being removed by a
+    # cleanup(background=True) thread, which attaching them again waits for
+    _pending_detach = {}
+    _pending_detach_lock = threading.Lock()
 
+    # identifiers, and struct tags written as "struct name", that tell
+    # generate_auto_includes() which header declares them
     _auto_includes = {
-        "linux/time.h": ["time"],
-        "linux/fs.h": ["fs", "file"],
-        "linux/blkdev.h": ["bio", "request"],
-        "linux/slab.h": ["alloc"],
-        "linux/netdevice.h": ["sk_buff", "net_device"]
+        "linux/time.h": ["struct timespec", "struct timeval"],
+        "linux/ktime.h": ["ktime_t"],
+        "linux/fs.h": ["struct file", "struct inode", "struct dentry",
+                       "struct super_block", "struct kiocb", "fmode_t"],
+        "linux/path.h": ["struct path"],
+        "linux/blkdev.h": ["struct bio", "struct request",
+                           "struct request_queue", "struct gendisk"],
+        "linux/slab.h": ["struct kmem_cache"],
+        "linux/gfp.h": ["gfp_t"],
+        "linux/skbuff.h": ["struct sk_buff"],
+        "linux/netdevice.h": ["struct net_device"],
+        "net/sock.h": ["struct sock"],
+        "linux/mm_types.h": ["struct mm_struct", "struct vm_area_struct",
+                             "struct page"],
     }
+    _auto_include_index = None
+    _token_re = re.compile(r"->|[A-Za-z_]\w*|\S")
 
     @classmethod
-    def generate_auto_includes(cls, program_words):
+    def _struct_needs_definition(cls, tokens, pos):
+        # tokens[pos] is the tag of a "struct tag" reference; only a named
+        # pointer that is never dereferenced can do with a declaration
+        if pos + 2 >= len(tokens) or tokens[pos + 1] != "*":
+            return True
+        i = pos + 1
+        while i < len(tokens) and tokens[i] == "*":
+            i += 1
+        if i == len(tokens) or not re.match(r"[A-Za-z_]\w*$", tokens[i]):
+            return True
+        var = tokens[i]
+        for j, tok in enumerate(tokens):
+            if tok != var or j == i:
+                continue
+            if j + 1 < len(tokens) and tokens[j + 1] in ("->", "["):
+                return True
+            if j > 0 and tokens[j - 1] == "*" and \
+                    (j < 2 or not re.match(r"[\w)\]]", tokens[j - 2])):
+                return True
+        return False
+
+    @classmethod
+    def generate_auto_includes(cls, program_words, forward_decls=False):
         """
         Generates #include statements automatically based on a set of
-        recognized types such as sk_buff and bio. The input is all the words
-        that appear in the BPF program, and the output is a (possibly empty)
-        string of #include statements, such as "#include <linux/fs.h>".
-        """
-        headers = ""
-        for header, keywords in cls._auto_includes.items():
-            for keyword in keywords:
-                for word in program_words:
-                    if keyword in word and header not in headers:
-                        headers += "#include <%s>\n" % header
-        return headers
+        recognized types such as struct sk_buff and struct bio. The input
+        is all the words that appear in the BPF program, and the output is a
+        (possibly empty) string of #include statements, such as
+        "#include <linux/fs.h>". Identifiers are matched exactly, so "file"
+        in "filename" does not pull in linux/fs.h.
+
+        With forward_decls=True, a struct that is only used through named
+        pointers that are never dereferenced gets a forward declaration
+        such as "struct file;" instead of its header, which can be much
+        cheaper to compile.
+        """
+        if cls._auto_include_index is None:
+            index = {}
+            for header, names in cls._auto_includes.items():
+                for name in names:
+                    index[name] = header
+            cls._auto_include_index = index
+        index = cls._auto_include_index
+        tokens = cls._token_re.findall(" ".join(program_words))
+        headers = set()
+        decls = set()
+        for i, tok in enumerate(tokens):
+            if tok == "struct" and i + 1 < len(tokens):
+                name = "struct " + tokens[i + 1]
+                if name not in index:
+                    continue
+                if forward_decls and \
+                        not cls._struct_needs_definition(tokens, i + 1):
+                    decls.add(name)
+                else:
+                    headers.add(index[name])
+            elif tok in index and tokens[i - 1:i] != ["struct"]:
+                headers.add(index[tok])
+        decls = [d for d in decls if index[d] not in headers]
+        return "".join(["#include <%s>\n" % h for h in sorted(headers)] +
+                       ["%s;\n" % d for d in sorted(decls)])
 
     # defined for compatibility reasons, to be removed
     Table = Table
@@ -107,6 +175,32 @@ class BPF(object):
             self.name = name
             self.fd = fd
 
+    class LoadResult(object):
+        """Outcome of load_funcs_batch(), keyed by function name."""
+        def __init__(self):
+            self.funcs = {}
+            self.errors = {}
+            self.logs = {}
+
+        def check(self):
+            """check()
+
+            Raise an exception describing every function that failed to
+            load, if any. Returns the result itself otherwise."""
+            if self.errors:
+                raise Exception("Failed to load BPF program %s" % ", ".join(
+                        "%s: %s" % (name, self.errors[name])
+                        for name in sorted(self.errors)))
+            return self
+
+    class AttachResult(object):
+        """Outcome of attach_kprobes(). Probes are identified by a
+        (function, "entry" | "return") tuple."""
+        def __init__(self):
+            self.attached = []
+            self.errors = {}
+            self.elapsed = 0.0
+
     @staticmethod
     def _find_file(filename):
         """ If filename is invalid, search in ./ of argv[0] """
@@ -148,28 +242,123 @@ class BPF(object):
                     return exe_file
         return None
 
+    @staticmethod
+    def _kernel_headers_id():
+        """
+        Identifies the kernel headers that clang would compile against, so
+        that cached objects are invalidated by kernel or header upgrades.
+        """
+        uname = os.uname()
+        ident = [uname[2], uname[3]]
+        for suffix in ["build", "source"]:
+            path = "/lib/modules/%s/%s" % (uname[2], suffix)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ident.append("%s:%d" % (os.path.realpath(path), st.st_mtime))
+        return "\n".join(ident)
+
+    # headers precompiled by BPF(..., pch=True)
+    _pch_headers = ["uapi/linux/ptrace.h", "linux/sched.h", "linux/fs.h",
+                    "linux/blkdev.h"]
+
+    @staticmethod
+    def _pch_path(cache_dir, headers, cflags):
+        h = hashlib.sha256()
+        for part in [str(OBJECT_CACHE_VERSION)] + headers + \
+                ["\0".join(cflags), BPF._kernel_headers_id()]:
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return os.path.join(cache_dir, "%s.pch" % h.hexdigest())
+
+    @staticmethod
+    def build_pch(headers, path, debug=0, cflags=[]):
+        """build_pch(headers, path, debug=0, cflags=[])
+
+        Precompile the given kernel headers, such as "linux/sched.h", for
+        the running kernel into path, to be passed as BPF(..., pch=path).
+        Programs compiled with it do not reparse these headers. clang only
+        accepts the header for programs compiled with the same cflags.
+        """
+        text = "".join(["#include <%s>\n" % h for h in headers])
+        cflags_array = (ct.c_char_p * len(cflags))()
+        for i, s in enumerate(cflags): cflags_array[i] = s.encode("ascii")
+        if lib.bpf_module_build_pch(text.encode("ascii"), path.encode("ascii"),
+                debug, cflags_array, len(cflags_array)) != 0:
+            raise Exception("Failed to build precompiled header %s" % path)
+
+    @staticmethod
+    def _pch_usable(pch_path, cflags):
+        # compile an empty program against the header, which only fails if
+        # clang rejects the header itself, e.g. because the kernel headers
+        # changed since it was built
+        cflags = cflags + ["-include-pch", pch_path]
+        cflags_array = (ct.c_char_p * len(cflags))()
+        for i, s in enumerate(cflags): cflags_array[i] = s.encode("ascii")
+        module = lib.bpf_module_create_c_from_string(b"\n", 0, cflags_array,
+                len(cflags_array))
+        if not module:
+            return False
+        lib.bpf_module_destroy(module)
+        return True
+
+    @staticmethod
+    def _object_cache_path(cache_dir, text, cflags, debug):
+        h = hashlib.sha256()
+        for part in [str(OBJECT_CACHE_VERSION), text, "\0".join(cflags),
+                     str(debug), BPF._kernel_headers_id()]:
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return os.path.join(cache_dir, "%s.bpfo" % h.hexdigest())
+
     def __init__(self, src_file="", hdr_file="", text=None, cb=None, debug=0,
-            cflags=[], usdt_contexts=[]):
+            cflags=[], usdt_contexts=[], cache_dir=None, obj_file="",
+            probe_limit=None, pch=None):
         """Create a a new BPF module with the given source code.
 
         Note:
-            All fields are marked as optional, but either `src_file` or `text`
-            must be supplied, and not both.
+            All fields are marked as optional, but exactly one of `src_file`,
+            `text` or `obj_file` must be supplied.
 
         Args:
             src_file (Optional[str]): Path to a source file for the module
             hdr_file (Optional[str]): Path to a helper header file for the `src_file`
             text (Optional[str]): Contents of a source file for the module
+            obj_file (Optional[str]): Path to a module previously written by
+                save_object(); loading it does not invoke clang
             debug (Optional[int]): Flags used for debug prints, can be |'d together
                 DEBUG_LLVM_IR: print LLVM IR to stderr
                 DEBUG_BPF: print BPF bytecode to stderr
                 DEBUG_PREPROCESSOR: print Preprocessed C file to stderr
+            cache_dir (Optional[str]): Directory for caching compiled `text`
+                modules across runs, keyed by the program text, cflags, debug
+                flags and kernel headers. Defaults to $BCC_CACHE_DIR; caching
+                is disabled if neither is set. Modules loaded from the cache
+                behave as with from_object().
+            probe_limit (Optional[int]): Maximum number of probes this
+                object may have open at once, in addition to the limit
+                shared by the whole process (see ProbeBudget.process())
+            pch (Optional[bool|list|str]): Compile against precompiled
+                kernel headers. A list of headers is precompiled once per
+                kernel and set of cflags into the cache directory, which
+                must then be set, and True stands for a common set of
+                headers. A string is the path of a header built with
+                build_pch() and the same cflags. The headers
+                are visible to the program whether it includes them or not.
         """
 
         self.open_kprobes = {}
         self.open_uprobes = {}
         self.open_tracepoints = {}
+        self.probe_budget = ProbeBudget(limit=probe_limit,
+                parent=ProbeBudget.process())
         self.tracefile = None
+        self._flush_timeouts = {}
+        self._flush_timeout = None
+        self._poller = None
+        self._polling = False
+        self._polled_frees = []
         atexit.register(self.cleanup)
 
         self._reader_cb_impl = _CB_TYPE(BPF._reader_cb)
@@ -177,6 +366,27 @@ class BPF(object):
         self.debug = debug
         self.funcs = {}
         self.tables = {}
+        self.module = None
+        # modules loaded from objects have no key/leaf sprintf and sscanf
+        self.from_object = False
+        if cache_dir is None:
+            cache_dir = os.environ.get("BCC_CACHE_DIR")
+        pch_cached = None
+        if pch:
+            if isinstance(pch, basestring):
+                pch_path = pch
+            else:
+                if not cache_dir:
+                    raise Exception("pch requires cache_dir or $BCC_CACHE_DIR")
+                headers = BPF._pch_headers if pch is True else list(pch)
+                pch_path = BPF._pch_path(cache_dir, headers, cflags)
+                if os.path.isfile(pch_path):
+                    pch_cached = (pch_path, cflags)
+                else:
+                    if not os.path.isdir(cache_dir):
+                        os.makedirs(cache_dir, 0o700)
+                    BPF.build_pch(headers, pch_path, self.debug, cflags)
+            cflags = cflags + ["-include-pch", pch_path]
         cflags_array = (ct.c_char_p * len(cflags))()
         for i, s in enumerate(cflags): cflags_array[i] = s.encode("ascii")
         if text:
@@ -190,8 +400,27 @@ class BPF(object):
                 text = usdt_context.get_text() + text
 
         if text:
-            self.module = lib.bpf_module_create_c_from_string(text.encode("ascii"),
-                    self.debug, cflags_array, len(cflags_array))
+            cache_path = None
+            if cache_dir:
+                cache_path = BPF._object_cache_path(cache_dir, text, cflags,
+                        self.debug)
+                if os.path.isfile(cache_path):
+                    self.module = lib.bpf_module_create_from_object(
+                            cache_path.encode("ascii"), self.debug)
+                    self.from_object = bool(self.module)
+            if not self.module:
+                self.module = lib.bpf_module_create_c_from_string(
+                        text.encode("ascii"), self.debug, cflags_array,
+                        len(cflags_array))
+                if self.module and cache_path:
+                    self._save_object_cache(cache_dir, cache_path)
+        elif obj_file:
+            obj_file = BPF._find_file(obj_file)
+            self.module = lib.bpf_module_create_from_object(
+                    obj_file.encode("ascii"), self.debug)
+            if not self.module:
+                raise Exception("Failed to load BPF object %s" % obj_file)
+            self.from_object = True
         else:
             src_file = BPF._find_file(src_file)
             hdr_file = BPF._find_file(hdr_file)
@@ -203,6 +432,13 @@ class BPF(object):
                         self.debug, cflags_array, len(cflags_array))
 
         if not self.module:
+            # a cached precompiled header that clang rejects is rebuilt by
+            # the next run; errors in the program itself leave it alone
+            if pch_cached and not BPF._pch_usable(*pch_cached):
+                try:
+                    os.unlink(pch_cached[0])
+                except OSError:
+                    pass
             raise Exception("Failed to compile BPF module %s" % src_file)
 
         for usdt_context in usdt_contexts:
@@ -212,48 +448,145 @@ class BPF(object):
         # they will be loaded and attached here.
         self._trace_autoload()
 
+    @classmethod
+    def from_object(cls, path, **kwargs):
+        """from_object(path, **kwargs)
+
+        Create a BPF module from an object previously written with
+        save_object(), skipping compilation entirely. The maps are created
+        anew, and tables, functions and attach_* behave as they do for a
+        freshly compiled module, except that key_sprintf(), leaf_sprintf(),
+        key_scanf() and leaf_scanf() are not available on its tables, as
+        they need code generated by the compiler. Additional arguments such
+        as cb, debug and usdt_contexts are passed to the constructor.
+
+        Example: BPF.from_object("/usr/share/bcc/objects/biolatency.bpfo")
+        """
+        return cls(obj_file=path, **kwargs)
+
+    def save_object(self, path):
+        """save_object(path)
+
+        Write the compiled functions and table definitions of this module to
+        path, to be loaded later with BPF.from_object(). Objects are tied to
+        the kernel they were compiled for, just like the BPF programs
+        themselves. Modules written in B cannot be saved.
+        """
+        if lib.bpf_module_save_object(self.module, path.encode("ascii")) < 0:
+            raise Exception("Failed to save BPF object %s" % path)
+
+    def _save_object_cache(self, cache_dir, cache_path):
+        # the cache is best effort, failing to populate it is not an error
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+        except OSError:
+            return
+        lib.bpf_module_save_object(self.module, cache_path.encode("ascii"))
+
     def load_funcs(self, prog_type=KPROBE):
         """load_funcs(prog_type=KPROBE)
 
         Load all functions in this BPF module with the given type.
         Returns a list of the function handles."""
 
-        fns = []
-        for i in range(0, lib.bpf_num_functions(self.module)):
-            func_name = lib.bpf_function_name(self.module, i).decode()
-            fns.append(self.load_func(func_name, prog_type))
+        names = [lib.bpf_function_name(self.module, i).decode()
+                 for i in range(0, lib.bpf_num_functions(self.module))]
+        result = self.load_funcs_batch([(name, prog_type) for name in names])
+        result.check()
+        return [result.funcs[name] for name in names]
 
-        return fns
+    def load_funcs_batch(self, funcs, max_workers=None, logs=False):
+        """load_funcs_batch(funcs, max_workers=None, logs=False)
 
-    def load_func(self, func_name, prog_type):
-        if func_name in self.funcs:
-            return self.funcs[func_name]
-        if not lib.bpf_function_start(self.module, func_name.encode("ascii")):
-            raise Exception("Unknown program %s" % func_name)
+        Load many functions at once. funcs is a list of (func_name, prog_type)
+        tuples. The kernel verifier runs in the context of the loading
+        thread, so the programs are submitted concurrently from up to
+        max_workers threads (defaults to the number of CPUs).
+
+        Failures do not raise; instead, a BPF.LoadResult is returned with the
+        loaded function handles in .funcs, error strings in .errors and, when
+        logs is True or debug is set, the verifier output in .logs. Call
+        .check() on the result to raise on any failure.
+        """
+        result = BPF.LoadResult()
+        pending = []
+        for func_name, prog_type in funcs:
+            if func_name in self.funcs:
+                result.funcs[func_name] = self.funcs[func_name]
+            elif not lib.bpf_function_start(self.module,
+                    func_name.encode("ascii")):
+                result.errors[func_name] = "Unknown program"
+            elif func_name not in [p[0] for p in pending]:
+                pending.append((func_name, prog_type))
+
+        def load(args):
+            return self._prog_load(args[0], args[1], logs)
+
+        if len(pending) > 1:
+            workers = min(len(pending),
+                    max_workers or multiprocessing.cpu_count())
+            pool = ThreadPool(workers)
+            try:
+                loaded = pool.map(load, pending)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            loaded = [load(args) for args in pending]
+
+        for (func_name, _), (fd, err, log) in zip(pending, loaded):
+            if log:
+                result.logs[func_name] = log
+                if self.debug & DEBUG_BPF:
+                    print(log, file=sys.stderr)
+            if fd < 0:
+                result.errors[func_name] = os.strerror(err)
+                continue
+            fn = BPF.Function(self, func_name, fd)
+            self.funcs[func_name] = fn
+            result.funcs[func_name] = fn
+        return result
+
+    def _prog_load(self, func_name, prog_type, log=False):
+        """
+        Submit one function to the kernel, without touching any state of
+        this object so that it can run from worker threads. Returns a tuple
+        of (fd, errno, verifier log); the log is only captured when debug is
+        set or log is True.
+        """
+        name = func_name.encode("ascii")
         buffer_len = LOG_BUFFER_SIZE
+        with_log = bool(self.debug) or log
         while True:
-            log_buf = ct.create_string_buffer(buffer_len) if self.debug else None
+            log_buf = ct.create_string_buffer(buffer_len) if with_log else None
             fd = lib.bpf_prog_load(prog_type,
-                    lib.bpf_function_start(self.module, func_name.encode("ascii")),
-                    lib.bpf_function_size(self.module, func_name.encode("ascii")),
+                    lib.bpf_function_start(self.module, name),
+                    lib.bpf_function_size(self.module, name),
                     lib.bpf_module_license(self.module),
                     lib.bpf_module_kern_version(self.module),
                     log_buf, ct.sizeof(log_buf) if log_buf else 0)
-            if fd < 0 and ct.get_errno() == errno.ENOSPC and self.debug:
+            err = ct.get_errno()
+            if fd < 0 and err == errno.ENOSPC and with_log:
                 buffer_len <<= 1
             else:
                 break
+        return fd, err, log_buf.value.decode() if log_buf else None
 
-        if self.debug & DEBUG_BPF and log_buf.value:
-            print(log_buf.value.decode(), file=sys.stderr)
+    def load_func(self, func_name, prog_type):
+        if func_name in self.funcs:
+            return self.funcs[func_name]
+        if not lib.bpf_function_start(self.module, func_name.encode("ascii")):
+            raise Exception("Unknown program %s" % func_name)
+        fd, err, log = self._prog_load(func_name, prog_type)
+
+        if self.debug & DEBUG_BPF and log:
+            print(log, file=sys.stderr)
 
         if fd < 0:
-            errstr = os.strerror(ct.get_errno())
-            if self.debug & DEBUG_BPF:
-                raise Exception("Failed to load BPF program %s: %s" %
-                                (func_name, errstr))
-            else:
-                raise Exception("Failed to load BPF program %s: %s" % (func_name, errstr))
+            errstr = os.strerror(err)
+            raise Exception("Failed to load BPF program %s: %s" %
+                            (func_name, errstr))
 
         fn = BPF.Function(self, func_name, fd)
         self.funcs[func_name] = fn
@@ -323,7 +656,27 @@ class BPF(object):
             _fields_=fields))
         return cls
 
+    # ctypes classes by JSON descriptor, shared by all BPF objects
+    _table_types = {}
+
+    @staticmethod
+    def _decode_table_desc(desc):
+        cls = BPF._table_types.get(desc)
+        if cls is None:
+            cls = BPF._decode_table_type(json.loads(desc))
+            BPF._table_types[desc] = cls
+        return cls
+
     def get_table(self, name, keytype=None, leaftype=None, reducer=None):
+        """get_table(name, keytype=None, leaftype=None, reducer=None)
+
+        Return the Table object for the map name. With the default
+        arguments, the same object is returned on every call, as with
+        b[name].
+        """
+        default = not keytype and not leaftype and not reducer
+        if default and name in self.tables:
+            return self.tables[name]
         map_id = lib.bpf_table_id(self.module, name.encode("ascii"))
         map_fd = lib.bpf_table_fd(self.module, name.encode("ascii"))
         if map_fd < 0:
@@ -332,18 +685,28 @@ class BPF(object):
             key_desc = lib.bpf_table_key_desc(self.module, name.encode("ascii"))
             if not key_desc:
                 raise Exception("Failed to load BPF Table %s key desc" % name)
-            keytype = BPF._decode_table_type(json.loads(key_desc.decode()))
+            keytype = BPF._decode_table_desc(key_desc.decode())
         if not leaftype:
             leaf_desc = lib.bpf_table_leaf_desc(self.module, name.encode("ascii"))
             if not leaf_desc:
                 raise Exception("Failed to load BPF Table %s leaf desc" % name)
-            leaftype = BPF._decode_table_type(json.loads(leaf_desc.decode()))
-        return Table(self, map_id, map_fd, keytype, leaftype, reducer=reducer)
+            leaftype = BPF._decode_table_desc(leaf_desc.decode())
+        table = Table(self, map_id, map_fd, keytype, leaftype, reducer=reducer)
+        if default:
+            self.tables[name] = table
+        return table
+
+    def get_double_table(self, name, **kwargs):
+        """get_double_table(name, **kwargs)
+
+        Return the DoubleTable declared in C with BPF_DOUBLE_TABLE(name),
+        for interval reporting with swap_and_drain(). Further arguments are
+        passed to get_table() for both tables.
+        """
+        return DoubleTable(self, name, **kwargs)
 
     def __getitem__(self, key):
-        if key not in self.tables:
-            self.tables[key] = self.get_table(key)
-        return self.tables[key]
+        return self.get_table(key)
 
     def __setitem__(self, key, leaf):
         self.tables[key] = leaf
@@ -378,51 +741,110 @@ class BPF(object):
         fn.sock = sock
 
     def _get_kprobe_functions(self, event_re):
-        with open("%s/../kprobes/blacklist" % TRACEFS) as blacklist_file:
-            blacklist = set([line.rstrip().split()[1] for line in
-                    blacklist_file])
-        fns = []
-        with open("%s/available_filter_functions" % TRACEFS) as avail_file:
-            for line in avail_file:
-                fn = line.rstrip().split()[0]
-                if re.match(event_re, fn) and fn not in blacklist:
-                    fns.append(fn)
-        self._check_probe_quota(len(fns))
-        return fns
-
-    def _check_probe_quota(self, num_new_probes):
-        global _num_open_probes
-        if _num_open_probes + num_new_probes > _kprobe_limit:
-            raise Exception("Number of open probes would exceed global quota")
+        return KernelFunctions.instance().regex(event_re)
+
+    @staticmethod
+    def get_kprobe_functions(event_re):
+        """get_kprobe_functions(event_re)
+
+        Return the kernel functions that attach_kprobe(event_re=...) would
+        attach to, without attaching anything. Use len() on the result to
+        decide whether a pattern is too wide before attaching.
+        """
+        return KernelFunctions.instance().regex(event_re)
+
+    def attach_kprobes(self, event_re, fn_name="", ret_fn_name="", pid=-1,
+            cpu=0, group_fd=-1):
+        """attach_kprobes(event_re, fn_name="", ret_fn_name="", pid=-1, cpu=0,
+                          group_fd=-1)
+
+        Attach the function fn_name to the entry and/or ret_fn_name to the
+        return of every kernel function matching the regular expression
+        event_re, in a single pass over the list of traceable functions.
+        Unlike attach_kprobe(event_re=...), failures do not go unnoticed: a
+        BPF.AttachResult is returned with the attached probes, the error of
+        each probe that could not be attached, and the elapsed time.
+
+        Example: r = b.attach_kprobes("^vfs_", "trace_entry", "trace_return")
+        """
+        result = BPF.AttachResult()
+        start = time.time()
+        kinds = []
+        if fn_name:
+            kinds.append(("entry", False, fn_name))
+        if ret_fn_name:
+            kinds.append(("return", True, ret_fn_name))
+        fns = self._get_kprobe_functions(event_re)
+        # reserve all of them up front, so that nothing is attached if they
+        # do not fit, and give back those that fail to attach
+        self.probe_budget.reserve(ProbeBudget.KPROBE, len(fns) * len(kinds))
+        try:
+            for fn in fns:
+                for kind, retprobe, name in kinds:
+                    try:
+                        self._attach_kprobe_reserved(fn, name, retprobe, pid,
+                                                     cpu, group_fd)
+                    except Exception as e:
+                        result.errors[(fn, kind)] = str(e)
+                    else:
+                        result.attached.append((fn, kind))
+        finally:
+            self.probe_budget.remove(ProbeBudget.KPROBE,
+                    len(fns) * len(kinds) - len(result.attached))
+        result.elapsed = time.time() - start
+        return result
+
+    @staticmethod
+    def _kprobe_kind(name):
+        # non-string keys in open_kprobes are perf_events readers
+        if isinstance(name, str):
+            return ProbeBudget.KPROBE
+        return ProbeBudget.PERF_READER
 
     def _add_kprobe(self, name, probe):
-        global _num_open_probes
+        # kprobes were reserved by the attach paths, perf readers have no
+        # limit and are only counted
         self.open_kprobes[name] = probe
-        _num_open_probes += 1
+        if BPF._kprobe_kind(name) == ProbeBudget.PERF_READER:
+            self.probe_budget.add(ProbeBudget.PERF_READER)
+        # the reader is tracked above either way, so that cleanup() frees it
+        if self._poller and lib.perf_reader_poller_add(self._poller, probe) < 0:
+            raise Exception("Failed to add perf reader to the poller")
 
     def _del_kprobe(self, name):
-        global _num_open_probes
+        if self._poller:
+            lib.perf_reader_poller_remove(self._poller, self.open_kprobes[name])
         del self.open_kprobes[name]
-        _num_open_probes -= 1
+        self.probe_budget.remove(BPF._kprobe_kind(name))
+        if self._flush_timeouts.pop(name, None) is not None:
+            self._update_flush_timeout()
 
     def attach_kprobe(self, event="", fn_name="", event_re="",
             pid=-1, cpu=0, group_fd=-1):
 
         # allow the caller to glob multiple functions together
         if event_re:
-            for line in self._get_kprobe_functions(event_re):
-                try:
-                    self.attach_kprobe(event=line, fn_name=fn_name, pid=pid,
-                            cpu=cpu, group_fd=group_fd)
-                except:
-                    pass
+            self.attach_kprobes(event_re, fn_name=fn_name, pid=pid, cpu=cpu,
+                    group_fd=group_fd)
             return
 
-        event = str(event)
-        self._check_probe_quota(1)
+        self.probe_budget.reserve(ProbeBudget.KPROBE)
+        try:
+            self._attach_kprobe_reserved(str(event), fn_name, False, pid, cpu,
+                                         group_fd)
+        except:
+            self.probe_budget.remove(ProbeBudget.KPROBE)
+            raise
+        return self
+
+    def _attach_kprobe_reserved(self, event, fn_name, retprobe, pid, cpu,
+                                group_fd):
+        # the caller has reserved the probe in the budget
         fn = self.load_func(fn_name, BPF.KPROBE)
-        ev_name = "p_" + event.replace("+", "_").replace(".", "_")
-        desc = "p:kprobes/%s %s" % (ev_name, event)
+        kind = "r" if retprobe else "p"
+        ev_name = kind + "_" + event.replace("+", "_").replace(".", "_")
+        BPF._wait_pending_detach("kprobes/%s" % ev_name)
+        desc = "%s:kprobes/%s %s" % (kind, ev_name, event)
         res = lib.bpf_attach_kprobe(fn.fd, ev_name.encode("ascii"),
                 desc.encode("ascii"), pid, cpu, group_fd,
                 self._reader_cb_impl, ct.cast(id(self), ct.py_object))
@@ -430,45 +852,36 @@ class BPF(object):
         if not res:
             raise Exception("Failed to attach BPF to kprobe")
         self._add_kprobe(ev_name, res)
-        return self
 
     def detach_kprobe(self, event):
         event = str(event)
         ev_name = "p_" + event.replace("+", "_").replace(".", "_")
         if ev_name not in self.open_kprobes:
             raise Exception("Kprobe %s is not attached" % event)
-        lib.perf_reader_free(self.open_kprobes[ev_name])
+        reader = self.open_kprobes[ev_name]
+        self._del_kprobe(ev_name)
+        self._free_reader(reader)
         desc = "-:kprobes/%s" % ev_name
         res = lib.bpf_detach_kprobe(desc.encode("ascii"))
         if res < 0:
             raise Exception("Failed to detach BPF from kprobe")
-        self._del_kprobe(ev_name)
 
     def attach_kretprobe(self, event="", fn_name="", event_re="",
             pid=-1, cpu=0, group_fd=-1):
 
         # allow the caller to glob multiple functions together
         if event_re:
-            for line in self._get_kprobe_functions(event_re):
-                try:
-                    self.attach_kretprobe(event=line, fn_name=fn_name, pid=pid,
-                            cpu=cpu, group_fd=group_fd)
-                except:
-                    pass
+            self.attach_kprobes(event_re, ret_fn_name=fn_name, pid=pid,
+                    cpu=cpu, group_fd=group_fd)
             return
 
-        event = str(event)
-        self._check_probe_quota(1)
-        fn = self.load_func(fn_name, BPF.KPROBE)
-        ev_name = "r_" + event.replace("+", "_").replace(".", "_")
-        desc = "r:kprobes/%s %s" % (ev_name, event)
-        res = lib.bpf_attach_kprobe(fn.fd, ev_name.encode("ascii"),
-                desc.encode("ascii"), pid, cpu, group_fd,
-                self._reader_cb_impl, ct.cast(id(self), ct.py_object))
-        res = ct.cast(res, ct.c_void_p)
-        if not res:
-            raise Exception("Failed to attach BPF to kprobe")
-        self._add_kprobe(ev_name, res)
+        self.probe_budget.reserve(ProbeBudget.KPROBE)
+        try:
+            self._attach_kprobe_reserved(str(event), fn_name, True, pid, cpu,
+                                         group_fd)
+        except:
+            self.probe_budget.remove(ProbeBudget.KPROBE)
+            raise
         return self
 
     def detach_kretprobe(self, event):
@@ -476,12 +889,13 @@ class BPF(object):
         ev_name = "r_" + event.replace("+", "_").replace(".", "_")
         if ev_name not in self.open_kprobes:
             raise Exception("Kretprobe %s is not attached" % event)
-        lib.perf_reader_free(self.open_kprobes[ev_name])
+        reader = self.open_kprobes[ev_name]
+        self._del_kprobe(ev_name)
+        self._free_reader(reader)
         desc = "-:kprobes/%s" % ev_name
         res = lib.bpf_detach_kprobe(desc.encode("ascii"))
         if res < 0:
             raise Exception("Failed to detach BPF from kprobe")
-        self._del_kprobe(ev_name)
 
     @staticmethod
     def attach_xdp(dev, fn):
@@ -547,15 +961,21 @@ class BPF(object):
         Example: BPF(text).attach_tracepoint("sched:sched_switch", "on_switch")
         """
 
-        fn = self.load_func(fn_name, BPF.TRACEPOINT)
-        (tp_category, tp_name) = tp.split(':')
-        res = lib.bpf_attach_tracepoint(fn.fd, tp_category.encode("ascii"),
-                tp_name.encode("ascii"), pid, cpu, group_fd,
-                self._reader_cb_impl, ct.cast(id(self), ct.py_object))
-        res = ct.cast(res, ct.c_void_p)
-        if not res:
-            raise Exception("Failed to attach BPF to tracepoint")
-        self.open_tracepoints[tp] = res
+        self.probe_budget.reserve(ProbeBudget.TRACEPOINT)
+        try:
+            fn = self.load_func(fn_name, BPF.TRACEPOINT)
+            (tp_category, tp_name) = tp.split(':')
+            res = lib.bpf_attach_tracepoint(fn.fd,
+                    tp_category.encode("ascii"), tp_name.encode("ascii"),
+                    pid, cpu, group_fd, self._reader_cb_impl,
+                    ct.cast(id(self), ct.py_object))
+            res = ct.cast(res, ct.c_void_p)
+            if not res:
+                raise Exception("Failed to attach BPF to tracepoint")
+        except:
+            self.probe_budget.remove(ProbeBudget.TRACEPOINT)
+            raise
+        self._add_tracepoint(tp, res)
         return self
 
     def detach_tracepoint(self, tp=""):
@@ -569,23 +989,30 @@ class BPF(object):
 
         if tp not in self.open_tracepoints:
             raise Exception("Tracepoint %s is not attached" % tp)
-        lib.perf_reader_free(self.open_tracepoints[tp])
+        reader = self.open_tracepoints[tp]
+        self._del_tracepoint(tp)
+        lib.perf_reader_free(reader)
         (tp_category, tp_name) = tp.split(':')
         res = lib.bpf_detach_tracepoint(tp_category.encode("ascii"),
                                         tp_name.encode("ascii"))
         if res < 0:
             raise Exception("Failed to detach BPF from tracepoint")
-        del self.open_tracepoints[tp]
+
+    def _add_tracepoint(self, name, probe):
+        # reserved in the budget by attach_tracepoint()
+        self.open_tracepoints[name] = probe
+
+    def _del_tracepoint(self, name):
+        del self.open_tracepoints[name]
+        self.probe_budget.remove(ProbeBudget.TRACEPOINT)
 
     def _add_uprobe(self, name, probe):
-        global _num_open_probes
+        # reserved in the budget by _attach_uprobe_at()
         self.open_uprobes[name] = probe
-        _num_open_probes += 1
 
     def _del_uprobe(self, name):
-        global _num_open_probes
         del self.open_uprobes[name]
-        _num_open_probes -= 1
+        self.probe_budget.remove(ProbeBudget.UPROBE)
 
     def attach_uprobe(self, name="", sym="", addr=None,
             fn_name="", pid=-1, cpu=0, group_fd=-1):
@@ -607,17 +1034,29 @@ class BPF(object):
 
         name = str(name)
         (path, addr) = BPF._check_path_symbol(name, sym, addr)
+        return self._attach_uprobe_at(path, addr, fn_name, pid, cpu, group_fd,
+                                      False)
 
-        self._check_probe_quota(1)
-        fn = self.load_func(fn_name, BPF.KPROBE)
-        ev_name = "p_%s_0x%x" % (self._probe_repl.sub("_", path), addr)
-        desc = "p:uprobes/%s %s:0x%x" % (ev_name, path, addr)
-        res = lib.bpf_attach_uprobe(fn.fd, ev_name.encode("ascii"),
-                desc.encode("ascii"), pid, cpu, group_fd,
-                self._reader_cb_impl, ct.cast(id(self), ct.py_object))
-        res = ct.cast(res, ct.c_void_p)
-        if not res:
-            raise Exception("Failed to attach BPF to uprobe")
+    def _attach_uprobe_at(self, path, offset, fn_name, pid, cpu, group_fd,
+                          retprobe):
+        # path and offset are as returned by _check_path_symbol()
+        self.probe_budget.reserve(ProbeBudget.UPROBE)
+        try:
+            fn = self.load_func(fn_name, BPF.KPROBE)
+            kind = "r" if retprobe else "p"
+            ev_name = "%s_%s_0x%x" % (kind, self._probe_repl.sub("_", path),
+                                      offset)
+            BPF._wait_pending_detach("uprobes/%s" % ev_name)
+            desc = "%s:uprobes/%s %s:0x%x" % (kind, ev_name, path, offset)
+            res = lib.bpf_attach_uprobe(fn.fd, ev_name.encode("ascii"),
+                    desc.encode("ascii"), pid, cpu, group_fd,
+                    self._reader_cb_impl, ct.cast(id(self), ct.py_object))
+            res = ct.cast(res, ct.c_void_p)
+            if not res:
+                raise Exception("Failed to attach BPF to uprobe")
+        except:
+            self.probe_budget.remove(ProbeBudget.UPROBE)
+            raise
         self._add_uprobe(ev_name, res)
         return self
 
@@ -633,12 +1072,13 @@ class BPF(object):
         ev_name = "p_%s_0x%x" % (self._probe_repl.sub("_", path), addr)
         if ev_name not in self.open_uprobes:
             raise Exception("Uprobe %s is not attached" % event)
-        lib.perf_reader_free(self.open_uprobes[ev_name])
+        reader = self.open_uprobes[ev_name]
+        self._del_uprobe(ev_name)
+        lib.perf_reader_free(reader)
         desc = "-:uprobes/%s" % ev_name
         res = lib.bpf_detach_uprobe(desc.encode("ascii"))
         if res < 0:
             raise Exception("Failed to detach BPF from uprobe")
-        self._del_uprobe(ev_name)
 
     def attach_uretprobe(self, name="", sym="", addr=None,
             fn_name="", pid=-1, cpu=0, group_fd=-1):
@@ -652,19 +1092,8 @@ class BPF(object):
 
         name = str(name)
         (path, addr) = BPF._check_path_symbol(name, sym, addr)
-
-        self._check_probe_quota(1)
-        fn = self.load_func(fn_name, BPF.KPROBE)
-        ev_name = "r_%s_0x%x" % (self._probe_repl.sub("_", path), addr)
-        desc = "r:uprobes/%s %s:0x%x" % (ev_name, path, addr)
-        res = lib.bpf_attach_uprobe(fn.fd, ev_name.encode("ascii"),
-                desc.encode("ascii"), pid, cpu, group_fd,
-                self._reader_cb_impl, ct.cast(id(self), ct.py_object))
-        res = ct.cast(res, ct.c_void_p)
-        if not res:
-            raise Exception("Failed to attach BPF to uprobe")
-        self._add_uprobe(ev_name, res)
-        return self
+        return self._attach_uprobe_at(path, addr, fn_name, pid, cpu, group_fd,
+                                      True)
 
     def detach_uretprobe(self, name="", sym="", addr=None):
         """detach_uretprobe(name="", sym="", addr=None)
@@ -678,26 +1107,34 @@ class BPF(object):
         ev_name = "r_%s_0x%x" % (self._probe_repl.sub("_", path), addr)
         if ev_name not in self.open_uprobes:
             raise Exception("Kretprobe %s is not attached" % event)
-        lib.perf_reader_free(self.open_uprobes[ev_name])
+        reader = self.open_uprobes[ev_name]
+        self._del_uprobe(ev_name)
+        lib.perf_reader_free(reader)
         desc = "-:uprobes/%s" % ev_name
         res = lib.bpf_detach_uprobe(desc.encode("ascii"))
         if res < 0:
             raise Exception("Failed to detach BPF from uprobe")
-        self._del_uprobe(ev_name)
 
     def _trace_autoload(self):
+        autoload = []
         for i in range(0, lib.bpf_num_functions(self.module)):
             func_name = str(lib.bpf_function_name(self.module, i).decode())
+            if func_name.startswith("kprobe__") or \
+                    func_name.startswith("kretprobe__"):
+                autoload.append((func_name, BPF.KPROBE))
+            elif func_name.startswith("tracepoint__"):
+                autoload.append((func_name, BPF.TRACEPOINT))
+
+        # verify all the programs up front, then attach them in order
+        self.load_funcs_batch(autoload).check()
+        for func_name, _ in autoload:
             if func_name.startswith("kprobe__"):
-                fn = self.load_func(func_name, BPF.KPROBE)
-                self.attach_kprobe(event=fn.name[8:], fn_name=fn.name)
+                self.attach_kprobe(event=func_name[8:], fn_name=func_name)
             elif func_name.startswith("kretprobe__"):
-                fn = self.load_func(func_name, BPF.KPROBE)
-                self.attach_kretprobe(event=fn.name[11:], fn_name=fn.name)
-            elif func_name.startswith("tracepoint__"):
-                fn = self.load_func(func_name, BPF.TRACEPOINT)
-                tp = fn.name[len("tracepoint__"):].replace("__", ":")
-                self.attach_tracepoint(tp=tp, fn_name=fn.name)
+                self.attach_kretprobe(event=func_name[11:], fn_name=func_name)
+            else:
+                tp = func_name[len("tracepoint__"):].replace("__", ":")
+                self.attach_tracepoint(tp=tp, fn_name=func_name)
 
     def trace_open(self, nonblocking=False):
         """trace_open(nonblocking=False)
@@ -836,40 +1273,143 @@ class BPF(object):
         """
         return len([k for k in self.open_kprobes.keys() if isinstance(k, str)])
 
+    def _free_reader(self, reader, refs=None):
+        # a callback may close a reader that kprobe_poll() is still reading,
+        # so keep it, and the callbacks in refs, until the poll returns
+        if self._polling:
+            self._polled_frees.append((reader, refs))
+        else:
+            lib.perf_reader_free(reader)
+
+    def _add_flush_timeout(self, name, timeout):
+        # name is the key of a perf reader in open_kprobes, which takes the
+        # timeout away again in _del_kprobe
+        self._flush_timeouts[name] = timeout
+        self._update_flush_timeout()
+
+    def _update_flush_timeout(self):
+        self._flush_timeout = min(self._flush_timeouts.values()) \
+            if self._flush_timeouts else None
+
     def kprobe_poll(self, timeout = -1):
         """kprobe_poll(self)
 
         Poll from the ring buffers for all of the open kprobes, calling the
         cb() that was given in the BPF constructor for each entry.
         """
+        # perf buffers with deferred wakeups are read once they have not been
+        # read for their flush timeout, so wake up at least that often
+        if self._flush_timeout is not None and \
+                (timeout < 0 or timeout > self._flush_timeout):
+            timeout = self._flush_timeout
         try:
-            readers = (ct.c_void_p * len(self.open_kprobes))()
-            for i, v in enumerate(self.open_kprobes.values()):
-                readers[i] = v
-            lib.perf_reader_poll(len(self.open_kprobes), readers, timeout)
+            if not self._poller:
+                # the poller is kept up to date by _add_kprobe/_del_kprobe
+                self._poller = lib.perf_reader_poller_new()
+                if not self._poller:
+                    raise Exception("Could not create perf reader poller")
+                for v in self.open_kprobes.values():
+                    if lib.perf_reader_poller_add(self._poller, v) < 0:
+                        lib.perf_reader_poller_free(self._poller)
+                        self._poller = None
+                        raise Exception("Failed to add perf reader to the "
+                                        "poller")
+            poller = self._poller
+            self._polling = True
+            try:
+                lib.perf_reader_poller_poll(poller, timeout)
+            finally:
+                self._polling = False
+                for reader, _ in self._polled_frees:
+                    lib.perf_reader_free(reader)
+                self._polled_frees = []
+                # a callback ran cleanup(), which left the poller to us
+                if self._poller is not poller:
+                    lib.perf_reader_poller_free(poller)
         except KeyboardInterrupt:
             exit()
 
-    def cleanup(self):
+    @staticmethod
+    def _detach_probes(kprobe_descs, uprobe_descs):
+        failed = 0
+        for descs, detach in [(kprobe_descs, lib.bpf_detach_kprobes),
+                              (uprobe_descs, lib.bpf_detach_uprobes)]:
+            if descs:
+                arr = (ct.c_char_p * len(descs))(
+                        *[desc.encode("ascii") for desc in descs])
+                res = detach(arr, len(descs))
+                failed += len(descs) if res < 0 else res
+        if failed:
+            raise Exception("Failed to remove %d of %d probe events" %
+                            (failed, len(kprobe_descs) + len(uprobe_descs)))
+
+    @staticmethod
+    def _detach_probes_pending(kprobe_descs, uprobe_descs):
+        try:
+            BPF._detach_probes(kprobe_descs, uprobe_descs)
+        finally:
+            t = threading.current_thread()
+            with BPF._pending_detach_lock:
+                for desc in kprobe_descs + uprobe_descs:
+                    if BPF._pending_detach.get(desc[2:]) is t:
+                        del BPF._pending_detach[desc[2:]]
+
+    @staticmethod
+    def _wait_pending_detach(event):
+        # event is "kprobes/<name>" or "uprobes/<name>"
+        with BPF._pending_detach_lock:
+            t = BPF._pending_detach.get(event)
+        if t:
+            t.join()
+
+    def cleanup(self, background=False):
+        """cleanup(background=False)
+
+        Detach all probes and close all perf buffers. The perf events are
+        closed right away, which stops the BPF programs from running; the
+        kprobe and uprobe definitions are then removed from tracefs in
+        batches. With background=True, that removal runs in a separate
+        thread, which is returned, so the caller is not blocked by it. The
+        interpreter waits for the thread to finish before exiting, and
+        attaching one of those probes again, from any BPF object, waits for
+        it too.
+        """
+        kprobe_descs = []
+        uprobe_descs = []
         for k, v in list(self.open_kprobes.items()):
-            lib.perf_reader_free(v)
-            # non-string keys here include the perf_events reader
-            if isinstance(k, str):
-                desc = "-:kprobes/%s" % k
-                lib.bpf_detach_kprobe(desc.encode("ascii"))
             self._del_kprobe(k)
+            self._free_reader(v)
+            if BPF._kprobe_kind(k) == ProbeBudget.KPROBE:
+                kprobe_descs.append("-:kprobes/%s" % k)
         for k, v in list(self.open_uprobes.items()):
-            lib.perf_reader_free(v)
-            desc = "-:uprobes/%s" % k
-            lib.bpf_detach_uprobe(desc.encode("ascii"))
             self._del_uprobe(k)
-        for k, v in self.open_tracepoints.items():
+            lib.perf_reader_free(v)
+            uprobe_descs.append("-:uprobes/%s" % k)
+        for k, v in list(self.open_tracepoints.items()):
+            self._del_tracepoint(k)
             lib.perf_reader_free(v)
             (tp_category, tp_name) = k.split(':')
-            lib.bpf_detach_tracepoint(tp_category, tp_name)
-        self.open_tracepoints.clear()
+            lib.bpf_detach_tracepoint(tp_category.encode("ascii"),
+                                      tp_name.encode("ascii"))
         if self.tracefile:
             self.tracefile.close()
-
-
+        if self._poller:
+            # in a callback, kprobe_poll() frees it once the poll returns
+            if not self._polling:
+                lib.perf_reader_poller_free(self._poller)
+            self._poller = None
+
+        if background and (kprobe_descs or uprobe_descs):
+            t = threading.Thread(target=BPF._detach_probes_pending,
+                                 args=(kprobe_descs, uprobe_descs))
+            with BPF._pending_detach_lock:
+                for desc in kprobe_descs + uprobe_descs:
+                    BPF._pending_detach[desc[2:]] = t
+            t.start()
+            return t
+        BPF._detach_probes(kprobe_descs, uprobe_descs)
+
+
+from .kfunctions import KernelFunctions
 from .usdt import USDT
+from .builder import BPFBuilder
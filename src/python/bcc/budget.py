@@ -0,0 +1,147 @@
+# Copyright (c) 2016 The bcc Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+class ProbeBudget(object):
+    """
+    Accounting of open probes by type, with an optional limit on their
+    total. Every BPF object has its own budget, whose parent is the budget
+    shared by the whole process, so a probe counts against both. The
+    process limit defaults to $BCC_PROBE_LIMIT, or 1000 if that is unset.
+    """
+    KPROBE = "kprobe"
+    UPROBE = "uprobe"
+    TRACEPOINT = "tracepoint"
+    PERF_READER = "perf_reader"
+    KINDS = [KPROBE, UPROBE, TRACEPOINT, PERF_READER]
+
+    # Rough cost of a single probe hit in nanoseconds, before the cost of
+    # the BPF program itself: kprobes are int3 or jump based, uprobes add a
+    # trap from user space, tracepoints are a static call and perf readers
+    # cost nothing until an event is submitted.
+    OVERHEAD_NS = {
+        KPROBE: 150,
+        UPROBE: 1500,
+        TRACEPOINT: 50,
+        PERF_READER: 0,
+    }
+
+    DEFAULT_PROCESS_LIMIT = 1000
+
+    _process = None
+    _process_lock = threading.Lock()
+
+    def __init__(self, limit=None, parent=None, name="session"):
+        self.limit = limit
+        self.parent = parent
+        self.name = name
+        self._lock = threading.Lock()
+        self._counts = dict((kind, 0) for kind in ProbeBudget.KINDS)
+
+    @classmethod
+    def process(cls):
+        """process()
+
+        Return the budget shared by all BPF objects in this process. Its
+        limit can be changed at any time by assigning to .limit.
+        """
+        with cls._process_lock:
+            if cls._process is None:
+                limit = int(os.environ.get("BCC_PROBE_LIMIT",
+                        cls.DEFAULT_PROCESS_LIMIT))
+                cls._process = cls(limit=limit, name="process")
+            return cls._process
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def counts(self):
+        """counts()
+
+        Return a dict with the number of open probes of each kind.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def overhead_ns(self):
+        """overhead_ns()
+
+        Return the estimated cost in nanoseconds of all the open probes
+        firing once each, for comparing the weight of tracing sessions.
+        """
+        return sum(ProbeBudget.OVERHEAD_NS[kind] * n
+                   for kind, n in self.counts().items())
+
+    def available(self):
+        """available()
+
+        Return the number of probes that can still be opened, or None if
+        neither this budget nor its parents are limited.
+        """
+        budget = self
+        avail = None
+        while budget:
+            if budget.limit is not None:
+                left = max(budget.limit - budget.total(), 0)
+                avail = left if avail is None else min(avail, left)
+            budget = budget.parent
+        return avail
+
+    def _chain(self):
+        budget = self
+        while budget:
+            yield budget
+            budget = budget.parent
+
+    def reserve(self, kind, num=1):
+        """reserve(kind, num=1)
+
+        Count num more probes of the given kind against this budget and its
+        parents, or raise without counting anything if that would exceed the
+        limit of any of them. The check and the update happen atomically, so
+        concurrent reservations cannot together go over a limit. Release
+        the probes with remove() when they are closed or fail to open.
+        """
+        chain = list(self._chain())
+        # always locked from the child up, so reservations never deadlock
+        for budget in chain:
+            budget._lock.acquire()
+        try:
+            for budget in chain:
+                total = sum(budget._counts.values())
+                if budget.limit is not None and total + num > budget.limit:
+                    raise Exception("Number of open probes would exceed %s " \
+                            "quota (%d open, %d requested, limit %d)" %
+                            (budget.name, total, num, budget.limit))
+            for budget in chain:
+                budget._counts[kind] += num
+        finally:
+            for budget in reversed(chain):
+                budget._lock.release()
+
+    def add(self, kind, num=1):
+        """add(kind, num=1)
+
+        Count num more probes of the given kind without checking the limit,
+        for probes that are not subject to it.
+        """
+        for budget in self._chain():
+            with budget._lock:
+                budget._counts[kind] += num
+
+    def remove(self, kind, num=1):
+        self.add(kind, -num)
@@ -0,0 +1,149 @@
+# Copyright (c) 2016 The bcc Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from . import BPF, TRACEFS
+from .kfunctions import KernelFunctions
+
+class BPFBuilder(object):
+    """
+    Builds a BPF object in a worker thread while the targets of its probes
+    are resolved in parallel: libraries and symbols for uprobes, tracepoint
+    formats, and the catalogue of kernel functions for event_re kprobes.
+    Once everything is ready, result() loads the probe functions and
+    attaches them. The constructor takes the same keyword arguments as
+    BPF(), so compilation starts right away; USDT contexts still have to
+    be enabled before the builder is created.
+
+    Example:
+        builder = BPFBuilder(text=prog)
+        builder.add_kprobe(event="vfs_read", fn_name="on_read")
+        builder.add_uprobe(name="c", sym="malloc", fn_name="on_malloc")
+        builder.add_tracepoint(tp="sched:sched_switch", fn_name="on_switch")
+        b = builder.result()
+    """
+    def __init__(self, max_workers=None, **kwargs):
+        workers = max(2, max_workers or multiprocessing.cpu_count())
+        self._pool = ThreadPool(workers)
+        # ctypes releases the GIL while clang runs
+        self._bpf = self._pool.apply_async(BPF, kwds=kwargs)
+        self._probes = []
+        self._kfuncs = None
+        self._result = None
+
+    def ready(self):
+        """ready()
+
+        Return whether the compilation has finished.
+        """
+        return self._bpf.ready()
+
+    def add_kprobe(self, event="", fn_name="", event_re="", retprobe=False,
+            pid=-1, cpu=0, group_fd=-1):
+        """add_kprobe(event="", fn_name="", event_re="", retprobe=False,
+                      pid=-1, cpu=0, group_fd=-1)
+
+        Attach fn_name to a kernel function, or to all the functions matching
+        event_re, as attach_kprobe() (or attach_kretprobe() if retprobe is
+        True) would.
+        """
+        if event_re and self._kfuncs is None:
+            self._kfuncs = self._pool.apply_async(
+                    KernelFunctions.instance().names)
+        attach = BPF.attach_kretprobe if retprobe else BPF.attach_kprobe
+        def attach_kprobe(bpf, resolved):
+            attach(bpf, event=event, fn_name=fn_name, event_re=event_re,
+                   pid=pid, cpu=cpu, group_fd=group_fd)
+        self._probes.append((self._kfuncs if event_re else None, fn_name,
+                             BPF.KPROBE, attach_kprobe))
+        return self
+
+    @staticmethod
+    def _resolve_uprobe(name, sym, addr):
+        # like trace and argdist, accept executables as well as libraries
+        if "/" not in name:
+            name = BPF.find_library(name) or BPF._find_exe(name) or name
+        return BPF._check_path_symbol(name, sym, addr)
+
+    def add_uprobe(self, name="", sym="", addr=None, fn_name="",
+            retprobe=False, pid=-1, cpu=0, group_fd=-1):
+        """add_uprobe(name="", sym="", addr=None, fn_name="", retprobe=False,
+                      pid=-1, cpu=0, group_fd=-1)
+
+        Attach fn_name to a symbol or address in a library or executable, as
+        attach_uprobe() (or attach_uretprobe() if retprobe is True) would.
+        The name can also be an executable found in $PATH.
+        """
+        resolved = self._pool.apply_async(BPFBuilder._resolve_uprobe,
+                (str(name), sym, addr))
+        def attach_uprobe(bpf, resolved):
+            (path, offset) = resolved
+            bpf._attach_uprobe_at(path, offset, fn_name, pid, cpu, group_fd,
+                                  retprobe)
+        self._probes.append((resolved, fn_name, BPF.KPROBE, attach_uprobe))
+        return self
+
+    @staticmethod
+    def _resolve_tracepoint(tp):
+        (category, event) = tp.split(":")
+        try:
+            with open("%s/events/%s/%s/format" % (TRACEFS, category, event)) \
+                    as format_file:
+                return format_file.read()
+        except IOError:
+            raise Exception("Tracepoint %s does not exist" % tp)
+
+    def add_tracepoint(self, tp="", fn_name="", pid=-1, cpu=0, group_fd=-1):
+        """add_tracepoint(tp="", fn_name="", pid=-1, cpu=0, group_fd=-1)
+
+        Attach fn_name to a kernel tracepoint such as "sched:sched_switch",
+        as attach_tracepoint() would.
+        """
+        resolved = self._pool.apply_async(BPFBuilder._resolve_tracepoint,
+                (tp,))
+        def attach_tracepoint(bpf, resolved):
+            bpf.attach_tracepoint(tp=tp, fn_name=fn_name, pid=pid, cpu=cpu,
+                                  group_fd=group_fd)
+        self._probes.append((resolved, fn_name, BPF.TRACEPOINT,
+                             attach_tracepoint))
+        return self
+
+    def result(self, timeout=None):
+        """result(timeout=None)
+
+        Wait for the compilation and the resolution of all the probes, load
+        the probe functions concurrently and attach the probes in the order
+        they were added. Returns the BPF object. If anything fails, the
+        probes attached so far are removed and the error is raised.
+        """
+        if self._result:
+            return self._result
+        try:
+            bpf = self._bpf.get(timeout)
+            try:
+                resolved = [r.get(timeout) if r else None
+                            for (r, _, _, _) in self._probes]
+                bpf.load_funcs_batch([(fn_name, prog_type)
+                        for (_, fn_name, prog_type, _) in self._probes]).check()
+                for (_, _, _, attach), res in zip(self._probes, resolved):
+                    attach(bpf, res)
+            except:
+                bpf.cleanup()
+                raise
+        finally:
+            self._pool.close()
+        self._result = bpf
+        return bpf
@@ -0,0 +1,170 @@
+# Copyright (c) 2016 The bcc Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left
+import fnmatch
+import re
+import threading
+import time
+
+from . import TRACEFS
+
+class KernelFunctions(object):
+    """
+    Catalogue of the kernel functions that can be kprobed, that is the
+    contents of available_filter_functions minus the kprobe blacklist.
+    The catalogue is read once and shared by all users in the process;
+    it is reloaded automatically when the set of loaded modules changes,
+    which is checked at most once every check_interval seconds.
+    Lookups by prefix, glob and regular expression use a sorted index so
+    that anchored patterns only scan the matching range.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # regex characters that end the literal prefix of a pattern
+    _regex_meta = set(".^$*+?{}[]\\|()")
+
+    check_interval = 1.0
+
+    def __init__(self, tracefs=TRACEFS):
+        self.tracefs = tracefs
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._modules = None
+        self._checked = 0
+        self._names = []
+
+    @classmethod
+    def instance(cls):
+        """instance()
+
+        Return the catalogue shared by all BPF objects in this process.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @staticmethod
+    def _read_modules():
+        # only the names matter, the other fields such as the reference
+        # counts change all the time
+        try:
+            with open("/proc/modules") as modules_file:
+                return frozenset([line.split(" ", 1)[0] for line in
+                                  modules_file])
+        except IOError:
+            return None
+
+    def refresh(self, force=False):
+        """refresh(force=False)
+
+        Reload the catalogue if kernel modules were loaded or unloaded since
+        it was last read, or unconditionally if force is True. Without force,
+        /proc/modules is read at most once every check_interval seconds.
+        """
+        now = time.time()
+        if not force and self._loaded and \
+                now - self._checked < self.check_interval:
+            return
+        modules = KernelFunctions._read_modules()
+        with self._lock:
+            self._checked = now
+            if not force and self._loaded and modules == self._modules:
+                return
+            with open("%s/../kprobes/blacklist" % self.tracefs) as \
+                    blacklist_file:
+                blacklist = set([line.rstrip().split()[1] for line in
+                        blacklist_file])
+            names = set()
+            with open("%s/available_filter_functions" % self.tracefs) as \
+                    avail_file:
+                for line in avail_file:
+                    fn = line.rstrip().split()[0]
+                    if fn not in blacklist:
+                        names.add(fn)
+            self._names = sorted(names)
+            self._modules = modules
+            self._loaded = True
+
+    def names(self):
+        """names()
+
+        Return the sorted list of all attachable kernel functions.
+        """
+        self.refresh()
+        return self._names
+
+    def _range(self, prefix):
+        names = self.names()
+        if not prefix:
+            return names
+        lo = bisect_left(names, prefix)
+        # the first name past the range has a greater character at the
+        # position of the last prefix character
+        hi = bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+        return names[lo:hi]
+
+    def with_prefix(self, prefix):
+        """with_prefix(prefix)
+
+        Return the functions whose name starts with prefix.
+        """
+        return self._range(prefix)
+
+    def glob(self, pattern):
+        """glob(pattern)
+
+        Return the functions matching the shell-style pattern, such as
+        "vfs_*" or "tcp_v?_connect".
+        """
+        prefix = re.split(r"[*?\[]", pattern, 1)[0]
+        return [fn for fn in self._range(prefix)
+                if fnmatch.fnmatchcase(fn, pattern)]
+
+    @classmethod
+    def _regex_prefix(cls, pattern):
+        if "|" in pattern:
+            return ""
+        if pattern.startswith("^"):
+            pattern = pattern[1:]
+        prefix = ""
+        for c in pattern:
+            if c in cls._regex_meta:
+                # a quantifier applies to the preceding character
+                if c in "*?{" and prefix:
+                    prefix = prefix[:-1]
+                break
+            prefix += c
+        return prefix
+
+    def regex(self, pattern):
+        """regex(pattern)
+
+        Return the functions matching the regular expression, anchored at
+        the start of the name as with re.match. This is how the event_re
+        argument of attach_kprobe is interpreted.
+        """
+        match = re.compile(pattern).match
+        return [fn for fn in self._range(KernelFunctions._regex_prefix(pattern))
+                if match(fn)]
+
+    def count(self, pattern):
+        """count(pattern)
+
+        Return the number of functions matching the regular expression,
+        e.g. to check a probe budget before attaching with event_re.
+        """
+        return len(self.regex(pattern))
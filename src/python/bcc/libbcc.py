@@ -25,6 +25,13 @@ lib.bpf_module_create_c.argtypes = [ct.c_char_p, ct.c_uint,
 lib.bpf_module_create_c_from_string.restype = ct.c_void_p
 lib.bpf_module_create_c_from_string.argtypes = [ct.c_char_p, ct.c_uint,
         ct.POINTER(ct.c_char_p), ct.c_int]
+lib.bpf_module_create_from_object.restype = ct.c_void_p
+lib.bpf_module_create_from_object.argtypes = [ct.c_char_p, ct.c_uint]
+lib.bpf_module_save_object.restype = ct.c_int
+lib.bpf_module_save_object.argtypes = [ct.c_void_p, ct.c_char_p]
+lib.bpf_module_build_pch.restype = ct.c_int
+lib.bpf_module_build_pch.argtypes = [ct.c_char_p, ct.c_char_p, ct.c_uint,
+        ct.POINTER(ct.c_char_p), ct.c_int]
 lib.bpf_module_destroy.restype = None
 lib.bpf_module_destroy.argtypes = [ct.c_void_p]
 lib.bpf_module_license.restype = ct.c_char_p
@@ -69,6 +76,26 @@ lib.bpf_get_next_key.restype = ct.c_int
 lib.bpf_get_next_key.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p]
 lib.bpf_lookup_elem.restype = ct.c_int
 lib.bpf_lookup_elem.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p]
+lib.bpf_get_first_key.restype = ct.c_int
+lib.bpf_get_first_key.argtypes = [ct.c_int, ct.c_void_p, ct.c_size_t,
+        ct.c_size_t]
+lib.bpf_dump_map.restype = ct.c_int
+lib.bpf_dump_map.argtypes = [ct.c_int, ct.c_void_p, ct.c_size_t, ct.c_void_p,
+        ct.c_size_t, ct.c_int]
+lib.bpf_count_map.restype = ct.c_int
+lib.bpf_count_map.argtypes = [ct.c_int, ct.c_size_t, ct.c_size_t]
+lib.bpf_dump_keys.restype = ct.c_int
+lib.bpf_dump_keys.argtypes = [ct.c_int, ct.c_void_p, ct.c_size_t, ct.c_size_t,
+        ct.c_int]
+lib.bpf_fill_array.restype = ct.c_int
+lib.bpf_fill_array.argtypes = [ct.c_int, ct.c_void_p, ct.c_int]
+lib.bpf_update_batch.restype = ct.c_int
+lib.bpf_update_batch.argtypes = [ct.c_int, ct.c_void_p, ct.c_size_t,
+        ct.c_void_p, ct.c_size_t, ct.c_int, ct.c_ulonglong,
+        ct.POINTER(ct.c_int)]
+lib.bpf_delete_batch.restype = ct.c_int
+lib.bpf_delete_batch.argtypes = [ct.c_int, ct.c_void_p, ct.c_size_t, ct.c_int,
+        ct.POINTER(ct.c_int)]
 lib.bpf_update_elem.restype = ct.c_int
 lib.bpf_update_elem.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p,
         ct.c_ulonglong]
@@ -85,30 +112,54 @@ lib.bpf_attach_kprobe.restype = ct.c_void_p
 _CB_TYPE = ct.CFUNCTYPE(None, ct.py_object, ct.c_int,
         ct.c_ulonglong, ct.POINTER(ct.c_ulonglong))
 _RAW_CB_TYPE = ct.CFUNCTYPE(None, ct.py_object, ct.c_void_p, ct.c_int)
+_LOST_CB_TYPE = ct.CFUNCTYPE(None, ct.py_object, ct.c_ulonglong)
+_BATCH_CB_TYPE = ct.CFUNCTYPE(None, ct.py_object, ct.c_void_p, ct.c_void_p,
+        ct.c_int)
 lib.bpf_attach_kprobe.argtypes = [ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_int,
         ct.c_int, ct.c_int, _CB_TYPE, ct.py_object]
 lib.bpf_detach_kprobe.restype = ct.c_int
 lib.bpf_detach_kprobe.argtypes = [ct.c_char_p]
+lib.bpf_detach_kprobes.restype = ct.c_int
+lib.bpf_detach_kprobes.argtypes = [ct.POINTER(ct.c_char_p), ct.c_int]
 lib.bpf_attach_uprobe.restype = ct.c_void_p
 lib.bpf_attach_uprobe.argtypes = [ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_int,
         ct.c_int, ct.c_int, _CB_TYPE, ct.py_object]
 lib.bpf_detach_uprobe.restype = ct.c_int
 lib.bpf_detach_uprobe.argtypes = [ct.c_char_p]
+lib.bpf_detach_uprobes.restype = ct.c_int
+lib.bpf_detach_uprobes.argtypes = [ct.POINTER(ct.c_char_p), ct.c_int]
 lib.bpf_attach_tracepoint.restype = ct.c_void_p
 lib.bpf_attach_tracepoint.argtypes = [ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_int,
         ct.c_int, ct.c_int, _CB_TYPE, ct.py_object]
 lib.bpf_detach_tracepoint.restype = ct.c_int
 lib.bpf_detach_tracepoint.argtypes = [ct.c_char_p, ct.c_char_p]
 lib.bpf_open_perf_buffer.restype = ct.c_void_p
-lib.bpf_open_perf_buffer.argtypes = [_RAW_CB_TYPE, ct.py_object, ct.c_int, ct.c_int]
+lib.bpf_open_perf_buffer.argtypes = [_RAW_CB_TYPE, _LOST_CB_TYPE,
+        ct.py_object, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int]
 lib.bpf_open_perf_event.restype = ct.c_int
 lib.bpf_open_perf_event.argtypes = [ct.c_uint, ct.c_ulonglong, ct.c_int, ct.c_int]
 lib.perf_reader_poll.restype = ct.c_int
 lib.perf_reader_poll.argtypes = [ct.c_int, ct.POINTER(ct.c_void_p), ct.c_int]
+lib.perf_reader_poller_new.restype = ct.c_void_p
+lib.perf_reader_poller_new.argtypes = []
+lib.perf_reader_poller_free.restype = None
+lib.perf_reader_poller_free.argtypes = [ct.c_void_p]
+lib.perf_reader_poller_add.restype = ct.c_int
+lib.perf_reader_poller_add.argtypes = [ct.c_void_p, ct.c_void_p]
+lib.perf_reader_poller_remove.restype = ct.c_int
+lib.perf_reader_poller_remove.argtypes = [ct.c_void_p, ct.c_void_p]
+lib.perf_reader_poller_poll.restype = ct.c_int
+lib.perf_reader_poller_poll.argtypes = [ct.c_void_p, ct.c_int]
 lib.perf_reader_free.restype = None
 lib.perf_reader_free.argtypes = [ct.c_void_p]
 lib.perf_reader_fd.restype = int
 lib.perf_reader_fd.argtypes = [ct.c_void_p]
+lib.perf_reader_lost_count.restype = ct.c_ulonglong
+lib.perf_reader_lost_count.argtypes = [ct.c_void_p]
+lib.perf_reader_set_flush_timeout.restype = None
+lib.perf_reader_set_flush_timeout.argtypes = [ct.c_void_p, ct.c_int]
+lib.perf_reader_set_batch_cb.restype = None
+lib.perf_reader_set_batch_cb.argtypes = [ct.c_void_p, _BATCH_CB_TYPE]
 
 lib.bpf_attach_xdp.restype = ct.c_int;
 lib.bpf_attach_xdp.argtypes = [ct.c_char_p, ct.c_int]
@@ -12,12 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
 from collections import MutableMapping
 import ctypes as ct
+import errno
 import multiprocessing
 import os
-
-from .libbcc import lib, _RAW_CB_TYPE
+import struct
+import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .libbcc import lib, _RAW_CB_TYPE, _LOST_CB_TYPE, _BATCH_CB_TYPE
 from .perf import Perf
 from subprocess import check_output
 
@@ -76,6 +84,92 @@ def _print_log2_hist(vals, val_type):
                       _stars(val, val_max, stars)))
 
 
+# simple ctypes types whose type code is also an array.array type code
+_array_typecodes = "bBhHiIlLqQfd"
+
+def _ctype_to_array(buf, ctype):
+    """Wrap a ctypes array of ctype without NumPy: an array.array for
+    integer and floating point types, a memoryview otherwise."""
+    code = getattr(ctype, "_type_", None)
+    if isinstance(code, str) and code in _array_typecodes:
+        arr = array(code)
+        data = ct.string_at(ct.addressof(buf), ct.sizeof(buf))
+        if hasattr(arr, "frombytes"):
+            arr.frombytes(data)
+        else:
+            arr.fromstring(data)
+        return arr
+    return memoryview(buf)
+
+# struct module codes for ctypes simple types, with standard sizes
+_struct_codes = {
+    "b": "b", "B": "B", "h": "h", "H": "H", "i": "i", "I": "I",
+    "q": "q", "Q": "Q", "f": "f", "d": "d", "?": "?", "c": "c",
+}
+_struct_int_codes = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+def _struct_format(ctype):
+    """Return a struct module format, without byte order, that unpacks
+    ctype into a flat tuple of its fields, padding included."""
+    if issubclass(ctype, ct.Array):
+        if ctype._type_ is ct.c_char:
+            return "%ds" % ctype._length_
+        elem = _struct_format(ctype._type_)
+        if len(elem) == 1:
+            return "%d%s" % (ctype._length_, elem)
+        return elem * ctype._length_
+    if issubclass(ctype, (ct.Structure, ct.Union)):
+        if issubclass(ctype, ct.Union):
+            raise Exception("Cannot unpack union %s" % ctype.__name__)
+        fmt = ""
+        pos = 0
+        for field in ctype._fields_:
+            if len(field) > 2:
+                raise Exception("Cannot unpack bitfield %s.%s" %
+                                (ctype.__name__, field[0]))
+            offset = getattr(ctype, field[0]).offset
+            fmt += "x" * (offset - pos) + _struct_format(field[1])
+            pos = offset + ct.sizeof(field[1])
+        return fmt + "x" * (ct.sizeof(ctype) - pos)
+    code = ctype._type_
+    # long and long long have platform dependent codes, go by size
+    if code in "lLnN":
+        code = _struct_int_codes[ct.sizeof(ctype)]
+        if ctype._type_ in "LN":
+            code = code.upper()
+    if code not in _struct_codes:
+        raise Exception("Cannot unpack %s" % ctype.__name__)
+    return _struct_codes[code]
+
+
+_percpu_reductions = {
+    "sum": sum,
+    "max": max,
+    "min": min,
+    "mean": lambda vals: float(sum(vals)) / len(vals),
+}
+
+def _reduce_percpu(table, op):
+    """Reduce the per-cpu values of all the keys of a PerCpuHash or
+    PerCpuArray along the cpu axis, in a single NumPy pass if available."""
+    if op not in _percpu_reductions:
+        raise Exception("Unknown per-cpu reduction %s" % op)
+    if issubclass(table.sLeaf, ct.Structure):
+        raise IndexError("Leaf must be an integer type for reductions")
+    if np is not None:
+        keys, leaves = table.to_arrays()
+        if table.alignment != 0:
+            # the kernel pads each value to 8 bytes, truncate them back
+            leaves = leaves.astype(table._dtype(table.sLeaf))
+        return (keys, getattr(np, op)(leaves, axis=1))
+    keys, leaves = table.dump()
+    reduction = _percpu_reductions[op]
+    if table.alignment != 0:
+        return (keys, [reduction([table.sLeaf(v).value for v in row])
+                       for row in leaves])
+    return (keys, [reduction(row) for row in leaves])
+
+
 def Table(bpf, map_id, map_fd, keytype, leaftype, **kwargs):
     """Table(bpf, map_id, map_fd, keytype, leaftype, **kwargs)
 
@@ -111,7 +205,18 @@ class TableBase(MutableMapping):
         self.Key = keytype
         self.Leaf = leaftype
         self.ttype = lib.bpf_table_type_id(self.bpf.module, self.map_id)
+        self.max_entries = int(lib.bpf_table_max_entries_id(self.bpf.module,
+                self.map_id))
         self._cbs = {}
+        self._last_len = None
+        self._structs = {}
+        self._into_key = self._into_buf = None
+
+    def _rw_error(self, what):
+        if self.bpf.from_object:
+            return "Could not %s: not supported for modules loaded from " \
+                   "an object" % what
+        return "Could not %s" % what
 
     def key_sprintf(self, key):
         key_p = ct.pointer(key)
@@ -119,7 +224,7 @@ class TableBase(MutableMapping):
         res = lib.bpf_table_key_snprintf(self.bpf.module, self.map_id,
                 buf, len(buf), key_p)
         if res < 0:
-            raise Exception("Could not printf key")
+            raise Exception(self._rw_error("printf key"))
         return buf.value
 
     def leaf_sprintf(self, leaf):
@@ -128,7 +233,7 @@ class TableBase(MutableMapping):
         res = lib.bpf_table_leaf_snprintf(self.bpf.module, self.map_id,
                 buf, len(buf), leaf_p)
         if res < 0:
-            raise Exception("Could not printf leaf")
+            raise Exception(self._rw_error("printf leaf"))
         return buf.value
 
     def key_scanf(self, key_str):
@@ -137,7 +242,7 @@ class TableBase(MutableMapping):
         res = lib.bpf_table_key_sscanf(self.bpf.module, self.map_id,
                 key_str, key_p)
         if res < 0:
-            raise Exception("Could not scanf key")
+            raise Exception(self._rw_error("scanf key"))
         return key
 
     def leaf_scanf(self, leaf_str):
@@ -146,7 +251,7 @@ class TableBase(MutableMapping):
         res = lib.bpf_table_leaf_sscanf(self.bpf.module, self.map_id,
                 leaf_str, leaf_p)
         if res < 0:
-            raise Exception("Could not scanf leaf")
+            raise Exception(self._rw_error("scanf leaf"))
         return leaf
 
     def __getitem__(self, key):
@@ -160,6 +265,52 @@ class TableBase(MutableMapping):
             raise KeyError
         return leaf
 
+    def lookup_into(self, key, buf):
+        """lookup_into(key, buf)
+
+        Read the leaf of key into buf, a writable buffer of at least
+        sizeof(Leaf) bytes such as a bytearray, without allocating a Leaf.
+        Returns False if the key is not in the table. When the same key
+        object and buffer are passed again, their addresses are reused, so
+        a polling loop can update key in place (e.g. key.value = i) and
+        read the result with leaf_struct().unpack_from(buf). Array tables
+        also accept an int index, as with table[i].
+        """
+        if key is not self._into_key:
+            self._into_key_addr = ct.addressof(key)
+            self._into_key = key
+        if buf is not self._into_buf:
+            view = (ct.c_char * ct.sizeof(self.Leaf)).from_buffer(buf)
+            self._into_buf_addr = ct.addressof(view)
+            # keep the view alive, which also keeps buf from being resized
+            self._into_view = view
+            self._into_buf = buf
+        return lib.bpf_lookup_elem(self.map_fd, self._into_key_addr,
+                self._into_buf_addr) == 0
+
+    def _struct(self, ctype):
+        s = self._structs.get(ctype)
+        if s is None:
+            s = struct.Struct("=" + _struct_format(ctype))
+            self._structs[ctype] = s
+        return s
+
+    def key_struct(self):
+        """key_struct()
+
+        Return a struct.Struct with the layout of Key, whose unpack_from()
+        turns a key buffer into a flat tuple of its fields.
+        """
+        return self._struct(self.Key)
+
+    def leaf_struct(self):
+        """leaf_struct()
+
+        Return a struct.Struct with the layout of Leaf, to decode buffers
+        filled by lookup_into(). Nested structs and arrays are flattened.
+        """
+        return self._struct(self.Leaf)
+
     def __setitem__(self, key, leaf):
         key_p = ct.pointer(key)
         leaf_p = ct.pointer(leaf)
@@ -191,9 +342,148 @@ class TableBase(MutableMapping):
     def items(self):
         return [item for item in self.iteritems()]
 
+    def dump(self, max_entries=None):
+        """dump(max_entries=None)
+
+        Read the keys and leaves of the whole table in one native call,
+        which uses the kernel's batch lookup where available. Returns a
+        (keys, leaves) tuple of ctypes arrays of Key and Leaf, holding the
+        entries in matching order. Both are contiguous buffers, so they can
+        be passed to memoryview() as well as indexed and iterated.
+        """
+        if max_entries is None:
+            max_entries = self.max_entries
+        keys = (self.Key * max_entries)()
+        leaves = (self.Leaf * max_entries)()
+        res = lib.bpf_dump_map(self.map_fd, ct.cast(keys, ct.c_void_p),
+                ct.sizeof(self.Key), ct.cast(leaves, ct.c_void_p),
+                ct.sizeof(self.Leaf), max_entries)
+        if res < 0:
+            errstr = os.strerror(ct.get_errno())
+            raise Exception("Could not dump table: %s" % errstr)
+        if res == max_entries:
+            return (keys, leaves)
+        # views of the first res entries, which keep the arrays alive
+        return ((self.Key * res).from_buffer(keys),
+                (self.Leaf * res).from_buffer(leaves))
+
+    @staticmethod
+    def _as_array(items, ctype):
+        if isinstance(items, ct.Array) and items._type_ == ctype:
+            return items
+        return (ctype * len(items))(*items)
+
+    def _failures(self, keys, errors, failed):
+        if failed == 0:
+            return []
+        return [(keys[i], errors[i]) for i in range(len(keys)) if errors[i]]
+
+    def update_many(self, keys, leaves, flags=0):
+        """update_many(keys, leaves, flags=0)
+
+        Set the leaves of many keys in one native call, which uses the
+        kernel's batch update where available. keys and leaves are
+        sequences of Key and Leaf of the same length, or ctypes arrays such
+        as those returned by dump(). flags are passed to the kernel as for
+        each single update. Returns a list of (key, errno) tuples for the
+        keys that could not be updated, which is empty on success.
+        """
+        if len(keys) != len(leaves):
+            raise Exception("update_many() needs as many leaves as keys")
+        keys = TableBase._as_array(keys, self.Key)
+        leaves = TableBase._as_array(leaves, self.Leaf)
+        errors = (ct.c_int * len(keys))()
+        failed = lib.bpf_update_batch(self.map_fd, ct.cast(keys, ct.c_void_p),
+                ct.sizeof(self.Key), ct.cast(leaves, ct.c_void_p),
+                ct.sizeof(self.Leaf), len(keys), flags, errors)
+        return self._failures(keys, errors, failed)
+
+    def delete_many(self, keys):
+        """delete_many(keys)
+
+        Delete many keys in one native call, which uses the kernel's batch
+        delete where available. keys is a sequence of Key or a ctypes array
+        of them. Returns a list of (key, errno) tuples for the keys that
+        could not be deleted, e.g. with errno.ENOENT if they were missing.
+        """
+        keys = TableBase._as_array(keys, self.Key)
+        errors = (ct.c_int * len(keys))()
+        failed = lib.bpf_delete_batch(self.map_fd, ct.cast(keys, ct.c_void_p),
+                ct.sizeof(self.Key), len(keys), errors)
+        return self._failures(keys, errors, failed)
+
+    def _dtype(self, ctype):
+        try:
+            return np.dtype(ctype)
+        except (TypeError, ValueError, NotImplementedError) as e:
+            raise Exception("No NumPy equivalent for %s: %s" %
+                            (ctype.__name__, e))
+
+    def to_arrays(self):
+        """to_arrays()
+
+        Read the whole table as with dump(), and return a (keys, leaves)
+        tuple of NumPy arrays whose dtypes mirror the Key and Leaf types:
+        structs become structured arrays with the same field names, and
+        the per-cpu values of per-cpu tables become a second dimension.
+        Without NumPy, integer and floating point keys and leaves are
+        returned as array.array, and others as memoryview objects.
+        """
+        keys, leaves = self.dump()
+        if np is None:
+            return (_ctype_to_array(keys, self.Key),
+                    _ctype_to_array(leaves, self.Leaf))
+        return (np.frombuffer(keys, dtype=self._dtype(self.Key)),
+                np.frombuffer(leaves, dtype=self._dtype(self.Leaf)))
+
+    def snapshot(self):
+        """snapshot()
+
+        Read the whole table into a single NumPy structured array with a
+        "key" and a "leaf" field, for sorting and filtering entries
+        together, e.g. s[np.argsort(s["leaf"])[::-1][:10]] for the top 10.
+        Requires NumPy.
+        """
+        if np is None:
+            raise Exception("snapshot() requires NumPy, use to_arrays()")
+        keys, leaves = self.to_arrays()
+        snap = np.empty(len(keys), dtype=[("key", keys.dtype, keys.shape[1:]),
+                                         ("leaf", leaves.dtype,
+                                          leaves.shape[1:])])
+        snap["key"] = keys
+        snap["leaf"] = leaves
+        return snap
+
     def values(self):
         return [value for value in self.itervalues()]
 
+    def _count(self):
+        # the kernel keeps no element count, so this walks all the keys, in
+        # one native call but still in time linear in the number of entries
+        res = lib.bpf_count_map(self.map_fd, ct.sizeof(self.Key),
+                ct.sizeof(self.Leaf))
+        if res < 0:
+            errstr = os.strerror(ct.get_errno())
+            raise Exception("Could not count table: %s" % errstr)
+        self._last_len = (time.time(), res)
+        return res
+
+    def cached_len(self, max_age=1.0):
+        """cached_len(max_age=1.0)
+
+        Return the number of entries in the table as last counted by len(),
+        if that was less than max_age seconds ago (or at any time if max_age
+        is None), and count them again otherwise. len() of a hash or stack
+        trace table walks all of its keys, so this is meant for polling the
+        occupancy of large tables from several places without walking the
+        table for each of them; the result may be out of date by up to
+        max_age seconds.
+        """
+        if self._last_len is not None and (max_age is None or
+                time.time() - self._last_len[0] < max_age):
+            return self._last_len[1]
+        return len(self)
+
     def clear(self):
         # default clear uses popitem, which can race with the bpf prog
         for k in self.keys():
@@ -213,22 +503,29 @@ class TableBase(MutableMapping):
         def __init__(self, table, keytype):
             self.Key = keytype
             self.table = table
-            k = self.Key()
-            kp = ct.pointer(k)
-            # if 0 is a valid key, try a few alternatives
-            if k in table:
-                ct.memset(kp, 0xff, ct.sizeof(k))
-                if k in table:
-                    ct.memset(kp, 0x55, ct.sizeof(k))
-                    if k in table:
-                        raise Exception("Unable to allocate iterator")
-            self.key = k
+            self.key = None
+            # the walk goes through these two buffers, so that the caller
+            # can keep or delete the returned keys
+            self._cur = ct.create_string_buffer(ct.sizeof(keytype))
+            self._next = ct.create_string_buffer(ct.sizeof(keytype))
         def __iter__(self):
             return self
         def __next__(self):
             return self.next()
         def next(self):
-            self.key = self.table.next(self.key)
+            if self.key is None:
+                res = lib.bpf_get_first_key(self.table.map_fd, self._next,
+                        len(self._next), ct.sizeof(self.table.Leaf))
+                if res < 0 and ct.get_errno() != errno.ENOENT:
+                    raise Exception("Unable to allocate iterator: %s" %
+                                    os.strerror(ct.get_errno()))
+            else:
+                res = lib.bpf_get_next_key(self.table.map_fd, self._cur,
+                        self._next)
+            if res < 0:
+                raise StopIteration()
+            self._cur, self._next = self._next, self._cur
+            self.key = self.Key.from_buffer_copy(self._cur)
             return self.key
 
     def next(self, key):
@@ -277,14 +574,107 @@ class TableBase(MutableMapping):
             _print_log2_hist(vals, val_type)
 
 
+class DoubleTable(object):
+    """
+    A pair of tables declared with BPF_DOUBLE_TABLE, of which the BPF
+    program writes to the one chosen by the _sel array. Swapping them lets
+    userspace read and clear the idle one while new events go to the other.
+    """
+    def __init__(self, bpf, name, **kwargs):
+        self.name = name
+        self.tables = [bpf.get_table("%s_%d" % (name, i), **kwargs)
+                       for i in range(2)]
+        self.selector = bpf.get_table("%s_sel" % name)
+        # the table returned by the last swap_and_drain() and what was read
+        # from it, which is cleared on the next one
+        self._drained = None
+
+    @staticmethod
+    def update_text(name, call):
+        """update_text(name, call)
+
+        Return the C statement that applies the map method call, such as
+        "increment(key)", to the active table of the BPF_DOUBLE_TABLE name.
+        The BPF program has to pick the table itself, since map methods
+        can't be called from within macros.
+
+        Example: DoubleTable.update_text("dist", "increment(key)")
+        """
+        return ("{ int __zero = 0; u32 *__sel = %s_sel.lookup(&__zero); " +
+                "if (__sel && *__sel) %s_1.%s; else %s_0.%s; }") % \
+                (name, name, call, name, call)
+
+    def active(self):
+        """active()
+
+        Return the table the BPF program is currently writing to.
+        """
+        return self.tables[self.selector[0].value & 1]
+
+    def swap(self, grace=0.001):
+        """swap(grace=0.001)
+
+        Direct the BPF program to the other table and return the one it was
+        writing to. Programs that read the selector just before the swap may
+        still update the returned table; waiting grace seconds makes that
+        unlikely but not impossible, so updates can land in the table after
+        it was read. Use swap_and_drain() to have them carried over.
+        """
+        idle = self.selector[0].value & 1
+        self.selector[0] = self.selector.Leaf(idle ^ 1)
+        if grace:
+            time.sleep(grace)
+        return self.tables[idle]
+
+    def swap_and_drain(self, grace=0.001):
+        """swap_and_drain(grace=0.001)
+
+        Swap the tables and return the items() of the one that was active.
+        That table is only cleared by the next call, right before it becomes
+        active again, and the updates that reached it after it was read are
+        returned then: integer leaves are added to the next result, other
+        leaves replace the entries for their key.
+        """
+        late = []
+        if self._drained:
+            table, seen = self._drained
+            for k, v in table.items():
+                old = seen.get(bytes(bytearray(k)))
+                if old is None or bytearray(v) != old:
+                    late.append((k, v, old))
+            table.clear()
+        idle = self.swap(grace)
+        items = idle.items()
+        self._drained = (idle, dict((bytes(bytearray(k)), bytearray(v))
+                                    for k, v in items))
+        return DoubleTable._carry_over(idle.Leaf, items, late)
+
+    @staticmethod
+    def _carry_over(leaftype, items, late):
+        if not late:
+            return items
+        index = dict((bytes(bytearray(k)), i) for i, (k, v) in
+                     enumerate(items))
+        counting = issubclass(leaftype, ct._SimpleCData)
+        for k, v, old in late:
+            if counting and old is not None:
+                v = leaftype(v.value - leaftype.from_buffer_copy(old).value)
+            i = index.get(bytes(bytearray(k)))
+            if i is None:
+                items.append((k, v))
+            elif counting:
+                items[i][1].value += v.value
+            else:
+                items[i] = (k, v)
+        return items
+
+
 class HashTable(TableBase):
     def __init__(self, *args, **kwargs):
         super(HashTable, self).__init__(*args, **kwargs)
 
     def __len__(self):
-        i = 0
-        for k in self: i += 1
-        return i
+        return self._count()
 
     def __delitem__(self, key):
         key_p = ct.pointer(key)
@@ -292,12 +682,27 @@ class HashTable(TableBase):
         if res < 0:
             raise KeyError
 
+    def clear(self):
+        # only the keys are read, and a key that is already gone, e.g. one
+        # the walk returned twice, is not an error
+        keys = (self.Key * self.max_entries)()
+        res = lib.bpf_dump_keys(self.map_fd, ct.cast(keys, ct.c_void_p),
+                ct.sizeof(self.Key), ct.sizeof(self.Leaf), self.max_entries)
+        if res < 0:
+            errstr = os.strerror(ct.get_errno())
+            raise Exception("Could not clear table: %s" % errstr)
+        failed = [(k, err) for k, err in
+                  self.delete_many((self.Key * res).from_buffer(keys))
+                  if err != errno.ENOENT]
+        if failed:
+            raise Exception("Could not clear table: %d keys failed, " \
+                    "first with %s" % (len(failed), os.strerror(failed[0][1])))
+
 
 class ArrayBase(TableBase):
     def __init__(self, *args, **kwargs):
         super(ArrayBase, self).__init__(*args, **kwargs)
-        self.max_entries = int(lib.bpf_table_max_entries_id(self.bpf.module,
-                self.map_id))
+        self._zero_leaf = None
 
     def _normalize_key(self, key):
         if isinstance(key, int):
@@ -321,6 +726,12 @@ class ArrayBase(TableBase):
         key = self._normalize_key(key)
         super(ArrayBase, self).__setitem__(key, leaf)
 
+    def lookup_into(self, key, buf):
+        # keys given as ints are converted, as for indexing; passing the
+        # same Key object each time keeps its address cached
+        key = self._normalize_key(key)
+        return super(ArrayBase, self).lookup_into(key, buf)
+
     def __delitem__(self, key):
         key = self._normalize_key(key)
         key_p = ct.pointer(key)
@@ -334,6 +745,26 @@ class ArrayBase(TableBase):
         if res < 0:
             raise Exception("Could not clear item")
 
+    def zero(self):
+        # created lazily, as per-cpu arrays change Leaf after __init__
+        if self._zero_leaf is None:
+            self._zero_leaf = self.Leaf()
+        res = lib.bpf_fill_array(self.map_fd,
+                ct.cast(ct.pointer(self._zero_leaf), ct.c_void_p),
+                self.max_entries)
+        if res < 0:
+            errstr = os.strerror(ct.get_errno())
+            raise Exception("Could not zero table: %s" % errstr)
+
+    def clear(self):
+        # deleting from arrays zeroes the entries
+        self.zero()
+
+    def delete_many(self, keys):
+        # as with __delitem__, zero out the entries
+        keys = [self._normalize_key(k) for k in keys]
+        return self.update_many(keys, [self.Leaf() for k in keys])
+
     def __iter__(self):
         return ArrayBase.Iter(self, self.Key)
 
@@ -413,33 +844,174 @@ class PerfEventArray(ArrayBase):
         super(PerfEventArray, self).__delitem__(key)
         self.close_perf_buffer(key)
 
-    def open_perf_buffer(self, callback):
-        """open_perf_buffers(callback)
+    def clear(self):
+        for k in self.keys():
+            self.__delitem__(k)
+
+    DEFAULT_PAGE_CNT = 8
+    MAX_AUTO_PAGE_CNT = 1024
+
+    @staticmethod
+    def auto_page_cnt(event_rate, event_size=128, latency=0.1, ncpu=None):
+        """auto_page_cnt(event_rate, event_size=128, latency=0.1, ncpu=None)
+
+        Return a ring buffer size, in pages per cpu, that can hold latency
+        seconds worth of events of event_size bytes arriving at event_rate
+        events per second spread over ncpu cpus (all cpus by default).
+        The result is a power of two between the default of 8 pages and
+        MAX_AUTO_PAGE_CNT.
+        """
+        if ncpu is None:
+            ncpu = multiprocessing.cpu_count()
+        # each sample carries a perf header and a size field
+        needed = float(event_rate) / ncpu * latency * (event_size + 12)
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        page_cnt = PerfEventArray.DEFAULT_PAGE_CNT
+        while page_cnt * page_size < needed and \
+                page_cnt < PerfEventArray.MAX_AUTO_PAGE_CNT:
+            page_cnt *= 2
+        return page_cnt
+
+    def open_perf_buffer(self, callback, page_cnt=None, event_rate=None,
+            on_lost=None, batch=False, wakeup_events=1, wakeup_watermark=0,
+            flush_timeout=100):
+        """open_perf_buffers(callback, page_cnt=None, event_rate=None,
+                             on_lost=None, batch=False, wakeup_events=1,
+                             wakeup_watermark=0, flush_timeout=100)
 
         Opens a set of per-cpu ring buffer to receive custom perf event
         data from the bpf program. The callback will be invoked for each
         event submitted from the kernel, up to millions per second.
+
+        page_cnt is the size of each ring buffer in pages, and must be a
+        power of two. If it is not given and event_rate, the expected
+        number of events per second, is, the size is chosen with
+        auto_page_cnt(). The default is 8 pages. Larger buffers lose fewer
+        events during bursts.
+
+        Events that do not fit in a buffer are dropped by the kernel, and
+        counted by lost_count(). on_lost(cpu, count) is called when the
+        reader finds out about them; without it, they are reported on
+        stderr.
+
+        If batch is True, the callback is invoked once for all the events
+        read from a ring, as callback(cpu, data, offsets): data is a
+        memoryview of the events copied back to back, and event i spans
+        data[offsets[i]:offsets[i + 1]], where offsets is a ctypes array.
+        Both are only valid during the call. Events of a fixed size can be
+        decoded at once with decode_events().
+
+        By default, kprobe_poll() is woken up for every event. At high
+        rates, wakeup_events=N wakes it up every N events instead, and
+        wakeup_watermark=B once B bytes are waiting in a buffer, which
+        saves CPU time at the cost of latency. Buffers opened this way are
+        also read by kprobe_poll() once they have not been read for
+        flush_timeout milliseconds, so that the last events of a slow
+        stream are not held back, even while other buffers keep it busy.
         """
+        if page_cnt is None:
+            if event_rate:
+                page_cnt = PerfEventArray.auto_page_cnt(event_rate)
+            else:
+                page_cnt = PerfEventArray.DEFAULT_PAGE_CNT
+        if page_cnt <= 0 or page_cnt & (page_cnt - 1):
+            raise Exception("Perf buffer page_cnt must be a power of two, " \
+                    "got %d" % page_cnt)
+        if wakeup_watermark >= page_cnt * os.sysconf("SC_PAGE_SIZE"):
+            raise Exception("Perf buffer wakeup_watermark must be smaller " \
+                    "than the buffer")
+        if wakeup_events <= 1 and wakeup_watermark <= 0:
+            flush_timeout = None
 
         for i in range(0, multiprocessing.cpu_count()):
-            self._open_perf_buffer(i, callback)
-
-    def _open_perf_buffer(self, cpu, callback):
-        fn = _RAW_CB_TYPE(lambda _, data, size: callback(cpu, data, size))
-        reader = lib.bpf_open_perf_buffer(fn, None, -1, cpu)
+            self._open_perf_buffer(i, callback, page_cnt, on_lost, batch,
+                                   wakeup_events, wakeup_watermark,
+                                   flush_timeout)
+
+    @staticmethod
+    def _batch_cb(cpu, callback, data, offsets, count):
+        offsets = (ct.c_uint32 * (count + 1)).from_address(offsets)
+        view = memoryview((ct.c_char * offsets[count]).from_address(data))
+        # plain bytes are easier to index than ctypes' "<c" format
+        if hasattr(view, "cast"):
+            view = view.cast("B")
+        callback(cpu, view, offsets)
+
+    @staticmethod
+    def decode_events(data, offsets, ctype):
+        """decode_events(data, offsets, ctype)
+
+        Decode a batch of events of type ctype, as passed to a batch
+        callback, into a NumPy structured array, or into a list of ctype
+        objects without NumPy. The result is a copy, which can be kept
+        after the callback returns. All the events must have the same size,
+        which the kernel pads to a multiple of 8 bytes minus 4.
+        """
+        count = len(offsets) - 1
+        if count == 0:
+            return np.empty(0, dtype=np.dtype(ctype)) if np is not None \
+                else []
+        stride = offsets[1] - offsets[0]
+        size = ct.sizeof(ctype)
+        if offsets[count] != count * stride or size > stride:
+            raise Exception("Events in batch do not all have the size of %s" %
+                            ctype.__name__)
+        if np is None:
+            return [ctype.from_buffer_copy(data, offsets[i])
+                    for i in range(count)]
+        raw = np.frombuffer(data, dtype=np.uint8, count=count * stride)
+        raw = raw.reshape(count, stride)[:, :size]
+        return np.ascontiguousarray(raw).view(np.dtype(ctype)).reshape(count)
+
+    def _open_perf_buffer(self, cpu, callback, page_cnt, on_lost, batch,
+            wakeup_events, wakeup_watermark, flush_timeout):
+        if batch:
+            fn = _RAW_CB_TYPE()
+            batch_fn = _BATCH_CB_TYPE(lambda _, data, offsets, count:
+                    PerfEventArray._batch_cb(cpu, callback, data, offsets,
+                                             count))
+        else:
+            fn = _RAW_CB_TYPE(lambda _, data, size: callback(cpu, data, size))
+            batch_fn = None
+        if on_lost:
+            lost_fn = _LOST_CB_TYPE(lambda _, lost: on_lost(cpu, lost))
+        else:
+            lost_fn = _LOST_CB_TYPE()
+        reader = lib.bpf_open_perf_buffer(fn, lost_fn, None, -1, cpu,
+                page_cnt, wakeup_events, wakeup_watermark)
         if not reader:
             raise Exception("Could not open perf buffer")
+        if batch_fn:
+            lib.perf_reader_set_batch_cb(reader, batch_fn)
+        if flush_timeout is not None:
+            lib.perf_reader_set_flush_timeout(reader, flush_timeout)
         fd = lib.perf_reader_fd(reader)
         self[self.Key(cpu)] = self.Leaf(fd)
-        self.bpf._add_kprobe((id(self), cpu), reader)
         # keep a refcnt
-        self._cbs[cpu] = fn
+        self._cbs[cpu] = (fn, lost_fn, batch_fn)
+        self.bpf._add_kprobe((id(self), cpu), reader)
+        if flush_timeout is not None:
+            self.bpf._add_flush_timeout((id(self), cpu), flush_timeout)
+
+    def lost_count(self, cpu=None):
+        """lost_count(cpu=None)
+
+        Return the number of events dropped by the kernel because the ring
+        buffer of cpu was full, or the total over all cpus if cpu is None,
+        since the buffers were opened.
+        """
+        if cpu is None:
+            return sum(self.lost_count(c) for c in self._cbs)
+        reader = self.bpf.open_kprobes.get((id(self), cpu))
+        if not reader:
+            return 0
+        return lib.perf_reader_lost_count(reader)
 
     def close_perf_buffer(self, key):
         reader = self.bpf.open_kprobes.get((id(self), key))
         if reader:
-            lib.perf_reader_free(reader)
             self.bpf._del_kprobe((id(self), key))
+            self.bpf._free_reader(reader, self._cbs[key])
         del self._cbs[key]
 
     def _open_perf_event(self, cpu, typ, config):
@@ -507,18 +1079,33 @@ class PerCpuHash(HashTable):
     def sum(self, key):
         if isinstance(self.Leaf(), ct.Structure):
             raise IndexError("Leaf must be an integer type for default sum functions")
-        return self.sLeaf(reduce(lambda x,y: x+y, self.getvalue(key)))
+        return self.sLeaf(sum(self.getvalue(key)))
 
     def max(self, key):
         if isinstance(self.Leaf(), ct.Structure):
             raise IndexError("Leaf must be an integer type for default max functions")
         return self.sLeaf(max(self.getvalue(key)))
 
+    def min(self, key):
+        if isinstance(self.Leaf(), ct.Structure):
+            raise IndexError("Leaf must be an integer type for default min functions")
+        return self.sLeaf(min(self.getvalue(key)))
+
     def average(self, key):
         result = self.sum(key)
         result.value/=self.total_cpu
         return result
 
+    def reduce_all(self, op="sum"):
+        """reduce_all(op="sum")
+
+        Read the whole table at once and reduce the values of each key
+        across cpus, where op is "sum", "max", "min" or "mean". Returns a
+        (keys, values) tuple, of NumPy arrays if NumPy is available. The
+        unreduced keys x cpus values are the leaves of to_arrays().
+        """
+        return _reduce_percpu(self, op)
+
 class PerCpuArray(ArrayBase):
     def __init__(self, *args, **kwargs):
         self.reducer = kwargs.pop("reducer", None)
@@ -560,18 +1147,33 @@ class PerCpuArray(ArrayBase):
     def sum(self, key):
         if isinstance(self.Leaf(), ct.Structure):
             raise IndexError("Leaf must be an integer type for default sum functions")
-        return self.sLeaf(reduce(lambda x,y: x+y, self.getvalue(key)))
+        return self.sLeaf(sum(self.getvalue(key)))
 
     def max(self, key):
         if isinstance(self.Leaf(), ct.Structure):
             raise IndexError("Leaf must be an integer type for default max functions")
         return self.sLeaf(max(self.getvalue(key)))
 
+    def min(self, key):
+        if isinstance(self.Leaf(), ct.Structure):
+            raise IndexError("Leaf must be an integer type for default min functions")
+        return self.sLeaf(min(self.getvalue(key)))
+
     def average(self, key):
         result = self.sum(key)
         result.value/=self.total_cpu
         return result
 
+    def reduce_all(self, op="sum"):
+        """reduce_all(op="sum")
+
+        Read the whole table at once and reduce the values of each key
+        across cpus, where op is "sum", "max", "min" or "mean". Returns a
+        (keys, values) tuple, of NumPy arrays if NumPy is available. The
+        unreduced keys x cpus values are the leaves of to_arrays().
+        """
+        return _reduce_percpu(self, op)
+
 class StackTrace(TableBase):
     MAX_DEPTH = 127
 
@@ -605,9 +1207,7 @@ class StackTrace(TableBase):
         return StackTrace.StackWalker(self[self.Key(stack_id)], resolve)
 
     def __len__(self):
-        i = 0
-        for k in self: i += 1
-        return i
+        return self._count()
 
     def __delitem__(self, key):
         key_p = ct.pointer(key)
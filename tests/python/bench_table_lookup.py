@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 The bcc Authors
+# Licensed under the Apache License, Version 2.0 (the "License")
+#
+# Compare reading table entries through table[key], which allocates a Leaf
+# per lookup, with lookup_into() and a struct unpacker. Must run as root.
+#
+# USAGE: bench_table_lookup.py [entries] [rounds]
+
+from __future__ import print_function
+from bcc import BPF
+import ctypes as ct
+import sys
+import time
+
+entries = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+b = BPF(text="""
+struct leaf_t {
+    u64 count;
+    u64 bytes;
+    u32 pid;
+    char comm[16];
+};
+BPF_HASH(stats, u32, struct leaf_t, %d);
+""" % entries)
+t = b["stats"]
+t.update_many([t.Key(i) for i in range(entries)],
+              [t.Leaf(i, i * 2, i, b"bench") for i in range(entries)])
+
+def getitem():
+    total = 0
+    for i in range(entries):
+        total += t[t.Key(i)].bytes
+    return total
+
+def lookup_into():
+    key = t.Key()
+    buf = bytearray(ct.sizeof(t.Leaf))
+    unpack = t.leaf_struct().unpack_from
+    total = 0
+    for i in range(entries):
+        key.value = i
+        if t.lookup_into(key, buf):
+            total += unpack(buf)[1]
+    return total
+
+for name, fn in [("table[key]", getitem), ("lookup_into", lookup_into)]:
+    fn()
+    start = time.time()
+    for r in range(rounds):
+        fn()
+    elapsed = time.time() - start
+    print("%-12s %8.0f ns/lookup" % (name,
+          elapsed * 1e9 / (entries * rounds)))
+
+b.cleanup()
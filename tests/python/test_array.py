@@ -3,7 +3,9 @@
 # Licensed under the Apache License, Version 2.0 (the "License")
 
 from bcc import BPF
+from bcc.table import PerfEventArray
 import ctypes as ct
+import os
 import random
 import time
 from unittest import main, TestCase
@@ -63,5 +65,202 @@ int kprobe__sys_nanosleep(void *ctx) {
         b.kprobe_poll()
         self.assertGreater(self.counter, 0)
 
+    def test_perf_buffer_page_cnt(self):
+        self.counter = 0
+
+        def cb(cpu, data, size):
+            self.counter += 1
+
+        text = """
+BPF_PERF_OUTPUT(events);
+int kprobe__sys_nanosleep(void *ctx) {
+    u64 ts = bpf_ktime_get_ns();
+    events.perf_submit(ctx, &ts, sizeof(ts));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        with self.assertRaises(Exception):
+            b["events"].open_perf_buffer(cb, page_cnt=12)
+        b["events"].open_perf_buffer(cb, page_cnt=64)
+        time.sleep(0.1)
+        b.kprobe_poll()
+        self.assertGreater(self.counter, 0)
+        b.cleanup()
+
+    def test_perf_buffer_lost(self):
+        lost = {}
+
+        def cb(cpu, data, size):
+            pass
+
+        def lost_cb(cpu, count):
+            lost[cpu] = lost.get(cpu, 0) + count
+
+        text = """
+BPF_PERF_OUTPUT(events);
+int kprobe__sys_getpid(void *ctx) {
+    u64 data[8] = {};
+    events.perf_submit(ctx, &data, sizeof(data));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        b["events"].open_perf_buffer(cb, page_cnt=1, on_lost=lost_cb)
+        # overflow the single page ring before reading it
+        for i in range(1000):
+            os.getpid()
+        b.kprobe_poll(timeout=100)
+        self.assertGreater(sum(lost.values()), 0)
+        self.assertEqual(sum(lost.values()), b["events"].lost_count())
+        for cpu, count in lost.items():
+            self.assertEqual(count, b["events"].lost_count(cpu))
+        b.cleanup()
+
+    def test_perf_buffer_batch(self):
+        self.events = []
+
+        class Data(ct.Structure):
+            _fields_ = [("pid", ct.c_uint), ("seq", ct.c_ulonglong)]
+
+        def cb(cpu, data, offsets):
+            self.assertEqual(offsets[-1], len(data))
+            self.events.extend(PerfEventArray.decode_events(data, offsets,
+                                                            Data))
+
+        text = """
+BPF_PERF_OUTPUT(events);
+BPF_TABLE("array", int, u64, seq, 1);
+struct data_t {
+    u32 pid;
+    u64 seq;
+};
+int kprobe__sys_getpid(void *ctx) {
+    int zero = 0;
+    u64 *s = seq.lookup(&zero);
+    struct data_t data = {};
+    data.pid = bpf_get_current_pid_tgid() >> 32;
+    if (s)
+        data.seq = __sync_fetch_and_add(s, 1);
+    events.perf_submit(ctx, &data, sizeof(data));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        b["events"].open_perf_buffer(cb, page_cnt=64, batch=True)
+        for i in range(100):
+            os.getpid()
+        b.kprobe_poll(timeout=100)
+        self.assertTrue(self.events)
+        mine = [e for e in self.events if e["pid"] == os.getpid()] \
+            if hasattr(self.events[0], "dtype") else \
+            [e for e in self.events if e.pid == os.getpid()]
+        self.assertGreaterEqual(len(mine), 100)
+        b.cleanup()
+
+    def test_perf_buffer_wakeup(self):
+        self.counter = 0
+
+        def cb(cpu, data, size):
+            self.counter += 1
+
+        text = """
+BPF_PERF_OUTPUT(events);
+int kprobe__sys_getpid(void *ctx) {
+    u64 ts = bpf_ktime_get_ns();
+    events.perf_submit(ctx, &ts, sizeof(ts));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        b["events"].open_perf_buffer(cb, wakeup_events=1000,
+                                     flush_timeout=50)
+        for i in range(3):
+            os.getpid()
+        # no wakeup is due, the events are read after flush_timeout
+        start = time.time()
+        b.kprobe_poll()
+        self.assertLess(time.time() - start, 1)
+        self.assertGreaterEqual(self.counter, 3)
+        with self.assertRaises(Exception):
+            b["events"].open_perf_buffer(cb, page_cnt=1,
+                                         wakeup_watermark=1 << 20)
+        # once the buffers are closed, polls block as long as asked again
+        for cpu in list(b["events"]._cbs):
+            b["events"].close_perf_buffer(cpu)
+        self.assertIsNone(b._flush_timeout)
+        b.cleanup()
+
+    def test_perf_buffer_reopen(self):
+        self.counter = 0
+
+        def cb(cpu, data, size):
+            self.counter += 1
+
+        text = """
+BPF_PERF_OUTPUT(events);
+int kprobe__sys_getpid(void *ctx) {
+    u64 ts = bpf_ktime_get_ns();
+    events.perf_submit(ctx, &ts, sizeof(ts));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        events = b["events"]
+        events.open_perf_buffer(cb)
+        os.getpid()
+        b.kprobe_poll(timeout=100)
+        self.assertGreater(self.counter, 0)
+        # the poller follows buffers being closed and opened again
+        for cpu in list(events._cbs):
+            events.close_perf_buffer(cpu)
+        b.kprobe_poll(timeout=10)
+        events.open_perf_buffer(cb)
+        self.counter = 0
+        os.getpid()
+        b.kprobe_poll(timeout=100)
+        self.assertGreater(self.counter, 0)
+        b.cleanup()
+
+    def test_perf_buffer_close_in_callback(self):
+        self.counter = 0
+
+        def cb(cpu, data, size):
+            self.counter += 1
+            # readers of other CPUs may still be queued in this poll
+            for c in list(b["events"]._cbs):
+                b["events"].close_perf_buffer(c)
+
+        text = """
+BPF_PERF_OUTPUT(events);
+int kprobe__sys_getpid(void *ctx) {
+    u64 ts = bpf_ktime_get_ns();
+    events.perf_submit(ctx, &ts, sizeof(ts));
+    return 0;
+}
+"""
+        b = BPF(text=text)
+        b["events"].open_perf_buffer(cb)
+        for i in range(100):
+            os.getpid()
+        b.kprobe_poll(timeout=100)
+        self.assertGreater(self.counter, 0)
+        self.assertFalse(b["events"]._cbs)
+        # nothing is left to read
+        self.counter = 0
+        os.getpid()
+        b.kprobe_poll(timeout=10)
+        self.assertEqual(self.counter, 0)
+        b.cleanup()
+
+    def test_auto_page_cnt(self):
+        auto = PerfEventArray.auto_page_cnt
+        self.assertEqual(8, auto(100, ncpu=4))
+        page_cnt = auto(10000000, ncpu=4)
+        self.assertEqual(0, page_cnt & (page_cnt - 1))
+        self.assertGreater(page_cnt, 8)
+        self.assertEqual(PerfEventArray.MAX_AUTO_PAGE_CNT,
+                         auto(10 ** 12, ncpu=1))
+
 if __name__ == "__main__":
     main()
@@ -4,6 +4,9 @@
 
 from bcc import BPF
 import ctypes
+import os
+import shutil
+import tempfile
 from unittest import main, TestCase
 
 class TestClang(TestCase):
@@ -352,5 +355,112 @@ int many(struct pt_regs *ctx, int a, int b, int c, int d, int e, int f, int g) {
         with self.assertRaises(Exception):
             b = BPF(text=text)
 
+    def test_object_cache(self):
+        text = """
+BPF_HASH(counts, int, u64);
+int count(void *ctx) {
+    int key = 1;
+    u64 zero = 0, *val = counts.lookup_or_init(&key, &zero);
+    (*val)++;
+    return 0;
+}
+"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            b1 = BPF(text=text, cache_dir=cache_dir)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            b2 = BPF(text=text, cache_dir=cache_dir)
+            # map fds differ, but the programs must have the same size
+            self.assertEqual(len(b1.dump_func("count")),
+                    len(b2.dump_func("count")))
+            b2.load_func("count", BPF.KPROBE)
+            t = b2["counts"]
+            t[t.Key(1)] = t.Leaf(42)
+            self.assertEqual(42, t[t.Key(1)].value)
+            self.assertNotEqual(b1["counts"].map_fd, t.map_fd)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_from_object(self):
+        text = """
+struct key_t { u32 pid; char comm[16]; };
+BPF_HASH(counts, struct key_t, u64);
+int kprobe__sys_getuid(void *ctx) { return 0; }
+"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.bpfo")
+            b1 = BPF(text=text)
+            b1.save_object(path)
+            b1.cleanup()
+            b2 = BPF.from_object(path)
+            self.assertEqual(1, b2.num_open_kprobes())
+            t = b2["counts"]
+            self.assertEqual(["pid", "comm"],
+                    [f[0] for f in t.Key._fields_])
+            b2.cleanup()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_funcs_batch(self):
+        b = BPF(text="""
+int good1(void *ctx) { return 0; }
+int good2(void *ctx) { return 1; }
+int bad(void *ctx) { return *(int *)0x1234; }
+""")
+        res = b.load_funcs_batch([("good1", BPF.KPROBE), ("good2", BPF.KPROBE),
+                ("bad", BPF.KPROBE), ("missing", BPF.KPROBE)], logs=True)
+        self.assertEqual(["good1", "good2"], sorted(res.funcs.keys()))
+        self.assertEqual(["bad", "missing"], sorted(res.errors.keys()))
+        self.assertIn("bad", res.logs)
+        self.assertIs(res.funcs["good1"], b.load_func("good1", BPF.KPROBE))
+        with self.assertRaises(Exception):
+            res.check()
+
+    def test_pch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            text = """
+int count(struct pt_regs *ctx) {
+    struct task_struct *t = (struct task_struct *)bpf_get_current_task();
+    return t->pid;
+}
+"""
+            path = os.path.join(tmpdir, "sched.pch")
+            BPF.build_pch(["uapi/linux/ptrace.h", "linux/sched.h"], path)
+            b = BPF(text=text, pch=path)
+            b.load_func("count", BPF.KPROBE)
+            b = BPF(text=text, pch=True, cache_dir=tmpdir)
+            self.assertEqual(2, len([f for f in os.listdir(tmpdir)
+                                     if f.endswith(".pch")]))
+            # the automatic header is built, and cached, per set of cflags
+            b = BPF(text=text.replace("t->pid", "t->pid + VALUE"), pch=True,
+                    cache_dir=tmpdir, cflags=["-DVALUE=1"])
+            b.load_func("count", BPF.KPROBE)
+            self.assertEqual(3, len([f for f in os.listdir(tmpdir)
+                                     if f.endswith(".pch")]))
+            # an error in the program keeps the cached header
+            with self.assertRaises(Exception):
+                BPF(text=text + "int broken(", pch=True, cache_dir=tmpdir)
+            self.assertEqual(3, len([f for f in os.listdir(tmpdir)
+                                     if f.endswith(".pch")]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_auto_includes(self):
+        self.assertEqual("", BPF.generate_auto_includes(
+                ["p::do_sys_open(int dfd, char *filename)"]))
+        self.assertEqual("#include <linux/fs.h>\n",
+                BPF.generate_auto_includes(["p::vfs_read(struct file *f)"]))
+        text = BPF.generate_auto_includes(
+                ["p::vfs_read(struct file *f) \"%d\", f->f_flags",
+                 "p::tcp_sendmsg(struct sock *sk) \"%llx\", sk"],
+                forward_decls=True)
+        self.assertEqual("#include <linux/fs.h>\nstruct sock;\n", text)
+        b = BPF(text=text + """
+int count(struct pt_regs *ctx, struct sock *sk) { return sk != 0; }
+""")
+        b.load_func("count", BPF.KPROBE)
+
 if __name__ == "__main__":
     main()
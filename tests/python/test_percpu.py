@@ -98,6 +98,35 @@ class TestPercpu(unittest.TestCase):
         k = stats_map[ stats_map.Key(0) ]
         self.assertGreater(k.c1, 0L)
 
+    def test_reduce_all(self):
+        bpf_code = BPF(text="""
+        BPF_TABLE("percpu_hash", u32, u64, stats, 16);
+        BPF_TABLE("percpu_array", u32, u32, counts, 4);
+        """)
+        ncpu = multiprocessing.cpu_count()
+        stats_map = bpf_code.get_table("stats")
+        for k in range(0, 10):
+            ini = stats_map.Leaf()
+            for i in range(0, ncpu):
+                ini[i] = k * i
+            stats_map[ stats_map.Key(k) ] = ini
+        keys, sums = stats_map.reduce_all()
+        self.assertEqual(len(keys), 10)
+        for k, s in zip(keys, sums):
+            self.assertEqual(s, k * ncpu * (ncpu - 1) / 2)
+        keys, maxes = stats_map.reduce_all("max")
+        for k, m in zip(keys, maxes):
+            self.assertEqual(m, k * (ncpu - 1))
+        counts_map = bpf_code.get_table("counts")
+        ini = counts_map.Leaf()
+        for i in range(0, ncpu):
+            ini[i] = 2
+        counts_map[ counts_map.Key(1) ] = ini
+        keys, means = counts_map.reduce_all("mean")
+        self.assertEqual(list(means), [0, 2, 0, 0])
+        keys, mins = counts_map.reduce_all("min")
+        self.assertEqual(list(mins), [0, 2, 0, 0])
+
     def cleanup(self):
         BPF.detach_kprobe("sys_clone")
 
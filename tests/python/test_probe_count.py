@@ -2,9 +2,11 @@
 # Copyright (c) Suchakra Sharma <suchakrapani.sharma@polymtl.ca>
 # Licensed under the Apache License, Version 2.0 (the "License")
 
-from bcc import BPF, _get_num_open_probes
+from bcc import BPF, BPFBuilder, KernelFunctions, ProbeBudget, \
+        _get_num_open_probes
 import os
 import sys
+import threading
 from unittest import main, TestCase
 
 class TestKprobeCnt(TestCase):
@@ -29,6 +31,87 @@ class TestKprobeCnt(TestCase):
         self.b.cleanup()
 
 
+class TestKprobeBulk(TestCase):
+    def setUp(self):
+        self.b = BPF(text="""
+        int entry(void *ctx) { return 0; }
+        int ret(void *ctx) { return 0; }
+        """)
+
+    def test_attach_kprobes(self):
+        res = self.b.attach_kprobes("^vfs_read$", fn_name="entry",
+                                    ret_fn_name="ret")
+        self.assertEqual([("vfs_read", "entry"), ("vfs_read", "return")],
+                         res.attached)
+        self.assertEqual({}, res.errors)
+        self.assertGreaterEqual(res.elapsed, 0)
+        self.assertEqual(2, self.b.num_open_kprobes())
+
+    def test_cleanup_background(self):
+        res = self.b.attach_kprobes("^vfs_", fn_name="entry",
+                                    ret_fn_name="ret")
+        self.assertGreater(len(res.attached), 0)
+        t = self.b.cleanup(background=True)
+        self.assertEqual(0, self.b.num_open_kprobes())
+        t.join()
+        with open("/sys/kernel/debug/tracing/kprobe_events") as f:
+            self.assertNotIn("p_vfs_read ", f.read())
+
+    def tearDown(self):
+        self.b.cleanup()
+
+
+class TestKernelFunctions(TestCase):
+    def test_lookups(self):
+        kf = KernelFunctions.instance()
+        fns = BPF.get_kprobe_functions("^vfs_.*")
+        self.assertIn("vfs_read", fns)
+        self.assertEqual(fns, kf.with_prefix("vfs_"))
+        self.assertEqual(fns, kf.glob("vfs_*"))
+        self.assertEqual(len(fns), kf.count("vfs_"))
+        self.assertIs(kf.names(), kf.names())
+
+    def test_refresh(self):
+        kf = KernelFunctions()
+        names = kf.names()
+        # an unchanged set of modules keeps the catalogue once the check
+        # interval has passed, and force always reloads it
+        kf._checked = 0
+        self.assertIs(names, kf.names())
+        kf.refresh(force=True)
+        self.assertIsNot(names, kf.names())
+        self.assertEqual(names, kf.names())
+
+
+class TestBPFBuilder(TestCase):
+    text = """
+int count(void *ctx) { return 0; }
+int on_switch(void *ctx) { return 0; }
+"""
+
+    def test_result(self):
+        builder = BPFBuilder(text=self.text)
+        builder.add_kprobe(event="vfs_read", fn_name="count")
+        builder.add_kprobe(event_re="^vfs_write$", fn_name="count",
+                           retprobe=True)
+        builder.add_uprobe(name="c", sym="malloc", fn_name="count")
+        builder.add_tracepoint(tp="sched:sched_switch", fn_name="on_switch")
+        b = builder.result()
+        self.assertIs(b, builder.result())
+        self.assertEqual(2, b.num_open_kprobes())
+        self.assertEqual(1, len(b.open_uprobes))
+        self.assertEqual(1, len(b.open_tracepoints))
+        b.cleanup()
+
+    def test_failure(self):
+        builder = BPFBuilder(text=self.text)
+        builder.add_kprobe(event="vfs_read", fn_name="count")
+        builder.add_tracepoint(tp="sched:___doesnotexist", fn_name="on_switch")
+        with self.assertRaises(Exception):
+            builder.result()
+        self.assertEqual(0, _get_num_open_probes())
+
+
 class TestProbeGlobalCnt(TestCase):
     def setUp(self):
         self.b1 = BPF(text="""int count(void *ctx) { return 0; }""")
@@ -55,6 +138,17 @@ class TestAutoKprobe(TestCase):
     def test_count(self):
         self.assertEqual(2, self.b.num_open_kprobes())
 
+    def test_cleanup_background(self):
+        t = self.b.cleanup(background=True)
+        self.assertEqual(0, self.b.num_open_kprobes())
+        # attaching the same probes again waits for the pending detach
+        b = BPF(text="""int kprobe__schedule(void *ctx) { return 0; }""")
+        self.assertEqual(1, b.num_open_kprobes())
+        t.join()
+        with open("/sys/kernel/debug/tracing/kprobe_events") as f:
+            self.assertIn("p_schedule ", f.read())
+        b.cleanup()
+
     def tearDown(self):
         self.b.cleanup()
 
@@ -67,6 +161,49 @@ class TestProbeQuota(TestCase):
         with self.assertRaises(Exception):
             self.b.attach_kprobe(event_re=".*", fn_name="count")
 
+    def test_instance_budget(self):
+        b = BPF(text="""int count(void *ctx) { return 0; }""",
+                probe_limit=2)
+        try:
+            b.attach_kprobe(event="vfs_read", fn_name="count")
+            b.attach_kretprobe(event="vfs_read", fn_name="count")
+            self.assertEqual(2, b.probe_budget.counts()[ProbeBudget.KPROBE])
+            self.assertEqual(0, b.probe_budget.available())
+            self.assertGreater(b.probe_budget.overhead_ns(), 0)
+            with self.assertRaises(Exception):
+                b.attach_kprobe(event="vfs_write", fn_name="count")
+            # the process budget is only charged for the attached probes
+            self.assertEqual(2, ProbeBudget.process().counts()[
+                ProbeBudget.KPROBE])
+            # a probe that fails to attach gives its reservation back
+            b.detach_kretprobe(event="vfs_read")
+            with self.assertRaises(Exception):
+                b.attach_kprobe(event="___doesnotexist", fn_name="count")
+            self.assertEqual(1, b.probe_budget.total())
+        finally:
+            b.cleanup()
+        self.assertEqual(0, b.probe_budget.total())
+
+    def test_reserve_concurrent(self):
+        parent = ProbeBudget(limit=50, name="parent")
+        budgets = [ProbeBudget(parent=parent) for i in range(4)]
+        failed = []
+        def reserve(budget):
+            for i in range(100):
+                try:
+                    budget.reserve(ProbeBudget.KPROBE)
+                except Exception:
+                    failed.append(i)
+        threads = [threading.Thread(target=reserve, args=(budget,))
+                   for budget in budgets]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(50, parent.total())
+        self.assertEqual(50, sum([budget.total() for budget in budgets]))
+        self.assertEqual(350, len(failed))
+
     def tearDown(self):
         self.b.cleanup()
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 The bcc Authors
+# Licensed under the Apache License, Version 2.0 (the "License")
+
+from bcc import BPF, DoubleTable
+import ctypes as ct
+import errno
+import os
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from unittest import main, TestCase
+
+class TestTableDump(TestCase):
+    def setUp(self):
+        self.b = BPF(text="""
+struct key_t {
+    u32 pid;
+    u32 tid;
+};
+BPF_HASH(hash, struct key_t, u64, 1024);
+BPF_TABLE("array", int, u64, array, 64);
+""")
+
+    def tearDown(self):
+        self.b.cleanup()
+
+    def test_dump_hash(self):
+        t = self.b["hash"]
+        keys, leaves = t.dump()
+        self.assertEqual(0, len(keys))
+        for i in range(1000):
+            t[t.Key(i, i * 2)] = t.Leaf(i * 3)
+        keys, leaves = t.dump()
+        self.assertEqual(1000, len(keys))
+        self.assertEqual(1000, len(leaves))
+        for k, v in zip(keys, leaves):
+            self.assertEqual(k.tid, k.pid * 2)
+            self.assertEqual(v, k.pid * 3)
+        self.assertEqual(ct.sizeof(t.Key) * 1000, len(memoryview(keys).tobytes()))
+        keys, leaves = t.dump(max_entries=10)
+        self.assertEqual(10, len(keys))
+
+    def test_dump_array(self):
+        t = self.b["array"]
+        t[5] = ct.c_ulonglong(42)
+        keys, leaves = t.dump()
+        self.assertEqual(list(range(64)), list(keys))
+        self.assertEqual(42, leaves[5])
+
+    def test_to_arrays(self):
+        t = self.b["hash"]
+        for i in range(10):
+            t[t.Key(i, 0)] = t.Leaf(i * 10)
+        keys, leaves = t.to_arrays()
+        self.assertEqual(10, len(keys))
+        if np is not None:
+            self.assertEqual(("pid", "tid"), keys.dtype.names)
+            self.assertEqual(sorted(keys["pid"] * 10), sorted(leaves))
+            snap = t.snapshot()
+            top = snap[np.argsort(snap["leaf"])[::-1][:3]]
+            self.assertEqual([9, 8, 7], list(top["key"]["pid"]))
+        else:
+            self.assertEqual(list(range(0, 100, 10)), sorted(leaves))
+            self.assertEqual(ct.sizeof(t.Key) * 10, keys.nbytes)
+
+    def test_len(self):
+        t = self.b["hash"]
+        self.assertEqual(0, len(t))
+        for i in range(100):
+            t[t.Key(i, 0)] = t.Leaf(i)
+        self.assertEqual(100, len(t))
+        del t[t.Key(0, 0)]
+        # the cached count is returned until the table is counted again
+        self.assertEqual(100, t.cached_len(max_age=None))
+        self.assertEqual(99, t.cached_len(max_age=0))
+        del t[t.Key(1, 0)]
+        self.assertEqual(99, t.cached_len(max_age=None))
+        self.assertEqual(98, len(t))
+        self.assertEqual(98, t.cached_len(max_age=None))
+        self.assertEqual(64, self.b["array"].cached_len())
+
+    def test_iter(self):
+        t = self.b["hash"]
+        self.assertEqual([], list(t.keys()))
+        # keys that used to be probed for a free starting point
+        for v in [0, 0xffffffff, 0x55555555]:
+            t[t.Key(v, v)] = t.Leaf(v)
+        keys = list(t.keys())
+        self.assertEqual(3, len(set((k.pid, k.tid) for k in keys)))
+        t.clear()
+        self.assertEqual(0, len(t))
+
+    def test_clear_full(self):
+        t = self.b["hash"]
+        t.update_many([t.Key(i, i) for i in range(1024)],
+                      [t.Leaf(i) for i in range(1024)])
+        self.assertEqual(1024, len(t))
+        t.clear()
+        self.assertEqual(0, len(t))
+        t.clear()
+
+    def test_update_delete_many(self):
+        t = self.b["hash"]
+        keys = [t.Key(i, i) for i in range(1000)]
+        leaves = [t.Leaf(i * 2) for i in range(1000)]
+        self.assertEqual([], t.update_many(keys, leaves))
+        self.assertEqual(1000, len(t))
+        self.assertEqual(20, t[t.Key(10, 10)].value)
+        self.assertEqual([], t.delete_many(keys[:500]))
+        self.assertEqual(500, len(t))
+        failed = t.delete_many([t.Key(500, 500), t.Key(2000, 0),
+                                t.Key(501, 501)])
+        self.assertEqual(1, len(failed))
+        self.assertEqual(2000, failed[0][0].pid)
+        self.assertEqual(errno.ENOENT, failed[0][1])
+        self.assertEqual([], t.delete_many(t.dump()[0]))
+        self.assertEqual(0, len(t))
+
+        a = self.b["array"]
+        self.assertEqual([], a.update_many([a.Key(1), a.Key(2)],
+                                           [a.Leaf(10), a.Leaf(20)]))
+        self.assertEqual(20, a[2].value)
+        self.assertEqual(1, len(a.update_many([a.Key(100)], [a.Leaf(1)])))
+        self.assertEqual([], a.delete_many([1, 2]))
+        self.assertEqual(0, a[2].value)
+
+    def test_delete_many_fallback(self):
+        # stack trace maps have no batch ops, so every key goes through the
+        # per-key fallback and each failure is reported on its own
+        b = BPF(text="BPF_STACK_TRACE(stacks, 64);")
+        t = b["stacks"]
+        failed = t.delete_many([t.Key(1), t.Key(2), t.Key(3)])
+        self.assertEqual([1, 2, 3], [k.value for k, e in failed])
+        self.assertEqual([errno.ENOENT] * 3, [e for k, e in failed])
+        b.cleanup()
+
+    def test_get_table_cached(self):
+        t = self.b.get_table("hash")
+        self.assertIs(t, self.b.get_table("hash"))
+        self.assertIs(t, self.b["hash"])
+        self.assertIsNot(t, self.b.get_table("hash", leaftype=ct.c_ulonglong))
+        b = BPF(text="""
+struct key_t {
+    u32 pid;
+    u32 tid;
+};
+BPF_HASH(other, struct key_t, u64, 16);
+""")
+        self.assertIs(t.Key, b["other"].Key)
+        b.cleanup()
+
+    def test_lookup_into(self):
+        b = BPF(text="""
+struct leaf_t {
+    u8 flag;
+    u64 count;
+    char comm[4];
+};
+BPF_HASH(stats, u32, struct leaf_t, 16);
+""")
+        t = b["stats"]
+        for i in range(4):
+            t[t.Key(i)] = t.Leaf(1, i * 10, b"ab")
+        key = t.Key()
+        buf = bytearray(ct.sizeof(t.Leaf))
+        unpack = t.leaf_struct().unpack_from
+        for i in range(4):
+            key.value = i
+            self.assertTrue(t.lookup_into(key, buf))
+            self.assertEqual((1, i * 10, b"ab\0\0"), unpack(buf))
+        key.value = 100
+        self.assertFalse(t.lookup_into(key, buf))
+        self.assertEqual((3,), t.key_struct().unpack_from(
+            memoryview(t.Key(3))))
+        b.cleanup()
+        a = self.b["array"]
+        a[2] = a.Leaf(42)
+        buf = bytearray(ct.sizeof(a.Leaf))
+        self.assertTrue(a.lookup_into(2, buf))
+        self.assertEqual((42,), a.leaf_struct().unpack_from(buf))
+        self.assertTrue(a.lookup_into(-62, buf))
+        self.assertEqual((42,), a.leaf_struct().unpack_from(buf))
+
+    def test_zero_array(self):
+        b = BPF(text="""BPF_TABLE("percpu_array", int, u64, pcpu, 128);""")
+        for t in [self.b["array"], b["pcpu"]]:
+            leaf = t.Leaf()
+            ct.memset(ct.pointer(leaf), 0x1, ct.sizeof(leaf))
+            for i in range(len(t)):
+                t[i] = leaf
+            t.zero()
+            keys, leaves = t.dump()
+            self.assertEqual(b"\0" * ct.sizeof(leaves),
+                             ct.string_at(leaves, ct.sizeof(leaves)))
+            t[3] = leaf
+            t.clear()
+            self.assertEqual(0, t.getvalue(3)[0] if t is b["pcpu"]
+                             else t[3].value)
+        b.cleanup()
+
+class TestDoubleTable(TestCase):
+    def test_swap_and_drain(self):
+        b = BPF(text="""
+BPF_DOUBLE_TABLE("hash", u32, u64, counts, 1024);
+int count(void *ctx) {
+    u32 key = bpf_get_current_pid_tgid() >> 32;
+    %s
+    return 0;
+}
+""" % DoubleTable.update_text("counts", "increment(key)"))
+        b.attach_kprobe(event="sys_getpid", fn_name="count")
+        counts = b.get_double_table("counts")
+        pid = os.getpid()
+        self.assertIs(counts.tables[0], counts.active())
+        os.getpid()
+        items = counts.swap_and_drain()
+        self.assertIs(counts.tables[1], counts.active())
+        self.assertGreaterEqual(dict((k.value, v.value) for k, v in items)
+                                .get(pid, 0), 1)
+        os.getpid()
+        self.assertGreaterEqual(counts.tables[1][ct.c_uint(pid)].value, 1)
+        # updates that reach a drained table late are returned by the next
+        # drain, which clears it before it becomes active again
+        t = counts.tables[0]
+        t[t.Key(1)] = t.Leaf(5)
+        items = dict((k.value, v.value) for k, v in counts.swap_and_drain())
+        self.assertIs(counts.tables[0], counts.active())
+        self.assertEqual(0, len(counts.tables[0]))
+        self.assertEqual(5, items[1])
+        self.assertGreaterEqual(items.get(pid, 0), 1)
+        b.cleanup()
+
+if __name__ == "__main__":
+    main()
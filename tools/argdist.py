@@ -607,7 +607,8 @@ struct __string_t { char s[%d]; };
                 for include in (self.args.include or []):
                         bpf_source += "#include <%s>\n" % include
                 bpf_source += BPF.generate_auto_includes(
-                                map(lambda p: p.raw_spec, self.probes))
+                                map(lambda p: p.raw_spec, self.probes),
+                                forward_decls=True)
                 bpf_source += Tracepoint.generate_decl()
                 bpf_source += Tracepoint.generate_entry_probe()
                 for probe in self.probes:
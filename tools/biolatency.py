@@ -12,7 +12,7 @@
 # 20-Sep-2015   Brendan Gregg   Created this.
 
 from __future__ import print_function
-from bcc import BPF
+from bcc import BPF, DoubleTable
 from time import sleep, strftime
 import argparse
 
@@ -92,17 +92,21 @@ if args.milliseconds:
 else:
     bpf_text = bpf_text.replace('FACTOR', 'delta /= 1000;')
     label = "usecs"
+# the histogram is double buffered, so that it can be printed and cleared
+# while the I/O that completes meanwhile is counted in the other one
 if args.disks:
     bpf_text = bpf_text.replace('STORAGE',
-        'BPF_HISTOGRAM(dist, disk_key_t);')
+        'BPF_DOUBLE_TABLE("histogram", disk_key_t, u64, dist, 64);')
     bpf_text = bpf_text.replace('STORE',
         'disk_key_t key = {.slot = bpf_log2l(delta)}; ' +
         'bpf_probe_read(&key.disk, sizeof(key.disk), ' +
-        'req->rq_disk->disk_name); dist.increment(key);')
+        'req->rq_disk->disk_name); ' +
+        DoubleTable.update_text('dist', 'increment(key)'))
 else:
-    bpf_text = bpf_text.replace('STORAGE', 'BPF_HISTOGRAM(dist);')
+    bpf_text = bpf_text.replace('STORAGE',
+        'BPF_DOUBLE_TABLE("histogram", int, u64, dist, 64);')
     bpf_text = bpf_text.replace('STORE',
-        'dist.increment(bpf_log2l(delta));')
+        DoubleTable.update_text('dist', 'increment(bpf_log2l(delta))'))
 if debug:
     print(bpf_text)
 
@@ -120,7 +124,7 @@ print("Tracing block device I/O... Hit Ctrl-C to end.")
 
 # output
 exiting = 0 if args.interval else 1
-dist = b.get_table("dist")
+dist = b.get_double_table("dist")
 while (1):
     try:
         sleep(int(args.interval))
@@ -131,8 +135,9 @@ while (1):
     if args.timestamp:
         print("%-8s\n" % strftime("%H:%M:%S"), end="")
 
-    dist.print_log2_hist(label, "disk")
-    dist.clear()
+    idle = dist.swap()
+    idle.print_log2_hist(label, "disk")
+    idle.clear()
 
     countdown -= 1
     if exiting or countdown == 0:
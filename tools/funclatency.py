@@ -151,8 +151,8 @@ def signal_ignore(signal, frame):
 
 # load BPF program
 b = BPF(text=bpf_text)
-b.attach_kprobe(event_re=pattern, fn_name="trace_func_entry")
-b.attach_kretprobe(event_re=pattern, fn_name="trace_func_return")
+b.attach_kprobes(pattern, fn_name="trace_func_entry",
+                 ret_fn_name="trace_func_return")
 matched = b.num_open_kprobes()
 if matched == 0:
     print("0 functions matched by \"%s\". Exiting." % args.pattern)
@@ -9,7 +9,7 @@
 # Licensed under the Apache License, Version 2.0 (the "License")
 # Copyright (C) 2016 Sasha Goldshtein.
 
-from bcc import BPF, Tracepoint, Perf, USDT
+from bcc import BPF, BPFBuilder, Tracepoint, Perf, USDT
 from functools import partial
 from time import sleep, strftime
 import argparse
@@ -451,24 +451,27 @@ int %s(%s)
                    Probe.event_count >= Probe.max_events:
                         exit()
 
-        def attach(self, bpf, verbose):
+        def attach(self, builder):
                 if len(self.library) == 0:
-                        self._attach_k(bpf)
+                        self._attach_k(builder)
                 else:
-                        self._attach_u(bpf)
+                        self._attach_u(builder)
+
+        def open_perf_buffer(self, bpf):
                 self.python_struct = self._generate_python_data_decl()
                 callback = partial(self.print_event, bpf)
                 bpf[self.events_name].open_perf_buffer(callback)
 
-        def _attach_k(self, bpf):
+        def _attach_k(self, builder):
                 if self.probe_type == "r":
-                        bpf.attach_kretprobe(event=self.function,
-                                             fn_name=self.probe_name)
+                        builder.add_kprobe(event=self.function,
+                                           fn_name=self.probe_name,
+                                           retprobe=True)
                 elif self.probe_type == "p" or self.probe_type == "t":
-                        bpf.attach_kprobe(event=self.function,
-                                          fn_name=self.probe_name)
+                        builder.add_kprobe(event=self.function,
+                                           fn_name=self.probe_name)
 
-        def _attach_u(self, bpf):
+        def _attach_u(self, builder):
                 libpath = BPF.find_library(self.library)
                 if libpath is None:
                         # This might be an executable (e.g. 'bash')
@@ -476,18 +479,16 @@ int %s(%s)
                 if libpath is None or len(libpath) == 0:
                         self._bail("unable to find library %s" % self.library)
 
+                # The symbol is resolved by the builder while the program
+                # compiles
                 if self.probe_type == "u":
                         pass # Was already enabled by the BPF constructor
-                elif self.probe_type == "r":
-                        bpf.attach_uretprobe(name=libpath,
-                                             sym=self.function,
-                                             fn_name=self.probe_name,
-                                             pid=Probe.pid)
                 else:
-                        bpf.attach_uprobe(name=libpath,
-                                          sym=self.function,
-                                          fn_name=self.probe_name,
-                                          pid=Probe.pid)
+                        builder.add_uprobe(name=libpath,
+                                           sym=self.function,
+                                           fn_name=self.probe_name,
+                                           retprobe=self.probe_type == "r",
+                                           pid=Probe.pid)
 
 class Tool(object):
         examples = """
@@ -557,7 +558,8 @@ trace 'u:pthread:pthread_create (arg4 != 0)'
 
 """
                 self.program += BPF.generate_auto_includes(
-                        map(lambda p: p.raw_probe, self.probes))
+                        map(lambda p: p.raw_probe, self.probes),
+                        forward_decls=True)
                 self.program += Tracepoint.generate_decl()
                 self.program += Tracepoint.generate_entry_probe()
                 for probe in self.probes:
@@ -577,12 +579,16 @@ trace 'u:pthread:pthread_create (arg4 != 0)'
                         probe.usdt.enable_probe(
                                 probe.usdt_name, probe.probe_name)
                         usdt_contexts.append(probe.usdt)
-                self.bpf = BPF(text=self.program, usdt_contexts=usdt_contexts)
-                Tracepoint.attach(self.bpf)
+                builder = BPFBuilder(text=self.program,
+                                     usdt_contexts=usdt_contexts)
                 for probe in self.probes:
                         if self.args.verbose:
                                 print(probe)
-                        probe.attach(self.bpf, self.args.verbose)
+                        probe.attach(builder)
+                self.bpf = builder.result()
+                Tracepoint.attach(self.bpf)
+                for probe in self.probes:
+                        probe.open_perf_buffer(self.bpf)
 
         def _main_loop(self):
                 all_probes_trivial = all(map(Probe.is_default_action,